@@ -1,29 +1,38 @@
 import os
+import json
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from pydantic import BaseModel
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from backend import models, database
+from backend.passwords import verify_password, get_password_hash
+from backend.redis_client import get_async_redis_client
+from backend.telemetry import span
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
+PRINCIPAL_CACHE_TTL_SECONDS = int(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", "300"))
+PRINCIPAL_CACHE_MAX_ENTRIES = int(os.getenv("PRINCIPAL_CACHE_MAX_ENTRIES", "10000"))
+# The in-process tier is not told about invalidations made by other API instances,
+# so it keeps entries for a shorter time than Redis does.
+PRINCIPAL_LOCAL_TTL_SECONDS = min(60, PRINCIPAL_CACHE_TTL_SECONDS)
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 class TokenData(BaseModel):
     username: Optional[str] = None
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
-
-def get_password_hash(password):
-    return pwd_context.hash(password)
+class Principal(BaseModel):
+    """The authenticated user as endpoints see it; small enough to cache, unlike the ORM row."""
+    id: int
+    username: str
 
 def create_access_token(data: dict):
     to_encode = data.copy()
@@ -31,24 +40,95 @@ def create_access_token(data: dict):
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
-def get_user(db: Session, username: str):
-    return db.query(models.User).filter(models.User.username == username).first()
+async def get_user(db: AsyncSession, username: str):
+    result = await db.execute(select(models.User).where(models.User.username == username))
+    return result.scalar_one_or_none()
+
+
+class PrincipalCache:
+    """
+    Caches principals by token subject so authenticated requests skip the user query.
+    An in-process LRU sits in front of a shared Redis tier under `principal:{username}`.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: int, local_ttl_seconds: int):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.local_ttl_seconds = local_ttl_seconds
+        self._local = OrderedDict()
+
+    @staticmethod
+    def _key(username: str) -> str:
+        return f"principal:{username}"
+
+    def _remember(self, principal: Principal):
+        self._local[principal.username] = (time.monotonic() + self.local_ttl_seconds, principal)
+        self._local.move_to_end(principal.username)
+        while len(self._local) > self.max_entries:
+            self._local.popitem(last=False)
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
+    async def get(self, username: str) -> Optional[Principal]:
+        entry = self._local.get(username)
+        if entry is not None:
+            expires_at, principal = entry
+            if expires_at > time.monotonic():
+                self._local.move_to_end(username)
+                return principal
+            del self._local[username]
+        try:
+            raw = await get_async_redis_client().get(self._key(username))
+        except Exception as e:
+            print(f"Principal cache: Redis read failed: {e}")
+            return None
+        if raw is None:
+            return None
+        principal = Principal(**json.loads(raw))
+        self._remember(principal)
+        return principal
+
+    async def set(self, principal: Principal):
+        self._remember(principal)
+        try:
+            await get_async_redis_client().set(self._key(principal.username), principal.model_dump_json(), ex=self.ttl_seconds)
+        except Exception as e:
+            print(f"Principal cache: Redis write failed: {e}")
+
+    async def invalidate(self, username: str):
+        """Call whenever a user is created, changed or removed."""
+        self._local.pop(username, None)
+        try:
+            await get_async_redis_client().delete(self._key(username))
+        except Exception as e:
+            # The shared entry stays until its TTL runs out
+            print(f"Principal cache: Redis invalidation of {username} failed: {e}")
+
+
+principal_cache = PrincipalCache(PRINCIPAL_CACHE_MAX_ENTRIES, PRINCIPAL_CACHE_TTL_SECONDS, PRINCIPAL_LOCAL_TTL_SECONDS)
+
+async def get_current_user(token: str = Depends(oauth2_scheme)) -> Principal:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
+    with span("auth") as attributes:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            username: str = payload.get("sub")
+            if username is None:
+                raise credentials_exception
+            token_data = TokenData(username=username)
+        except JWTError:
+            raise credentials_exception
+        principal = await principal_cache.get(token_data.username)
+        attributes["cache_hit"] = principal is not None
+        if principal is not None:
+            return principal
+        # Cache miss: one short-lived session from the async pool, released before the endpoint runs
+        async with database.AsyncSessionLocal() as db:
+            user = await get_user(db, username=token_data.username)
+        if user is None:
             raise credentials_exception
-        token_data = TokenData(username=username)
-    except JWTError:
-        raise credentials_exception
-    user = get_user(db, username=token_data.username)
-    if user is None:
-        raise credentials_exception
-    return user
+        principal = Principal(id=user.id, username=user.username)
+        await principal_cache.set(principal)
+        return principal
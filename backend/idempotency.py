@@ -0,0 +1,53 @@
+import json
+import time
+import asyncio
+import hashlib
+from typing import Awaitable, Callable
+from fastapi import HTTPException, status
+from backend.redis_client import get_async_redis_client
+
+# --- Idempotency keys ---
+# A request carrying an `Idempotency-Key` header runs at most once per user and key:
+#   idempotency:{scope}:{key} -> {"state": "in_progress" | "done", "fingerprint", "response"}
+# A retry that arrives while the first attempt is still running waits for it, and one
+# that arrives afterwards gets the stored response back. Reusing a key for a different
+# request body is rejected. Failed attempts release the key so the client can retry.
+IDEMPOTENCY_TTL_SECONDS = 24 * 3600
+IDEMPOTENCY_IN_PROGRESS_TTL_SECONDS = 120
+IDEMPOTENCY_WAIT_SECONDS = 30
+_POLL_SECONDS = 0.1
+
+def _key(scope: str, idempotency_key: str) -> str:
+    return f"idempotency:{scope}:{idempotency_key}"
+
+def request_fingerprint(endpoint: str, body: dict) -> str:
+    return hashlib.sha256(f"{endpoint}\x00{json.dumps(body, sort_keys=True)}".encode()).hexdigest()
+
+async def run_idempotent(scope: str, idempotency_key: str, fingerprint: str, handler: Callable[[], Awaitable[dict]]) -> tuple[dict, bool]:
+    """Runs `handler` once for this scope and key. Returns (response, whether it was replayed)."""
+    redis = get_async_redis_client()
+    key = _key(scope, idempotency_key)
+    claimed = await redis.set(key, json.dumps({"state": "in_progress", "fingerprint": fingerprint}), nx=True, ex=IDEMPOTENCY_IN_PROGRESS_TTL_SECONDS)
+    if claimed:
+        try:
+            response = await handler()
+        except BaseException:
+            await redis.delete(key)
+            raise
+        await redis.set(key, json.dumps({"state": "done", "fingerprint": fingerprint, "response": response}, default=str), ex=IDEMPOTENCY_TTL_SECONDS)
+        return response, False
+
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        raw = await redis.get(key)
+        if raw is None:
+            # The first attempt failed and released the key; this retry takes over
+            return await run_idempotent(scope, idempotency_key, fingerprint, handler)
+        record = json.loads(raw)
+        if record["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Idempotency-Key was already used for a different request.")
+        if record["state"] == "done":
+            return record["response"], True
+        if time.monotonic() >= deadline:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="A request with this Idempotency-Key is still being processed.")
+        await asyncio.sleep(_POLL_SECONDS)
@@ -0,0 +1,397 @@
+import json
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+from typing import AsyncIterator, Optional
+from backend.redis_client import get_redis_client, get_async_redis_client
+
+# --- Redis-backed plan-run job queue ---
+# The API tier enqueues jobs and reads their status; the worker tier (backend/worker.py)
+# claims jobs, runs the Portia plan and reports progress. Each job has:
+#   job:{id}         -> hash with status, kind, payload and the final response
+#   job_events:{id}  -> Redis stream of progress events, replayable by SSE clients
+#   job_lease:{id}   -> held by the worker processing the job, renewed while it runs
+#
+# Jobs requeued with a delay (their session is busy on another worker) wait in the
+# jobs:delayed sorted set, scored by when they are due; each claim first moves due
+# jobs to the front of the queue.
+#
+# Claimed jobs sit on the processing list until they finish. A job whose lease has
+# lapsed there lost its worker (crash, OOM kill) and is reaped: requeued if it never
+# started, failed if it did, since a half-run plan may already have had side effects.
+# Taking the lease and reaping are both scripts that check the processing list, so a
+# job is either claimed by its worker or recovered by the reaper, never both.
+#
+# A plan run paused on an action (e.g. Xero OAuth) is parked instead of holding a worker:
+#   parked_run:{session_id} -> hash with the id of its pre-created resume job, and
+#                              `ready` once the action has been completed
+# Completing the action publishes the session id on PLAN_READY_CHANNEL; workers listen
+# there and queue the parked resume job.
+JOB_QUEUE_KEY = "jobs:queue"
+JOB_PROCESSING_KEY = "jobs:processing"
+JOB_TTL_SECONDS = 24 * 3600
+JOB_LEASE_SECONDS = 60
+JOB_REAPER_LOCK_KEY = "jobs:reaper_lock"
+JOB_REAPER_INTERVAL_SECONDS = JOB_LEASE_SECONDS / 2
+JOB_DELAYED_KEY = "jobs:delayed"
+JOB_BUSY_RETRY_INITIAL_SECONDS = 2
+JOB_BUSY_RETRY_MAX_SECONDS = 30
+JOB_EVENTS_MAXLEN = 500
+PARKED_TTL_SECONDS = 3600
+PLAN_READY_CHANNEL = "plan_runs:ready"
+
+JOB_PARKED = "parked"
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+TERMINAL_EVENTS = {"job_succeeded", "job_failed"}
+
+def _job_key(job_id: str) -> str:
+    return f"job:{job_id}"
+
+def _events_key(job_id: str) -> str:
+    return f"job_events:{job_id}"
+
+def _lease_key(job_id: str) -> str:
+    return f"job_lease:{job_id}"
+
+def _parked_key(session_id: str) -> str:
+    return f"parked_run:{session_id}"
+
+# Flags a parked run as ready only while its hash still exists, so an expired one is
+# not recreated without its job id or TTL
+_MARK_READY_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'ready', '1')
+return 1
+"""
+
+# KEYS: processing list, lease, job hash. ARGV: job id, now, lease seconds.
+# Takes the lease only if the reaper has not already taken the job off the list
+_TAKE_LEASE_LUA = """
+if not redis.call('LPOS', KEYS[1], ARGV[1]) then
+    return 0
+end
+redis.call('SET', KEYS[2], '1', 'EX', ARGV[3])
+redis.call('HSET', KEYS[3], 'claimed_at', ARGV[2])
+return 1
+"""
+
+# KEYS: processing list, lease, job hash. ARGV: job id, now, lease seconds.
+# Removes the job from the processing list if it has no lease and was not claimed
+# within the last lease period; returns the number of entries removed
+_REAP_LUA = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+local claimed_at = tonumber(redis.call('HGET', KEYS[3], 'claimed_at') or '0')
+if tonumber(ARGV[2]) - claimed_at < tonumber(ARGV[3]) then
+    return 0
+end
+return redis.call('LREM', KEYS[1], 1, ARGV[1])
+"""
+
+# KEYS: delayed set, queue. ARGV: now. Moves due jobs to the front of the queue
+_PROMOTE_DUE_LUA = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 100)
+for _, job_id in ipairs(due) do
+    redis.call('ZREM', KEYS[1], job_id)
+    redis.call('RPUSH', KEYS[2], job_id)
+end
+return #due
+"""
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+def _parse_job(job_id: str, raw: dict) -> Optional[dict]:
+    if not raw:
+        return None
+    job = {_decode(k): _decode(v) for k, v in raw.items()}
+    return {
+        "job_id": job_id,
+        "kind": job.get("kind"),
+        "status": job.get("status"),
+        "session_id": job.get("session_id"),
+        "user_id": job.get("user_id"),
+        "payload": json.loads(job.get("payload") or "{}"),
+        "response": json.loads(job["response"]) if job.get("response") else None,
+        "error": job.get("error") or None,
+        "created_at": float(job.get("created_at", 0)),
+        "updated_at": float(job.get("updated_at", 0)),
+    }
+
+def _event_fields(event_type: str, data: Optional[dict]) -> dict:
+    return {"type": event_type, "data": json.dumps(data or {}, default=str), "ts": str(time.time())}
+
+# --- API side (async) ---
+async def enqueue_job(kind: str, session_id: str, user_id: str, payload: dict) -> str:
+    """Records a new job, emits its `job_queued` event and pushes it onto the queue."""
+    redis = get_async_redis_client()
+    job_id = uuid.uuid4().hex
+    now = str(time.time())
+    job = {
+        "kind": kind,
+        "status": JOB_QUEUED,
+        "session_id": session_id,
+        "user_id": user_id,
+        "payload": json.dumps(payload),
+        "created_at": now,
+        "updated_at": now,
+    }
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(_job_key(job_id), mapping=job)
+        pipe.expire(_job_key(job_id), JOB_TTL_SECONDS)
+        pipe.xadd(_events_key(job_id), _event_fields("job_queued", {"kind": kind}), maxlen=JOB_EVENTS_MAXLEN)
+        pipe.expire(_events_key(job_id), JOB_TTL_SECONDS)
+        pipe.lpush(JOB_QUEUE_KEY, job_id)
+        await pipe.execute()
+    return job_id
+
+async def get_job(job_id: str) -> Optional[dict]:
+    raw = await get_async_redis_client().hgetall(_job_key(job_id))
+    return _parse_job(job_id, raw)
+
+async def get_parked_job(session_id: str) -> Optional[dict]:
+    """The parked resume job waiting on this session's action, if any."""
+    raw = await get_async_redis_client().hgetall(_parked_key(session_id))
+    return {_decode(k): _decode(v) for k, v in raw.items()} if raw else None
+
+async def mark_action_completed(session_id: str) -> int:
+    """
+    Flags the session's parked plan run as ready and wakes the workers. The flag makes
+    this durable: listeners that were down when it was published pick it up on start.
+    Returns the number of listeners that received the wake-up, or 0 if the parked run
+    has expired in the meantime.
+    """
+    redis = get_async_redis_client()
+    if not await redis.eval(_MARK_READY_LUA, 1, _parked_key(session_id)):
+        return 0
+    return await redis.publish(PLAN_READY_CHANNEL, session_id)
+
+async def stream_job_events(job_id: str, last_event_id: str = "0-0", block_ms: int = 15000) -> AsyncIterator[str]:
+    """
+    Yields the job's progress events formatted as server-sent events. Events already
+    recorded are replayed first, so clients can reconnect with `Last-Event-ID`.
+    The stream ends after a terminal event.
+    """
+    redis = get_async_redis_client()
+    while True:
+        entries = await redis.xread({_events_key(job_id): last_event_id}, block=block_ms, count=100)
+        if not entries:
+            # Keep idle connections alive through proxies
+            yield ": keep-alive\n\n"
+            continue
+        for _stream, events in entries:
+            for event_id, fields in events:
+                last_event_id = _decode(event_id)
+                fields = {_decode(k): _decode(v) for k, v in fields.items()}
+                yield f"id: {last_event_id}\nevent: {fields['type']}\ndata: {fields['data']}\n\n"
+                if fields["type"] in TERMINAL_EVENTS:
+                    return
+
+# --- Worker side (sync) ---
+def claim_next_job(timeout: int = 5) -> Optional[str]:
+    """Atomically moves the next job id from the queue onto the processing list and leases it."""
+    redis = get_redis_client()
+    redis.eval(_PROMOTE_DUE_LUA, 2, JOB_DELAYED_KEY, JOB_QUEUE_KEY, time.time())
+    job_id = redis.blmove(JOB_QUEUE_KEY, JOB_PROCESSING_KEY, timeout, "RIGHT", "LEFT")
+    if not job_id:
+        return None
+    job_id = _decode(job_id)
+    if not redis.eval(_TAKE_LEASE_LUA, 3, JOB_PROCESSING_KEY, _lease_key(job_id), _job_key(job_id), job_id, time.time(), JOB_LEASE_SECONDS):
+        # The reaper requeued it between the move and the lease; another claim will run it
+        return None
+    return job_id
+
+@contextmanager
+def job_lease(job_id: str):
+    """Renews the job's lease from a background thread while the block runs, then drops it."""
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(JOB_LEASE_SECONDS / 3):
+            try:
+                get_redis_client().set(_lease_key(job_id), "1", ex=JOB_LEASE_SECONDS)
+            except Exception as e:
+                print(f"Jobs: could not renew the lease of job {job_id}: {e}")
+
+    thread = threading.Thread(target=renew, name=f"job-lease-{job_id}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+        get_redis_client().delete(_lease_key(job_id))
+
+def requeue_job(job_id: str, delay_seconds: float = 0):
+    """Puts a claimed job back on the queue, or in the delayed set until `delay_seconds` have passed."""
+    redis = get_redis_client()
+    with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(_job_key(job_id), mapping={"status": JOB_QUEUED, "updated_at": str(time.time())})
+        pipe.lrem(JOB_PROCESSING_KEY, 1, job_id)
+        if delay_seconds > 0:
+            pipe.zadd(JOB_DELAYED_KEY, {job_id: time.time() + delay_seconds})
+        else:
+            pipe.lpush(JOB_QUEUE_KEY, job_id)
+        pipe.delete(_lease_key(job_id))
+        pipe.execute()
+
+def requeue_busy_job(job_id: str) -> float:
+    """
+    Requeues a job whose session is locked by another worker, doubling the delay with
+    each attempt so it does not cycle through the workers while a long run holds the
+    lock. Returns the delay.
+    """
+    attempts = get_redis_client().hincrby(_job_key(job_id), "busy_requeues", 1)
+    delay = min(JOB_BUSY_RETRY_MAX_SECONDS, JOB_BUSY_RETRY_INITIAL_SECONDS * 2 ** (attempts - 1))
+    requeue_job(job_id, delay)
+    return delay
+
+def reap_orphaned_jobs() -> int:
+    """
+    Recovers jobs left on the processing list by dead workers. Runs in one worker at a
+    time per lease period; returns the number of jobs reaped.
+    """
+    redis = get_redis_client()
+    if not redis.set(JOB_REAPER_LOCK_KEY, "1", nx=True, ex=JOB_LEASE_SECONDS):
+        return 0
+    reaped = 0
+    for job_id in redis.lrange(JOB_PROCESSING_KEY, 0, -1):
+        job_id = _decode(job_id)
+        # Only the caller whose removal succeeds recovers the job
+        if not redis.eval(_REAP_LUA, 3, JOB_PROCESSING_KEY, _lease_key(job_id), _job_key(job_id), job_id, time.time(), JOB_LEASE_SECONDS):
+            continue
+        reaped += 1
+        job = load_job(job_id)
+        if job is None:
+            continue
+        if job["status"] == JOB_QUEUED:
+            print(f"Jobs: requeueing job {job_id}, whose worker stopped before starting it")
+            with redis.pipeline(transaction=True) as pipe:
+                pipe.hset(_job_key(job_id), mapping={"updated_at": str(time.time())})
+                pipe.lpush(JOB_QUEUE_KEY, job_id)
+                pipe.execute()
+        elif job["status"] == JOB_RUNNING:
+            print(f"Jobs: failing job {job_id}, whose worker stopped while running it")
+            finish_job(job_id, error="The worker running this task stopped unexpectedly. Please try again.")
+    return reaped
+
+def run_job_reaper():
+    """Blocks forever, reaping orphaned jobs on a timer independent of the workers' load."""
+    while True:
+        try:
+            reaped = reap_orphaned_jobs()
+            if reaped:
+                print(f"Jobs: recovered {reaped} job(s) left behind by stopped workers")
+        except Exception as e:
+            print(f"Jobs: reaper failed, retrying: {e}")
+        time.sleep(JOB_REAPER_INTERVAL_SECONDS)
+
+def load_job(job_id: str) -> Optional[dict]:
+    return _parse_job(job_id, get_redis_client().hgetall(_job_key(job_id)))
+
+def publish_job_event(job_id: str, event_type: str, data: Optional[dict] = None):
+    get_redis_client().xadd(_events_key(job_id), _event_fields(event_type, data), maxlen=JOB_EVENTS_MAXLEN)
+
+def mark_job_running(job_id: str):
+    get_redis_client().hset(_job_key(job_id), mapping={"status": JOB_RUNNING, "updated_at": str(time.time())})
+    publish_job_event(job_id, "job_started")
+
+def finish_job(job_id: str, response: Optional[dict] = None, error: Optional[str] = None):
+    """Stores the job's outcome, emits the terminal event and releases it from the processing list."""
+    status = JOB_FAILED if error else JOB_SUCCEEDED
+    fields = {"status": status, "updated_at": str(time.time())}
+    if response is not None:
+        fields["response"] = json.dumps(response, default=str)
+    if error:
+        fields["error"] = error
+    redis = get_redis_client()
+    with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(_job_key(job_id), mapping=fields)
+        pipe.xadd(_events_key(job_id), _event_fields(f"job_{status}", {"response": response, "error": error}), maxlen=JOB_EVENTS_MAXLEN)
+        pipe.lrem(JOB_PROCESSING_KEY, 1, job_id)
+        pipe.delete(_lease_key(job_id))
+        pipe.execute()
+
+def park_job(kind: str, session_id: str, user_id: str, payload: dict) -> str:
+    """
+    Records a job that runs only once the session's pending action is completed. Nothing
+    is queued and no worker waits on it; `release_parked_job` queues it later.
+    """
+    redis = get_redis_client()
+    job_id = uuid.uuid4().hex
+    now = str(time.time())
+    job = {
+        "kind": kind,
+        "status": JOB_PARKED,
+        "session_id": session_id,
+        "user_id": user_id,
+        "payload": json.dumps(payload),
+        "created_at": now,
+        "updated_at": now,
+    }
+    with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(_job_key(job_id), mapping=job)
+        pipe.expire(_job_key(job_id), JOB_TTL_SECONDS)
+        pipe.xadd(_events_key(job_id), _event_fields("job_parked", {"kind": kind}), maxlen=JOB_EVENTS_MAXLEN)
+        pipe.expire(_events_key(job_id), JOB_TTL_SECONDS)
+        pipe.delete(_parked_key(session_id))
+        pipe.hset(_parked_key(session_id), mapping={"job_id": job_id, "user_id": user_id})
+        pipe.expire(_parked_key(session_id), PARKED_TTL_SECONDS)
+        pipe.execute()
+    return job_id
+
+def release_parked_job(session_id: str) -> Optional[str]:
+    """Queues the session's parked job if its action is complete. Safe to call from many workers at once."""
+    redis = get_redis_client()
+    parked = redis.hgetall(_parked_key(session_id))
+    parked = {_decode(k): _decode(v) for k, v in parked.items()}
+    if parked.get("ready") != "1":
+        return None
+    if "job_id" not in parked:
+        # Left behind by an older release without the atomic ready flag; nothing to resume
+        redis.delete(_parked_key(session_id))
+        return None
+    # Only the caller whose delete succeeds queues the job
+    if not redis.delete(_parked_key(session_id)):
+        return None
+    job_id = parked["job_id"]
+    with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(_job_key(job_id), mapping={"status": JOB_QUEUED, "updated_at": str(time.time())})
+        pipe.xadd(_events_key(job_id), _event_fields("job_queued", {"kind": "resume"}), maxlen=JOB_EVENTS_MAXLEN)
+        pipe.lpush(JOB_QUEUE_KEY, job_id)
+        pipe.execute()
+    return job_id
+
+def release_ready_parked_jobs() -> int:
+    """Queues every parked job whose action completed while no listener was running."""
+    released = 0
+    for key in get_redis_client().scan_iter(match=_parked_key("*"), count=500):
+        if release_parked_job(_decode(key)[len(_parked_key("")):]):
+            released += 1
+    return released
+
+def listen_for_ready_plans():
+    """Blocks forever, queueing parked plan runs as their actions are completed."""
+    while True:
+        try:
+            pubsub = get_redis_client().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(PLAN_READY_CHANNEL)
+            # Catch up on wake-ups published while this listener was not subscribed
+            released = release_ready_parked_jobs()
+            if released:
+                print(f"Jobs: queued {released} parked plan run(s) that became ready while no listener was running")
+            for message in pubsub.listen():
+                session_id = _decode(message["data"])
+                job_id = release_parked_job(session_id)
+                if job_id:
+                    print(f"Jobs: action completed for session {session_id}, queued resume job {job_id}")
+        except Exception as e:
+            print(f"Jobs: plan-ready listener lost its connection, reconnecting: {e}")
+            time.sleep(1)
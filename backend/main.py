@@ -1,23 +1,36 @@
 import os
-import pickle
-from fastapi import FastAPI, Depends, HTTPException, status
-from pydantic import BaseModel
+import asyncio
+import time
+import tempfile
+from typing import Optional
+from functools import lru_cache
+from fastapi import FastAPI, Depends, Header, HTTPException, Request, Response, status
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 # Local imports will now work correctly after renaming the folder to `portia_agent`
 from portia_agent.agent import PortiaAIAgent
-from portia import ActionClarification, InputClarification, MultipleChoiceClarification, PlanRunState, PlanRun
-from backend.redis_client import get_redis_client
-from backend.database import get_db, Base, engine
+from portia_agent.hs_index import get_hs_index
+from portia_agent.sanctions import DEFAULT_MATCH_THRESHOLD, get_sanctions_screener
+from portia_agent.landed_cost import get_tariff_tables, price_shipment_file
+from portia_agent.mcp_cache import get_mcp_cache_stats
+from portia_agent.llm_scheduler import PLAN_RUN_COST, LLMRateLimited, get_llm_scheduler, retry_after_header
+from backend.redis_client import get_redis_client, get_async_redis_client
+from backend.jobs import enqueue_job, get_job, get_parked_job, mark_action_completed, stream_job_events
+from backend.plan_state import plan_run_exists
+from backend.database import get_async_db, Base, async_engine
 from backend.models import User
-from backend.auth import create_access_token, get_password_hash, verify_password, get_current_user
-# from backend.plan_registrar import register_all_plans # Uncomment if using pre-defined plans
-
-# --- Database Setup ---
-Base.metadata.create_all(bind=engine)
+from backend.auth import Principal, create_access_token, get_current_user, principal_cache
+from backend.passwords import get_password_hash_async, verify_password_async, start_password_pool, shutdown_password_pool
+from backend.startup import StartupState
+from backend.idempotency import request_fingerprint, run_idempotent
+from backend.telemetry import HTTP_LATENCY, configure_tracing, render_metrics
 
 # --- App Initialization ---
 load_dotenv()
@@ -34,121 +47,292 @@ if PRODUCTION_FRONTEND_URL:
 
 app.add_middleware(CORSMiddleware, allow_origins=allowed_origins, allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    # Label by route template (/jobs/{job_id}), not the raw path, to keep the series bounded
+    route = getattr(request.scope.get("route"), "path", "unmatched")
+    HTTP_LATENCY.labels(method=request.method, route=route, status=str(response.status_code)).observe(time.perf_counter() - start)
+    return response
+
 # --- Client Initializations ---
-agent = PortiaAIAgent(
-    portia_api_key=os.getenv("PORTIA_API_KEY"),
-    google_api_key=os.getenv("GOOGLE_API_KEY"),
-    xero_client_id=os.getenv("XERO_CLIENT_ID"),
-    xero_client_secret=os.getenv("XERO_CLIENT_SECRET")
-)
-redis = get_redis_client()
-portia_sdk = agent.portia_client.get_sdk()
-
-# --- HEALTH CHECK ENDPOINT (for Render) ---
+# Nothing slow happens at import time. The agent is built on first use, and the startup
+# event warms everything else in the background while /ready reports progress.
+@lru_cache(maxsize=1)
+def get_agent() -> PortiaAIAgent:
+    return PortiaAIAgent(
+        portia_api_key=os.getenv("PORTIA_API_KEY"),
+        google_api_key=os.getenv("GOOGLE_API_KEY"),
+        xero_client_id=os.getenv("XERO_CLIENT_ID"),
+        xero_client_secret=os.getenv("XERO_CLIENT_SECRET")
+    )
+
+redis = get_async_redis_client()
+startup_state = StartupState()
+
+@app.exception_handler(LLMRateLimited)
+async def llm_rate_limited(request: Request, exc: LLMRateLimited):
+    # Per-user quota or provider capacity exhausted: tell the client when to come back
+    return JSONResponse(status_code=status.HTTP_429_TOO_MANY_REQUESTS, content={"detail": str(exc), "scope": exc.scope}, headers=retry_after_header(exc))
+
+# --- HEALTH CHECK ENDPOINTS (for Render) ---
 @app.get("/health", status_code=status.HTTP_200_OK)
 def health_check():
+    """Liveness: the process is up, though it may still be warming up."""
     return {"status": "ok"}
 
+@app.get("/ready")
+def readiness_check():
+    """Readiness: database, Redis, agent and lookup indexes are all initialized."""
+    report = startup_state.report()
+    if not startup_state.ready:
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content=report)
+    return report
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus scrape endpoint: stage, HTTP, LLM token and tool-call metrics."""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Hit/miss counters for this process's pre-processing cache and the workers' shared Xero tool cache."""
+    return {"preprocess": get_agent().preprocess_cache.stats(), "xero_tools": await get_mcp_cache_stats(redis)}
+
 # --- Models and Helper Functions ---
 class ChatRequest(BaseModel):
     user_message: str
     session_id: str
+class ActionCompleteRequest(BaseModel):
+    session_id: str
 class UserCreate(BaseModel):
     username: str
     password: str
-
-def store_plan_run(session_id: str, plan_run: PlanRun):
-    redis.set(f"plan_run:{session_id}", pickle.dumps(plan_run), ex=3600)
-def get_plan_run(session_id: str) -> PlanRun:
-    data = redis.get(f"plan_run:{session_id}")
-    return pickle.loads(data) if data else None
+class HSLookupRequest(BaseModel):
+    descriptions: list[str] = Field(..., min_length=1, max_length=10000)
+    top_k: int = Field(3, ge=1, le=20)
+class ScreeningRequest(BaseModel):
+    names: list[str] = Field(..., min_length=1, max_length=50000)
+    threshold: float = Field(DEFAULT_MATCH_THRESHOLD, ge=0.5, le=1.0)
+    max_matches: int = Field(5, ge=1, le=50)
 
 # --- Authentication Endpoints ---
 @app.post("/signup")
-def signup(user: UserCreate, db: Session = Depends(get_db)):
-    db_user = db.query(User).filter(User.username == user.username).first()
-    if db_user:
+async def signup(user: UserCreate, db: AsyncSession = Depends(get_async_db)):
+    result = await db.execute(select(User).where(User.username == user.username))
+    if result.scalar_one_or_none():
         raise HTTPException(status_code=400, detail="Username already registered")
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await get_password_hash_async(user.password)
     db_user = User(username=user.username, hashed_password=hashed_password)
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await principal_cache.invalidate(user.username)
     return {"message": "User created successfully"}
 
 @app.post("/token")
-def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.username == form_data.username).first()
-    if not user or not verify_password(form_data.password, user.hashed_password):
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
+    result = await db.execute(select(User).where(User.username == form_data.username))
+    user = result.scalar_one_or_none()
+    if not user or not await verify_password_async(form_data.password, user.hashed_password):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect username or password")
     access_token = create_access_token(data={"sub": user.username})
     return {"access_token": access_token, "token_type": "bearer"}
 
 # --- Core Application Endpoints (Protected) ---
+async def _with_idempotency(endpoint: str, request: ChatRequest, current_user: Principal, idempotency_key: Optional[str], response: Response, handler) -> dict:
+    """Runs `handler` at most once per user and Idempotency-Key; retries get the first response back."""
+    if not idempotency_key:
+        return await handler(request, current_user)
+    result, replayed = await run_idempotent(
+        str(current_user.id), idempotency_key, request_fingerprint(endpoint, request.model_dump()), lambda: handler(request, current_user)
+    )
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
 @app.post("/chat")
-def chat(request: ChatRequest, current_user: User = Depends(get_current_user)):
+async def chat(request: ChatRequest, response: Response, idempotency_key: Optional[str] = Header(None), current_user: Principal = Depends(get_current_user)):
+    return await _with_idempotency("/chat", request, current_user, idempotency_key, response, _chat)
+
+async def _chat(request: ChatRequest, current_user: Principal) -> dict:
     end_user_id = str(current_user.id)
-    
-    processed_query = agent.pre_process_query(request.user_message, request.session_id)
-    
-    if processed_query.get("status") == "clarification_needed":
-        return {"response_type": "clarification_input", "message": processed_query.get("clarification_question")}
-    
-    if processed_query.get("status") == "error":
-        raise HTTPException(status_code=500, detail="Failed to pre-process query.")
-
-    enriched_query = processed_query.get("enriched_query")
+    # The turn is charged against the user's LLM quota at its full cost in one go, so it
+    # is never rejected half-way; the plan-run share is refunded if no plan run starts
+    scheduler = get_llm_scheduler()
+    await scheduler.admit(end_user_id, cost=1 + PLAN_RUN_COST)
+    job_id = None
     try:
-        plan_run = agent.start_new_task(enriched_query, end_user_id)
-        store_plan_run(request.session_id, plan_run)
-        
-        if plan_run.state == PlanRunState.NEED_CLARIFICATION:
-            clarification = plan_run.get_outstanding_clarifications()[0]
-            if isinstance(clarification, ActionClarification):
-                return {"response_type": "clarification_action", "message": clarification.user_guidance, "action_url": clarification.action_url}
-            else:
-                return {"response_type": "clarification_input", "message": clarification.user_guidance}
-        elif plan_run.state == PlanRunState.DONE:
-            return {"response_type": "success", "message": "Task completed instantly!", "result": plan_run.output}
-        else:
-            return {"response_type": "pending", "message": "Task is in progress..."}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        processed_query = await get_agent().pre_process_query(request.user_message, request.session_id)
+
+        if processed_query.get("status") == "clarification_needed":
+            return {"response_type": "clarification_input", "message": processed_query.get("clarification_question")}
+
+        if processed_query.get("status") == "error":
+            raise HTTPException(status_code=500, detail="Failed to pre-process query.")
+
+        # Plan generation and execution happen on the worker tier; poll /jobs/{job_id}
+        # or subscribe to /jobs/{job_id}/events for the outcome.
+        enriched_query = processed_query.get("enriched_query")
+        job_id = await enqueue_job("start", request.session_id, end_user_id, {"enriched_query": enriched_query})
+        return {"response_type": "job_queued", "message": "Task queued...", "job_id": job_id}
+    finally:
+        if job_id is None:
+            await scheduler.refund(end_user_id, PLAN_RUN_COST)
+
+async def _complete_parked_action(session_id: str, current_user: Principal):
+    """Wakes the session's plan run if it is parked on an action; returns None if it is not."""
+    parked = await get_parked_job(session_id)
+    if parked is None or "job_id" not in parked or parked.get("user_id") != str(current_user.id):
+        return None
+    await mark_action_completed(session_id)
+    return {"response_type": "job_queued", "message": "Resuming task...", "job_id": parked["job_id"]}
+
+@app.post("/action_complete")
+async def action_complete(request: ActionCompleteRequest, current_user: Principal = Depends(get_current_user)):
+    """Completion callback for an action clarification (e.g. Xero OAuth): resumes the parked plan run on a worker."""
+    response = await _complete_parked_action(request.session_id, current_user)
+    if response is None:
+        raise HTTPException(status_code=404, detail="No plan run is waiting on an action for this session.")
+    return response
 
 @app.post("/resume_flow")
-def resume_flow(request: ChatRequest, current_user: User = Depends(get_current_user)):
-    plan_run = get_plan_run(request.session_id)
-    if not plan_run:
+async def resume_flow(request: ChatRequest, response: Response, idempotency_key: Optional[str] = Header(None), current_user: Principal = Depends(get_current_user)):
+    return await _with_idempotency("/resume_flow", request, current_user, idempotency_key, response, _resume_flow)
+
+async def _resume_flow(request: ChatRequest, current_user: Principal) -> dict:
+    # A run parked on an action resumes through its pre-created job
+    parked_response = await _complete_parked_action(request.session_id, current_user)
+    if parked_response is not None:
+        return parked_response
+    if not await plan_run_exists(request.session_id):
         raise HTTPException(status_code=404, detail="No active plan found for this session.")
-    
+
+    # Only a new resume counts against the user's quota; parked runs were charged when queued
+    await get_llm_scheduler().admit(str(current_user.id), cost=PLAN_RUN_COST)
+    job_id = await enqueue_job("resume", request.session_id, str(current_user.id), {"user_message": request.user_message})
+    return {"response_type": "job_queued", "message": "Resuming task...", "job_id": job_id}
+
+async def _get_owned_job(job_id: str, current_user: Principal) -> dict:
+    job = await get_job(job_id)
+    if job is None or job["user_id"] != str(current_user.id):
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str, current_user: Principal = Depends(get_current_user)):
+    job = await _get_owned_job(job_id, current_user)
+    return {key: job[key] for key in ("job_id", "kind", "status", "response", "error", "created_at", "updated_at")}
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, last_event_id: str = Header("0-0"), current_user: Principal = Depends(get_current_user)):
+    """Server-sent events stream of the job's step transitions, ending with its outcome."""
+    await _get_owned_job(job_id, current_user)
+    return StreamingResponse(
+        stream_job_events(job_id, last_event_id=last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# --- Compliance Lookups (Protected) ---
+@app.post("/hs/lookup")
+async def hs_lookup(request: HSLookupRequest, current_user: Principal = Depends(get_current_user)):
+    """Classifies a batch of product descriptions against the local HS code index."""
+    results = await run_in_threadpool(get_hs_index().lookup, request.descriptions, request.top_k)
+    return {"results": [{"description": d, "candidates": c} for d, c in zip(request.descriptions, results)]}
+
+@app.post("/screen/batch")
+async def screen_batch(request: ScreeningRequest, current_user: Principal = Depends(get_current_user)):
+    """Screens a batch of names against the loaded sanctions watchlists."""
+    screener = get_sanctions_screener()
+    if not screener.has_lists():
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="No sanctions watchlists are loaded.")
+    index = await run_in_threadpool(screener.get_index)
+    results = await run_in_threadpool(index.screen_batch, request.names, request.threshold, request.max_matches)
+    return {"threshold": request.threshold, "hits": sum(result["is_hit"] for result in results), "results": results}
+
+@app.post("/landed_cost/batch")
+async def landed_cost_batch(request: Request, input_format: str = "csv", output: str = "csv", report_currency: str = "USD", current_user: Principal = Depends(get_current_user)):
+    """
+    Prices a shipment manifest (CSV or Parquet request body with hs_code, origin, destination,
+    value and currency columns) and streams duty, tax and landed cost back chunk by chunk.
+    """
+    if input_format not in ("csv", "parquet") or output not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="input_format must be csv or parquet; output must be csv or ndjson.")
+
+    # Spool the body to disk as it arrives so large manifests never sit in memory
+    upload = tempfile.NamedTemporaryFile(suffix=f".{input_format}", delete=False)
+    # Once the generator has started, its `finally` removes the file; until then, we do
+    generator_started = False
+
+    def priced_chunks():
+        nonlocal generator_started
+        generator_started = True
+        try:
+            with open(upload.name, "rb") as f:
+                yield from price_shipment_file(tables, f, input_format, report_currency, output)
+        finally:
+            os.unlink(upload.name)
+
     try:
-        while plan_run.state == PlanRunState.NEED_CLARIFICATION:
-            clarification = plan_run.get_outstanding_clarifications()[0]
-            if isinstance(clarification, ActionClarification):
-                plan_run = portia_sdk.wait_for_ready(plan_run)
-            else:
-                plan_run = portia_sdk.resolve_clarification(clarification, request.user_message, plan_run)
-            
-        if plan_run.state != PlanRunState.DONE:
-            plan_run = portia_sdk.resume(plan_run)
-
-        store_plan_run(request.session_id, plan_run)
-
-        if plan_run.state == PlanRunState.DONE:
-            return {"response_type": "success", "message": "Task completed!", "result": plan_run.output}
-        elif plan_run.state == PlanRunState.NEED_CLARIFICATION:
-            new_clarification = plan_run.get_outstanding_clarifications()[0]
-            return {"response_type": "clarification_input", "message": new_clarification.user_guidance}
-        else:
-            return {"response_type": "pending", "message": "Task is still in progress..."}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        try:
+            async for chunk in request.stream():
+                upload.write(chunk)
+        finally:
+            upload.close()
+
+        tables = await run_in_threadpool(get_tariff_tables, get_redis_client())
+        results = priced_chunks()
+        try:
+            # Price the first chunk up front so bad input is a 400, not a truncated stream
+            first_chunk = await run_in_threadpool(next, results, "")
+        except Exception as e:
+            results.close()
+            raise HTTPException(status_code=400, detail=f"Could not price shipment file: {e}")
+    except BaseException:
+        # Client disconnect mid-upload, table load failure or cancellation before pricing began
+        if not generator_started:
+            os.unlink(upload.name)
+        raise
+
+    def stream():
+        yield first_chunk
+        yield from results
+
+    media_type = "application/x-ndjson" if output == "ndjson" else "text/csv"
+    return StreamingResponse(stream(), media_type=media_type)
 
 # --- STARTUP EVENT (for pre-defined plans, if you choose that route) ---
+async def _create_schema():
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+async def warm_up():
+    """Initializes every dependency in timed stages, retrying failed ones, then marks the instance ready."""
+    await startup_state.run_stage("database", _create_schema)
+    await startup_state.run_stage("redis", redis.ping)
+    await startup_state.run_stage("password_pool", start_password_pool)
+    await startup_state.run_stage("agent", lambda: run_in_threadpool(get_agent))
+    await startup_state.run_stage("hs_index", lambda: run_in_threadpool(get_hs_index))
+    await startup_state.run_stage("tariff_tables", lambda: run_in_threadpool(get_tariff_tables, get_redis_client()))
+    screener = get_sanctions_screener()
+    if screener.has_lists():
+        await startup_state.run_stage("sanctions_index", lambda: run_in_threadpool(screener.get_index))
+    startup_state.mark_ready()
+
 @app.on_event("startup")
 async def startup_event():
     """This function runs once when the application starts."""
-    # If you create a `backend/plan_registrar.py`, you can uncomment this line
-    # to have your application automatically register its core workflows on startup.
-    # register_all_plans(agent.portia_client)
+    # Plan templates are registered by the workers (backend/plan_registrar.py), which
+    # run the plans; the API tier never builds a Portia client.
+    configure_tracing("compliance-ai-backend")
+    app.state.warm_up_task = asyncio.create_task(warm_up())
     print("Application startup complete.")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Releases the password-hashing pool and the async database and Redis pools."""
+    shutdown_password_pool()
+    await async_engine.dispose()
+    await redis.aclose()
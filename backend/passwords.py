@@ -0,0 +1,45 @@
+import os
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from passlib.context import CryptContext
+
+# bcrypt is deliberately slow and holds the GIL, so hashing runs in a small dedicated
+# process pool. A burst of logins then queues there instead of stalling the event loop
+# or the request threadpool. Pool processes come from a forkserver that has imported
+# only this module, never a fork of the running server with its event loop, threads
+# and connection pools. Kept free of app imports so they start light.
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+_pool = None
+
+def verify_password(plain_password, hashed_password):
+    return pwd_context.verify(plain_password, hashed_password)
+
+def get_password_hash(password):
+    return pwd_context.hash(password)
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload([__name__])
+        _pool = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, mp_context=context)
+    return _pool
+
+async def start_password_pool():
+    """Creates the pool and starts its first process, so the first login does not pay for it."""
+    await asyncio.get_running_loop().run_in_executor(_get_pool(), os.getpid)
+
+async def verify_password_async(plain_password, hashed_password) -> bool:
+    return await asyncio.get_running_loop().run_in_executor(_get_pool(), verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password) -> str:
+    return await asyncio.get_running_loop().run_in_executor(_get_pool(), get_password_hash, password)
+
+def shutdown_password_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
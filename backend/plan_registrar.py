@@ -0,0 +1,23 @@
+from portia_agent.plan_templates import PLAN_TEMPLATES, PLAN_TEMPLATES_ENABLED
+
+def register_all_plans(portia_client) -> dict:
+    """
+    Builds every plan template and saves it to Portia's plan storage, so template runs
+    reference one stored plan per template. Called once per worker process at startup;
+    a template that fails to register is planned by the LLM instead.
+    """
+    if not PLAN_TEMPLATES_ENABLED:
+        return {}
+    portia_sdk = portia_client.get_sdk()
+    for template in PLAN_TEMPLATES.values():
+        if template.name in portia_client.registered_plans:
+            continue
+        try:
+            plan = template.build()
+            portia_sdk.storage.save_plan(plan)
+        except Exception as e:
+            print(f"Plan registrar: could not register template '{template.name}': {e}")
+            continue
+        portia_client.registered_plans[template.name] = plan
+        print(f"Plan registrar: registered template '{template.name}' as plan {plan.id}")
+    return portia_client.registered_plans
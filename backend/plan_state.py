@@ -0,0 +1,160 @@
+import hashlib
+import threading
+from contextlib import contextmanager
+from typing import Optional
+import msgpack
+import zstandard
+from portia import ActionClarification, PlanRun, PlanRunState
+from redis.exceptions import LockError, RedisError
+from backend.redis_client import get_redis_client, get_async_redis_client
+
+# Plan runs are shared between the API tier (which reads them) and the worker tier
+# (which creates and advances them), so both sides go through these helpers.
+#
+# Each plan run is stored as a Redis hash, `plan_state:{session_id}`, built from its
+# pydantic JSON model rather than a pickle, so any worker version can read it:
+#   v          schema version
+#   core       the plan run without its step outputs
+#   out:{name} one field per step output
+#   digests    digest and size of every field, so a store only rewrites changed fields
+# Field values are msgpack, zstd-compressed above a small size threshold.
+PLAN_RUN_TTL_SECONDS = 3600
+SCHEMA_VERSION = 1
+COMPRESSION_THRESHOLD_BYTES = 256
+# Sorted set of per-session payload sizes in bytes, keeping the largest sessions
+# (inspect with `ZREVRANGE plan_state:sizes 0 19 WITHSCORES`)
+PLAN_STATE_SIZES_KEY = "plan_state:sizes"
+PLAN_STATE_SIZES_KEPT = 1000
+# Plan runs of one session are serialized across workers so they never overwrite each
+# other. The lock is renewed while the run is in progress, so its timeout only bounds
+# how long a crashed worker blocks the session. A worker that cannot get the lock
+# quickly requeues the job with a backoff (see `requeue_busy_job`) rather than waiting
+# behind another run.
+PLAN_LOCK_TIMEOUT_SECONDS = 60
+PLAN_LOCK_WAIT_SECONDS = 1
+
+_RAW, _ZSTD = b"\x00", b"\x01"
+_VERSION_FIELD, _CORE_FIELD, _DIGESTS_FIELD, _OUTPUT_PREFIX = "v", "core", "digests", "out:"
+_codecs = threading.local()
+
+def _plan_run_key(session_id: str) -> str:
+    return f"plan_state:{session_id}"
+
+def _pack(value) -> bytes:
+    packed = msgpack.packb(value, use_bin_type=True)
+    if len(packed) < COMPRESSION_THRESHOLD_BYTES:
+        return _RAW + packed
+    # zstd contexts are not thread-safe, so each thread keeps its own
+    if not hasattr(_codecs, "compressor"):
+        _codecs.compressor = zstandard.ZstdCompressor(level=3)
+    return _ZSTD + _codecs.compressor.compress(packed)
+
+def _unpack(data: bytes):
+    if data[:1] == _ZSTD:
+        if not hasattr(_codecs, "decompressor"):
+            _codecs.decompressor = zstandard.ZstdDecompressor()
+        data = _codecs.decompressor.decompress(data[1:])
+    else:
+        data = data[1:]
+    return msgpack.unpackb(data, raw=False)
+
+def _encode_fields(plan_run: PlanRun) -> dict:
+    state = plan_run.model_dump(mode="json")
+    step_outputs = state["outputs"].pop("step_outputs", {}) or {}
+    fields = {_CORE_FIELD: _pack(state)}
+    fields.update({f"{_OUTPUT_PREFIX}{name}": _pack(output) for name, output in step_outputs.items()})
+    return fields
+
+def _decode_fields(raw: dict) -> Optional[PlanRun]:
+    fields = {(k.decode() if isinstance(k, bytes) else k): v for k, v in raw.items()}
+    if not fields or int(fields.get(_VERSION_FIELD, 0)) != SCHEMA_VERSION:
+        return None
+    state = _unpack(fields[_CORE_FIELD])
+    state["outputs"]["step_outputs"] = {
+        name[len(_OUTPUT_PREFIX):]: _unpack(value) for name, value in fields.items() if name.startswith(_OUTPUT_PREFIX)
+    }
+    return PlanRun.model_validate(state)
+
+def _diff_fields(fields: dict, previous_digests: Optional[bytes]):
+    """Returns (fields to write, fields to delete, new digests, total payload bytes)."""
+    previous = _unpack(previous_digests) if previous_digests else {}
+    digests = {name: [hashlib.blake2b(value, digest_size=8).hexdigest(), len(value)] for name, value in fields.items()}
+    changed = {name: value for name, value in fields.items() if previous.get(name, [None])[0] != digests[name][0]}
+    removed = [name for name in previous if name not in fields]
+    return changed, removed, digests, sum(size for _digest, size in digests.values())
+
+def _queue_store(pipe, session_id: str, changed: dict, removed: list, digests: dict, total_bytes: int):
+    key = _plan_run_key(session_id)
+    if removed:
+        pipe.hdel(key, *removed)
+    pipe.hset(key, mapping={**changed, _VERSION_FIELD: SCHEMA_VERSION, _DIGESTS_FIELD: _pack(digests)})
+    pipe.expire(key, PLAN_RUN_TTL_SECONDS)
+    pipe.zadd(PLAN_STATE_SIZES_KEY, {session_id: total_bytes})
+    pipe.zremrangebyrank(PLAN_STATE_SIZES_KEY, 0, -PLAN_STATE_SIZES_KEPT - 1)
+
+async def plan_run_exists(session_id: str) -> bool:
+    return bool(await get_async_redis_client().exists(_plan_run_key(session_id)))
+
+def store_plan_run_sync(session_id: str, plan_run: PlanRun) -> int:
+    redis = get_redis_client()
+    changed, removed, digests, total_bytes = _diff_fields(_encode_fields(plan_run), redis.hget(_plan_run_key(session_id), _DIGESTS_FIELD))
+    with redis.pipeline(transaction=True) as pipe:
+        _queue_store(pipe, session_id, changed, removed, digests, total_bytes)
+        pipe.execute()
+    return total_bytes
+
+def get_plan_run_sync(session_id: str) -> Optional[PlanRun]:
+    return _decode_fields(get_redis_client().hgetall(_plan_run_key(session_id)))
+
+class PlanRunBusy(Exception):
+    """Another worker is advancing this session's plan run."""
+
+@contextmanager
+def plan_run_lock(session_id: str):
+    """
+    Redis lock held by a worker for the whole load, run and store of a session's plan run.
+    Raises PlanRunBusy if the session stays locked for PLAN_LOCK_WAIT_SECONDS.
+    """
+    lock = get_redis_client().lock(
+        f"plan_lock:{session_id}", timeout=PLAN_LOCK_TIMEOUT_SECONDS, blocking_timeout=PLAN_LOCK_WAIT_SECONDS,
+        # Shared with the renewal thread
+        thread_local=False,
+    )
+    if not lock.acquire():
+        raise PlanRunBusy(session_id)
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(PLAN_LOCK_TIMEOUT_SECONDS / 3):
+            try:
+                lock.reacquire()
+            except LockError as e:
+                print(f"Plan state: lost the lock for session {session_id}: {e}")
+                return
+            except RedisError as e:
+                print(f"Plan state: could not renew the lock for session {session_id}: {e}")
+
+    thread = threading.Thread(target=renew, name=f"plan-lock-{session_id}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+        try:
+            lock.release()
+        except (LockError, RedisError) as e:
+            # The run itself finished; an expired lock must not turn it into a failure
+            print(f"Plan state: the lock for session {session_id} was no longer held on release: {e}")
+
+def plan_run_response(plan_run: PlanRun) -> dict:
+    """Translates a plan run's state into the response payload the frontend understands."""
+    if plan_run.state == PlanRunState.NEED_CLARIFICATION:
+        clarification = plan_run.get_outstanding_clarifications()[0]
+        if isinstance(clarification, ActionClarification):
+            return {"response_type": "clarification_action", "message": clarification.user_guidance, "action_url": clarification.action_url}
+        return {"response_type": "clarification_input", "message": clarification.user_guidance}
+    elif plan_run.state == PlanRunState.DONE:
+        return {"response_type": "success", "message": "Task completed!", "result": plan_run.output}
+    else:
+        return {"response_type": "pending", "message": "Task is still in progress..."}
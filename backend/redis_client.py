@@ -1,8 +1,14 @@
 import redis
+import redis.asyncio as aioredis
 import os
 
 redis_url = os.getenv("REDIS_URL")
 redis_client = redis.from_url(redis_url) 
+# Async client for the request path, so Redis round trips never block the event loop.
+async_redis_client = aioredis.from_url(redis_url)
 
 def get_redis_client():
     return redis_client
+
+def get_async_redis_client():
+    return async_redis_client
@@ -0,0 +1,56 @@
+import time
+import asyncio
+from contextlib import contextmanager
+from typing import Optional
+
+# --- Startup timing and readiness ---
+# The process starts serving (and answers /health) straight away. Slow initialization
+# runs as named warm-up stages, each timed, and /ready reports 503 until all of them have
+# finished. That lets the platform route traffic to a new instance only once it is usable.
+# A stage that fails (e.g. the database is not accepting connections yet at boot) is
+# retried with exponential backoff; /ready reports the latest failure meanwhile.
+STARTUP_RETRY_INITIAL_SECONDS = 1
+STARTUP_RETRY_MAX_SECONDS = 30
+
+class StartupState:
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.timings = {}
+        self.ready = False
+        self.error: Optional[str] = None
+
+    @contextmanager
+    def stage(self, name: str):
+        """Times one warm-up stage; its duration is reported by /ready and printed."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timings[name] = round(time.monotonic() - start, 3)
+            print(f"Startup: {name} took {self.timings[name]:.3f}s")
+
+    def mark_ready(self):
+        self.ready = True
+        self.timings["total"] = round(time.monotonic() - self.started_at, 3)
+        print(f"Startup: ready after {self.timings['total']:.3f}s")
+
+    async def run_stage(self, name: str, init):
+        """Awaits `init()` as a timed stage until it succeeds, backing off between failed attempts."""
+        delay = STARTUP_RETRY_INITIAL_SECONDS
+        attempt = 1
+        while True:
+            try:
+                with self.stage(name):
+                    await init()
+            except Exception as e:
+                self.error = f"{name} failed (attempt {attempt}): {type(e).__name__}: {e}"
+                print(f"Startup: {self.error}; retrying in {delay}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, STARTUP_RETRY_MAX_SECONDS)
+                attempt += 1
+                continue
+            self.error = None
+            return
+
+    def report(self) -> dict:
+        return {"status": "ready" if self.ready else ("retrying" if self.error else "starting"), "timings": self.timings, "error": self.error}
@@ -0,0 +1,91 @@
+import os
+import time
+from contextlib import ExitStack, contextmanager
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+
+# --- Stage timing and metrics ---
+# Every stage of a request or plan run is wrapped in `span(stage)`, which records its
+# latency in a Prometheus histogram. When OpenTelemetry is installed and
+# OTEL_TRACES_ENABLED is true, it also opens a trace span. Stages:
+#   auth, history_read, history_write, preprocess_cache, llm_preprocess, llm_summarize,
+#   portia_plan, portia_run_plan, portia_resume, store_plan_run
+# Tool calls, LLM token counts, plan sources, plan-state sizes and queue waits have their own metrics.
+# With several processes per instance (uvicorn --workers, WORKER_CONCURRENCY > 1), set
+# PROMETHEUS_MULTIPROC_DIR so every process's samples are aggregated in one scrape.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+STAGE_LATENCY = Histogram("compliance_stage_duration_seconds", "Latency of each request and plan-run stage.", ["stage", "outcome"], buckets=LATENCY_BUCKETS)
+HTTP_LATENCY = Histogram("compliance_http_request_duration_seconds", "HTTP request latency by route.", ["method", "route", "status"], buckets=LATENCY_BUCKETS)
+LLM_TOKENS = Counter("compliance_llm_tokens_total", "Tokens sent to and received from the LLM.", ["stage", "direction"])
+TOOL_LATENCY = Histogram("compliance_tool_call_duration_seconds", "Latency of each Portia tool call.", ["tool"], buckets=LATENCY_BUCKETS)
+PLAN_STATE_BYTES = Histogram("compliance_plan_state_bytes", "Stored size of a plan run.", buckets=(1e3, 4e3, 16e3, 64e3, 256e3, 1e6, 4e6))
+PLAN_SOURCES = Counter("compliance_plan_source_total", "Plans used for new plan runs, by source: template, cache or planner.", ["source"])
+JOB_QUEUE_WAIT = Histogram("compliance_job_queue_wait_seconds", "Time a plan-run job waits in the queue before a worker starts it.", buckets=LATENCY_BUCKETS)
+
+_tracer = None
+
+def configure_tracing(service_name: str):
+    """Sets up OpenTelemetry tracing (OTLP exporter) when it is enabled and installed."""
+    global _tracer
+    if os.getenv("OTEL_TRACES_ENABLED", "false").lower() != "true":
+        return
+    try:
+        from opentelemetry import trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    except ImportError:
+        print("Telemetry: OTEL_TRACES_ENABLED is set but the OpenTelemetry SDK is not installed; traces are disabled.")
+        return
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    _tracer = trace.get_tracer("global-trade-compliance-ai")
+
+@contextmanager
+def span(stage: str, **attributes):
+    """
+    Times a stage. Yields a dict that the caller can add attributes to (e.g. sizes or
+    cache hits); they are attached to the trace span.
+    """
+    attributes = dict(attributes)
+    outcome = "ok"
+    start = time.perf_counter()
+    with ExitStack() as stack:
+        # Entered as the current span, so stages opened inside it become its children.
+        # Tool calls are not spans; they are timed by TOOL_LATENCY from the worker's tool hooks.
+        trace_span = stack.enter_context(_tracer.start_as_current_span(stage)) if _tracer is not None else None
+        try:
+            yield attributes
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            STAGE_LATENCY.labels(stage=stage, outcome=outcome).observe(time.perf_counter() - start)
+            if trace_span is not None:
+                for key, value in attributes.items():
+                    trace_span.set_attribute(key, value if isinstance(value, (str, bool, int, float)) else str(value))
+
+def record_llm_usage(stage: str, response):
+    """Counts prompt and completion tokens from a Gemini response's usage metadata."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return {}
+    prompt_tokens = getattr(usage, "prompt_token_count", 0) or 0
+    completion_tokens = getattr(usage, "candidates_token_count", 0) or 0
+    LLM_TOKENS.labels(stage=stage, direction="prompt").inc(prompt_tokens)
+    LLM_TOKENS.labels(stage=stage, direction="completion").inc(completion_tokens)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+
+def metrics_registry():
+    """The registry to expose: aggregated across processes in multiprocess mode."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+def render_metrics() -> tuple[bytes, str]:
+    return generate_latest(metrics_registry()), CONTENT_TYPE_LATEST
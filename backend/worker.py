@@ -0,0 +1,173 @@
+import os
+import time
+import traceback
+import threading
+import multiprocessing
+from contextvars import ContextVar
+from dotenv import load_dotenv
+from portia.execution_hooks import ExecutionHooks, BeforeStepExecutionOutcome
+
+from portia_agent.agent import PortiaAIAgent
+from backend.jobs import claim_next_job, load_job, mark_job_running, publish_job_event, finish_job, park_job, listen_for_ready_plans, job_lease, run_job_reaper, requeue_busy_job
+from backend.plan_state import get_plan_run_sync, store_plan_run_sync, plan_run_response, plan_run_lock, PlanRunBusy
+from backend.redis_client import get_redis_client
+from backend.plan_registrar import register_all_plans
+from portia_agent.landed_cost import refresh_xero_tax_rates
+from portia_agent.mcp_gateway import start_xero_mcp_gateway, stop_xero_mcp_gateway
+from backend.telemetry import span, configure_tracing, metrics_registry, TOOL_LATENCY, PLAN_STATE_BYTES, JOB_QUEUE_WAIT
+from prometheus_client import start_http_server
+
+# --- Plan-run worker ---
+# Run with `python -m backend.worker`. Each worker process claims jobs from the Redis
+# queue one at a time, so the agent-execution tier scales independently of the API.
+load_dotenv()
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "2"))
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "0"))
+XERO_MCP_GATEWAY_ENABLED = os.getenv("XERO_MCP_GATEWAY_ENABLED", "true").lower() == "true"
+
+# The job currently executing in this process, read by the execution hooks below.
+current_job_id: ContextVar[str] = ContextVar("current_job_id", default=None)
+# Start time of the tool call in progress in this process, for the tool latency histogram
+current_tool_call_started: ContextVar[float] = ContextVar("current_tool_call_started", default=None)
+
+def _output_summary(output):
+    summary = getattr(output, "summary", None)
+    return summary if summary is not None else str(getattr(output, "value", output))[:500]
+
+def _before_step(plan, plan_run, step):
+    job_id = current_job_id.get()
+    if job_id:
+        publish_job_event(job_id, "step_started", {"step_index": plan_run.current_step_index, "task": step.task})
+    return BeforeStepExecutionOutcome.CONTINUE
+
+def _after_step(plan, plan_run, step, output):
+    job_id = current_job_id.get()
+    if job_id:
+        publish_job_event(job_id, "step_completed", {"step_index": plan_run.current_step_index, "task": step.task, "output": _output_summary(output)})
+
+def _before_tool_call(tool, *_):
+    current_tool_call_started.set(time.perf_counter())
+    return None
+
+def _after_tool_call(tool, *_):
+    started = current_tool_call_started.get()
+    if started is not None:
+        TOOL_LATENCY.labels(tool=tool.id).observe(time.perf_counter() - started)
+    return None
+
+def build_agent() -> PortiaAIAgent:
+    return PortiaAIAgent(
+        portia_api_key=os.getenv("PORTIA_API_KEY"),
+        google_api_key=os.getenv("GOOGLE_API_KEY"),
+        xero_client_id=os.getenv("XERO_CLIENT_ID"),
+        xero_client_secret=os.getenv("XERO_CLIENT_SECRET"),
+        execution_hooks=ExecutionHooks(
+            before_step_execution=_before_step,
+            after_step_execution=_after_step,
+            before_tool_call=_before_tool_call,
+            after_tool_call=_after_tool_call,
+        ),
+    )
+
+def _run_job(agent: PortiaAIAgent, job_id: str, job: dict) -> dict:
+    """Advances the session's plan run, stores it and returns the response for the job."""
+    payload = job["payload"]
+    if job["kind"] == "start":
+        plan_run = agent.start_new_task(payload["enriched_query"], job["user_id"])
+    elif job["kind"] == "resume":
+        plan_run = get_plan_run_sync(job["session_id"])
+        if plan_run is None:
+            raise ValueError("No active plan found for this session.")
+        plan_run = agent.resume_task(plan_run, payload["user_message"])
+    else:
+        raise ValueError(f"Unknown job kind: {job['kind']}")
+
+    with span("store_plan_run") as attributes:
+        payload_bytes = store_plan_run_sync(job["session_id"], plan_run)
+        attributes["payload_bytes"] = payload_bytes
+    PLAN_STATE_BYTES.observe(payload_bytes)
+    print(f"Worker {os.getpid()}: stored plan run for session {job['session_id']} ({payload_bytes} bytes)")
+    response = plan_run_response(plan_run)
+    if response["response_type"] == "clarification_action":
+        # Park rather than wait: no worker is held while the user completes the action,
+        # and the resume job is queued when the completion is published
+        response["resume_job_id"] = park_job("resume", job["session_id"], job["user_id"], {"user_message": ""})
+    if response["response_type"].startswith("clarification"):
+        publish_job_event(job_id, "clarification_needed", response)
+    return response
+
+def process_job(agent: PortiaAIAgent, job_id: str):
+    """Runs a single `start` or `resume` job and records its outcome."""
+    job = load_job(job_id)
+    if job is None:
+        # The job hash expired before a worker got to it
+        finish_job(job_id, error="Job expired before it could run.")
+        return
+
+    token = current_job_id.set(job_id)
+    try:
+        with job_lease(job_id):
+            try:
+                with plan_run_lock(job["session_id"]):
+                    JOB_QUEUE_WAIT.observe(max(0.0, time.time() - job["updated_at"]))
+                    mark_job_running(job_id)
+                    response = _run_job(agent, job_id, job)
+                finish_job(job_id, response=response)
+            except PlanRunBusy:
+                # Another worker is advancing this session; try again later, backing off
+                delay = requeue_busy_job(job_id)
+                print(f"Worker {os.getpid()}: session {job['session_id']} is busy, retrying job {job_id} in {delay:.0f}s")
+            except Exception as e:
+                traceback.print_exc()
+                finish_job(job_id, error=str(e))
+    finally:
+        current_job_id.reset(token)
+
+def run_worker():
+    """Claims and processes jobs until the process is terminated."""
+    started = time.monotonic()
+    configure_tracing("compliance-ai-worker")
+    agent = build_agent()
+    # Build the Portia client (tool registry and MCP connection) and register the plan
+    # templates before claiming work, so the first job does not pay for it
+    agent.portia_sdk
+    register_all_plans(agent.portia_client)
+    print(f"Worker {os.getpid()}: ready in {time.monotonic() - started:.3f}s, waiting for jobs...")
+    while True:
+        job_id = claim_next_job()
+        if job_id:
+            print(f"Worker {os.getpid()}: processing job {job_id}")
+            process_job(agent, job_id)
+        else:
+            # Idle: keep the landed-cost tax table in sync with Xero (one worker per interval)
+            refresh_xero_tax_rates(agent.portia_sdk, get_redis_client())
+
+def main():
+    if WORKER_METRICS_PORT:
+        if WORKER_CONCURRENCY > 1 and not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+            print("Worker: set PROMETHEUS_MULTIPROC_DIR to include the worker processes' samples in /metrics.")
+        start_http_server(WORKER_METRICS_PORT, registry=metrics_registry())
+    # One long-lived Xero MCP server per instance, shared by every worker process
+    if XERO_MCP_GATEWAY_ENABLED and not os.getenv("XERO_MCP_URL"):
+        started = time.monotonic()
+        url = start_xero_mcp_gateway(os.getenv("XERO_CLIENT_ID"), os.getenv("XERO_CLIENT_SECRET"))
+        if url:
+            os.environ["XERO_MCP_URL"] = url
+            print(f"Worker: Xero MCP gateway up at {url} in {time.monotonic() - started:.3f}s")
+    threading.Thread(target=listen_for_ready_plans, name="plan-ready-listener", daemon=True).start()
+    # Recovers jobs of crashed workers on its own timer, so it runs however busy the workers are
+    threading.Thread(target=run_job_reaper, name="job-reaper", daemon=True).start()
+    try:
+        if WORKER_CONCURRENCY <= 1:
+            run_worker()
+            return
+        processes = [multiprocessing.Process(target=run_worker, daemon=True) for _ in range(WORKER_CONCURRENCY)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    finally:
+        stop_xero_mcp_gateway()
+
+if __name__ == "__main__":
+    main()
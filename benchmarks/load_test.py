@@ -0,0 +1,400 @@
+"""
+Offline load test of the backend: boots `backend.main:app` in-process against local
+stand-ins and drives a mix of /token, /chat and /resume_flow traffic through it.
+
+Stand-ins:
+  - Redis: fakeredis, shared by the API and the in-process workers
+  - Postgres: SQLite through aiosqlite
+  - Gemini: a fake model with a configurable latency distribution
+  - Portia: a fake SDK whose plan, run and resume steps have their own latencies, and
+    which calls a stub Xero tool through the real MCP read-through cache
+The real request path is exercised end to end: auth, principal cache, pre-processing
+and chat history, idempotency, the job queue, worker processing and plan-state storage.
+
+Run from the repository root (needs backend/requirements.txt and benchmarks/requirements.txt):
+    python -m benchmarks.load_test --concurrency 16 --duration 30
+    python -m benchmarks.load_test --mix token=1,chat=6,resume=3 --llm-latency lognormal:0.4,0.5
+
+As a regression gate, record a baseline once and compare later runs against it. The run
+exits non-zero if throughput drops, p95 latency grows by more than --tolerance, or any
+request fails. The peak Python heap is measured in a separate, untimed phase of
+--heap-duration seconds, since tracemalloc slows every allocation:
+    python -m benchmarks.load_test --write-baseline benchmarks/baseline.json
+    python -m benchmarks.load_test --baseline benchmarks/baseline.json --tolerance 0.2
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import resource
+from types import SimpleNamespace
+
+
+# --- Latency distributions ---
+def parse_latency(spec: str):
+    """`fixed:S`, `uniform:LO,HI` or `lognormal:MEDIAN,SIGMA`, all in seconds."""
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",") if v]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "lognormal":
+        import math
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    raise argparse.ArgumentTypeError(f"Unknown latency distribution: {spec}")
+
+
+def parse_mix(spec: str) -> dict:
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ("token", "chat", "resume"):
+            raise argparse.ArgumentTypeError(f"Unknown operation in mix: {name}")
+        mix[name] = float(weight)
+    return mix
+
+
+# --- Environment ---
+def configure_environment(data_dir: str):
+    """Points the app at local stand-ins. Must run before any backend module is imported."""
+    os.environ.update({
+        "DATABASE_URL": f"sqlite+aiosqlite:///{os.path.join(data_dir, 'bench.db')}",
+        "REDIS_URL": "redis://localhost:6379/0",
+        "SECRET_KEY": "benchmark-secret",
+        "PORTIA_API_KEY": "benchmark",
+        "GOOGLE_API_KEY": "benchmark",
+        "XERO_CLIENT_ID": "benchmark",
+        "XERO_CLIENT_SECRET": "benchmark",
+        "SANCTIONS_LISTS_DIR": os.path.join(data_dir, "sanctions"),
+        "SANCTIONS_INDEX_DIR": os.path.join(data_dir, "sanctions_index"),
+        "PASSWORD_HASH_WORKERS": os.getenv("PASSWORD_HASH_WORKERS", "2"),
+        # The fakes have no rate limits; measure the app, not the LLM quotas
+        "LLM_USER_RPM": os.getenv("LLM_USER_RPM", "1000000"),
+        "LLM_USER_BURST": os.getenv("LLM_USER_BURST", "100000"),
+        "LLM_PROVIDER_RPM": os.getenv("LLM_PROVIDER_RPM", "1000000"),
+        "LLM_PROVIDER_BURST": os.getenv("LLM_PROVIDER_BURST", "100000"),
+    })
+    import fakeredis
+    import backend.redis_client as redis_client
+
+    server = fakeredis.FakeServer()
+    redis_client.redis_client = fakeredis.FakeRedis(server=server)
+    redis_client.async_redis_client = fakeredis.FakeAsyncRedis(server=server)
+
+
+# --- Fake Gemini ---
+class FakeLLM:
+    def __init__(self, latency, clarify_ratio: float):
+        self.latency = latency
+        self.clarify_ratio = clarify_ratio
+
+    async def generate_content_async(self, prompt: str):
+        await asyncio.sleep(self.latency())
+        if "Update the summary" in prompt:
+            text = "The user has been asking about HS codes, duties and invoices."
+        elif random.random() < self.clarify_ratio:
+            text = json.dumps({"status": "clarification_needed", "clarification_question": "Which country are you importing into?"})
+        else:
+            text = json.dumps({"status": "ready_for_execution", "enriched_query": "Find the HS code for wooden chairs into Germany and calculate duty on 150 EUR."})
+        usage = SimpleNamespace(prompt_token_count=len(prompt) // 4, candidates_token_count=len(text) // 4)
+        return SimpleNamespace(text=text, usage_metadata=usage)
+
+
+# --- Fake Portia and stub Xero tool ---
+def build_fake_portia(execution_hooks, plan_latency, run_latency, tool_latency, pause_ratio: float):
+    from pydantic import BaseModel
+    from portia import PlanRun, PlanRunState, Tool, ToolRegistry
+    from portia.plan_run import PlanRunOutputs
+    from portia.prefixed_uuid import PlanUUID
+    from portia.execution_agents.output import LocalDataValue
+    from portia_agent.mcp_cache import cached_tool_registry
+    from backend.redis_client import get_redis_client
+
+    class NoArgs(BaseModel):
+        pass
+
+    class StubXeroTaxRatesTool(Tool[str]):
+        id: str = "mcp:xero:list-tax-rates"
+        name: str = "List Tax Rates"
+        description: str = "Stand-in for the Xero MCP list-tax-rates tool."
+        args_schema: type[BaseModel] = NoArgs
+        output_schema: tuple[str, str] = ("str", "Tax rates as JSON.")
+
+        def run(self, _, **kwargs) -> str:
+            time.sleep(tool_latency())
+            return json.dumps({"TaxRates": [{"Name": "Import VAT", "EffectiveRate": 19.0}]})
+
+    [tax_rates_tool] = cached_tool_registry(ToolRegistry([StubXeroTaxRatesTool()]), get_redis_client(), tenant="benchmark").get_tools()
+    hooks = execution_hooks or SimpleNamespace()
+
+    def _run_step(plan, plan_run, step, tool=None):
+        if getattr(hooks, "before_step_execution", None):
+            hooks.before_step_execution(plan, plan_run, step)
+        output = None
+        if tool is not None:
+            if getattr(hooks, "before_tool_call", None):
+                hooks.before_tool_call(tool, {}, plan_run, step)
+            output = tool.run(None)
+            if getattr(hooks, "after_tool_call", None):
+                hooks.after_tool_call(tool, output, plan_run, step)
+        else:
+            time.sleep(run_latency())
+            output = f"Completed: {step.task}"
+        value = LocalDataValue(value=output, summary=str(output)[:100])
+        if getattr(hooks, "after_step_execution", None):
+            hooks.after_step_execution(plan, plan_run, step, value)
+        return value
+
+    class FakePortia:
+        def plan(self, query: str):
+            time.sleep(plan_latency())
+            return SimpleNamespace(id=PlanUUID(), query=query, steps=[
+                SimpleNamespace(task="Look up the import tax rate in Xero", tool=tax_rates_tool),
+                SimpleNamespace(task="Classify the product and calculate duty", tool=None),
+            ])
+
+        def run_plan(self, plan, end_user_id: str, plan_run_inputs=None):
+            plan_run = PlanRun(plan_id=plan.id, end_user_id=end_user_id, state=PlanRunState.IN_PROGRESS, outputs=PlanRunOutputs())
+            plan_run.outputs.step_outputs["$tax_rates"] = _run_step(plan, plan_run, plan.steps[0], plan.steps[0].tool)
+            if random.random() < pause_ratio:
+                # Left in progress, so the client follows up with /resume_flow
+                return plan_run
+            plan_run.current_step_index = 1
+            plan_run.outputs.final_output = _run_step(plan, plan_run, plan.steps[1])
+            plan_run.state = PlanRunState.DONE
+            return plan_run
+
+        def resume(self, plan_run):
+            step = SimpleNamespace(task="Classify the product and calculate duty", tool=None)
+            plan_run.current_step_index = 1
+            plan_run.outputs.final_output = _run_step(None, plan_run, step)
+            plan_run.state = PlanRunState.DONE
+            return plan_run
+
+    return FakePortia()
+
+
+def install_fakes(agent, args):
+    """Swaps the agent's Gemini model and Portia client for the stand-ins."""
+    agent.pre_processing_llm = FakeLLM(args.llm_latency, args.clarify_ratio)
+    execution_hooks = agent._portia_client_args[3]
+    sdk = build_fake_portia(execution_hooks, args.plan_latency, args.run_latency, args.tool_latency, args.pause_ratio)
+    # No plan templates or plan cache: every run pays for planning, as a worst case
+    agent._portia_client = SimpleNamespace(get_sdk=lambda: sdk, portia_sdk=sdk, registered_plans={}, plan_cache=None)
+    return agent
+
+
+# --- In-process workers ---
+def start_workers(count: int, args, stop: threading.Event):
+    from backend import worker
+    from backend.jobs import claim_next_job
+
+    def loop():
+        agent = install_fakes(worker.build_agent(), args)
+        while not stop.is_set():
+            job_id = claim_next_job(timeout=1)
+            if job_id:
+                worker.process_job(agent, job_id)
+
+    threads = [threading.Thread(target=loop, name=f"bench-worker-{i}", daemon=True) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+# --- Traffic ---
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, operation: str, seconds: float, ok: bool = True):
+        self.latencies.setdefault(operation, []).append(seconds)
+        if not ok:
+            self.errors[operation] = self.errors.get(operation, 0) + 1
+
+
+async def wait_for_job(client, headers, job_id: str, poll_seconds: float = 0.02) -> dict:
+    while True:
+        job = (await client.get(f"/jobs/{job_id}", headers=headers)).json()
+        if job["status"] in ("succeeded", "failed"):
+            return job
+        await asyncio.sleep(poll_seconds)
+
+
+async def virtual_user(client, user_index: int, password: str, mix: dict, deadline: float, recorder: Recorder, queries: list):
+    username = f"bench-user-{user_index}"
+    response = await client.post("/token", data={"username": username, "password": password})
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    session_id = f"bench-session-{user_index}"
+    paused = False
+    operations, weights = zip(*mix.items())
+
+    while time.monotonic() < deadline:
+        operation = random.choices(operations, weights)[0]
+        if operation == "resume" and not paused:
+            operation = "chat"
+        start = time.perf_counter()
+
+        if operation == "token":
+            response = await client.post("/token", data={"username": username, "password": password})
+            recorder.record("token", time.perf_counter() - start, response.status_code == 200)
+            continue
+
+        endpoint = "/chat" if operation == "chat" else "/resume_flow"
+        body = {"user_message": random.choice(queries) if operation == "chat" else "continue", "session_id": session_id}
+        response = await client.post(endpoint, json=body, headers={**headers, "Idempotency-Key": os.urandom(8).hex()})
+        recorder.record(operation, time.perf_counter() - start, response.status_code == 200)
+        if response.status_code != 200:
+            continue
+        data = response.json()
+        if data.get("response_type") != "job_queued":
+            continue
+        job = await wait_for_job(client, headers, data["job_id"])
+        ok = job["status"] == "succeeded"
+        recorder.record(f"{operation}_task", time.perf_counter() - start, ok)
+        paused = ok and (job["response"] or {}).get("response_type") == "pending"
+
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def summarize(recorder: Recorder, elapsed: float) -> dict:
+    results = {}
+    for operation, values in sorted(recorder.latencies.items()):
+        results[operation] = {
+            "count": len(values),
+            "errors": recorder.errors.get(operation, 0),
+            "throughput_per_s": round(len(values) / elapsed, 2),
+            "p50_ms": round(percentile(values, 0.50) * 1000, 1),
+            "p95_ms": round(percentile(values, 0.95) * 1000, 1),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 1),
+        }
+    return results
+
+
+def check_regression(results: dict, baseline: dict, tolerance: float) -> list:
+    failures = []
+    for operation, base in baseline["operations"].items():
+        current = results["operations"].get(operation)
+        if current is None:
+            failures.append(f"{operation}: missing from this run")
+            continue
+        if current["errors"]:
+            failures.append(f"{operation}: {current['errors']} failed requests")
+        if current["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            failures.append(f"{operation}: p95 {current['p95_ms']}ms vs baseline {base['p95_ms']}ms")
+        if current["throughput_per_s"] < base["throughput_per_s"] * (1 - tolerance):
+            failures.append(f"{operation}: throughput {current['throughput_per_s']}/s vs baseline {base['throughput_per_s']}/s")
+    if None not in (results.get("peak_python_heap_mb"), baseline.get("peak_python_heap_mb")) and results["peak_python_heap_mb"] > baseline["peak_python_heap_mb"] * (1 + tolerance):
+        failures.append(f"peak heap {results['peak_python_heap_mb']}MB vs baseline {baseline['peak_python_heap_mb']}MB")
+    return failures
+
+
+async def run(args) -> dict:
+    import httpx
+    from backend import main
+    from backend.passwords import shutdown_password_pool
+
+    install_fakes(main.get_agent(), args)
+    await main.warm_up()
+    if not main.startup_state.ready:
+        raise RuntimeError(f"Startup failed: {main.startup_state.error}")
+
+    from benchmarks.slot_extractor_benchmark import SAMPLE_QUERIES
+    queries = [query for query, _has_history in SAMPLE_QUERIES]
+    password = "benchmark-password"
+    stop = threading.Event()
+    start_workers(args.workers, args, stop)
+
+    transport = httpx.ASGITransport(app=main.app)
+    limits = httpx.Limits(max_connections=args.concurrency * 2)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", limits=limits, timeout=120) as client:
+        await asyncio.gather(*[client.post("/signup", json={"username": f"bench-user-{i}", "password": password}) for i in range(args.concurrency)])
+        recorder = Recorder()
+        started = time.monotonic()
+        deadline = started + args.duration
+        await asyncio.gather(*[virtual_user(client, i, password, args.mix, deadline, recorder, queries) for i in range(args.concurrency)])
+        elapsed = time.monotonic() - started
+
+        # Heap is traced in its own phase, whose timings are discarded, so tracemalloc's
+        # per-allocation overhead never reaches the numbers the regression gate compares
+        peak = None
+        if args.heap_duration > 0:
+            tracemalloc.start()
+            deadline = time.monotonic() + args.heap_duration
+            await asyncio.gather(*[virtual_user(client, i, password, args.mix, deadline, Recorder(), queries) for i in range(args.concurrency)])
+            _current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+    stop.set()
+    shutdown_password_pool()
+    await main.async_engine.dispose()
+    return {
+        "config": {"concurrency": args.concurrency, "duration_s": args.duration, "workers": args.workers, "mix": args.mix},
+        "elapsed_s": round(elapsed, 2),
+        "operations": summarize(recorder, elapsed),
+        "peak_python_heap_mb": round(peak / 2**20, 1) if peak is not None else None,
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def print_report(results: dict):
+    heap = f"{results['peak_python_heap_mb']} MB" if results["peak_python_heap_mb"] is not None else "not measured"
+    print(f"\nElapsed: {results['elapsed_s']}s  |  peak Python heap: {heap}  |  max RSS: {results['max_rss_mb']} MB")
+    print(f"{'operation':<14}{'count':>8}{'errors':>8}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for operation, stats in results["operations"].items():
+        print(f"{operation:<14}{stats['count']:>8}{stats['errors']:>8}{stats['throughput_per_s']:>9}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+    print("(chat/resume: time to the queued response; chat_task/resume_task: time until the job finished)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=16, help="Virtual users sending requests in parallel.")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds of traffic.")
+    parser.add_argument("--heap-duration", type=float, default=5, help="Seconds of extra, untimed traffic with heap tracing; 0 skips it.")
+    parser.add_argument("--workers", type=int, default=4, help="In-process plan-run workers.")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("token=1,chat=6,resume=3"), help="Relative weights of token, chat and resume.")
+    parser.add_argument("--llm-latency", type=parse_latency, default=parse_latency("lognormal:0.35,0.4"))
+    parser.add_argument("--plan-latency", type=parse_latency, default=parse_latency("lognormal:1.0,0.4"))
+    parser.add_argument("--run-latency", type=parse_latency, default=parse_latency("lognormal:0.5,0.5"))
+    parser.add_argument("--tool-latency", type=parse_latency, default=parse_latency("lognormal:0.3,0.3"))
+    parser.add_argument("--clarify-ratio", type=float, default=0.2, help="Share of LLM pre-processing answers that ask for clarification.")
+    parser.add_argument("--pause-ratio", type=float, default=0.3, help="Share of plan runs left in progress for a /resume_flow follow-up.")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json-out", help="Also write the results as JSON to this file.")
+    parser.add_argument("--write-baseline", help="Write the results as the regression baseline to this file.")
+    parser.add_argument("--baseline", help="Compare against this baseline and exit non-zero on a regression.")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative regression against the baseline.")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as data_dir:
+        configure_environment(data_dir)
+        results = asyncio.run(run(args))
+
+    print_report(results)
+    for path in (args.json_out, args.write_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures = check_regression(results, json.load(f), args.tolerance)
+        if failures:
+            print("\nREGRESSION:\n  " + "\n  ".join(failures))
+            sys.exit(1)
+        print("\nNo regression against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Measures how much pre-processing traffic the rule-based fast path resolves without Gemini.
+
+Run from the repository root:
+    python -m benchmarks.slot_extractor_benchmark [--verbose]
+"""
+import sys
+import time
+from collections import Counter
+
+from portia_agent.slot_extractor import fast_path_analysis
+
+# (query, has_history) pairs shaped like real /chat traffic
+SAMPLE_QUERIES = [
+    ("HS code for cotton t-shirts into Germany", False),
+    ("What is the HS code for cotton t-shirts?", False),
+    ("Find the HS code for wooden chairs for import into France", False),
+    ("hs code for frozen turkey into Japan", False),
+    ("Classify leather handbags for export to the United States", False),
+    ("HS code for stainless steel cutlery", False),
+    ("What's the duty on 1,500 EUR of wooden chairs to France?", False),
+    ("Calculate duty for importing $2000 worth of laptops into the UK", False),
+    ("Calculate import duty for ceramic tiles from China into Australia valued at 12000 AUD", False),
+    ("How much duty would I pay on bicycles?", False),
+    ("Calculate the landed cost for 500 USD of running shoes", False),
+    ("Duty on 300 GBP of wool sweaters into Canada", False),
+    ("Find the HS code and calculate duty for solar panels into DE worth 40000 EUR", False),
+    ("Create an invoice for Acme Trading for office chairs totaling 2500 USD", False),
+    ("Raise an invoice to customer Globex Ltd for 20 steel pipes at 1,200 EUR", False),
+    ("Create an invoice for Acme Trading", False),
+    ("Create an invoice for 500 EUR", False),
+    ("Show me my unpaid invoices", False),
+    ("Germany", True),
+    ("The value is 450 EUR", True),
+    ("Into Spain please", True),
+    ("HS code for olive oil into Italy", True),
+    ("Screen Rosneft against the sanctions lists", False),
+    ("What documents do I need to export wine to China?", False),
+    ("Compare duties for t-shirts into Germany and France", False),
+    ("Is there an anti-dumping duty on steel from Vietnam?", False),
+    ("HS code for organic coffee beans going to Canada", False),
+    ("Calculate duties on 10000 USD of electric scooters into the Netherlands", False),
+    ("yes, go ahead", True),
+    ("Create invoice for Initech for consulting services 3000 AUD", False),
+]
+
+
+def run(verbose: bool = False, rounds: int = 200):
+    outcomes = Counter()
+    for query, has_history in SAMPLE_QUERIES:
+        analysis = fast_path_analysis(query, has_history)
+        outcome = analysis["status"] if analysis else "fallback_to_llm"
+        outcomes[outcome] += 1
+        if verbose:
+            detail = (analysis or {}).get("enriched_query") or (analysis or {}).get("clarification_question") or ""
+            print(f"{outcome:<22} | {query}\n{'':<22} | -> {detail}")
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for query, has_history in SAMPLE_QUERIES:
+            fast_path_analysis(query, has_history)
+    per_query_us = (time.perf_counter() - start) / (rounds * len(SAMPLE_QUERIES)) * 1e6
+
+    total = len(SAMPLE_QUERIES)
+    resolved = total - outcomes["fallback_to_llm"]
+    print(f"\nQueries:                 {total}")
+    print(f"Resolved without Gemini: {resolved} ({resolved / total:.0%})")
+    for outcome, count in sorted(outcomes.items()):
+        print(f"  {outcome:<22} {count}")
+    print(f"Mean fast-path latency:  {per_query_us:.1f} µs/query")
+
+
+if __name__ == "__main__":
+    run(verbose="--verbose" in sys.argv)
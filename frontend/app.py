@@ -3,17 +3,38 @@ import requests
 import uuid
 import json
 import os
+import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # --- Page and Backend Configuration ---
 st.set_page_config(page_title="Global Trade & Compliance AI", layout="wide")
 BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:8000")
+JOB_POLL_INTERVAL_SECONDS = 1.0
+# Longest the chat waits on a queued task before giving up on it
+JOB_WAIT_TIMEOUT_SECONDS = float(os.getenv("JOB_WAIT_TIMEOUT_SECONDS", "600"))
+# Consecutive dropped event streams tolerated before falling back to polling
+JOB_STREAM_MAX_RECONNECTS = 5
+HISTORY_PAGE_SIZE = 20
+
+
+@st.cache_resource
+def get_http_session():
+    """One pooled, keep-alive HTTP session shared by every rerun and browser session."""
+    session = requests.Session()
+    # POSTs are retried too: chat requests carry an Idempotency-Key, so a retry never runs a task twice
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504), allowed_methods=frozenset({"GET", "POST"}))
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 
 # --- Authentication Functions ---
 def login(username, password):
     """Handles the login request to the backend."""
     try:
-        response = requests.post(f"{BACKEND_URL}/token", data={"username": username, "password": password})
+        response = get_http_session().post(f"{BACKEND_URL}/token", data={"username": username, "password": password})
         if response.status_code == 200:
             st.session_state.auth_token = response.json()['access_token']
             st.session_state.logged_in = True
@@ -28,7 +49,7 @@ def login(username, password):
 def signup(username, password):
     """Handles the signup request to the backend."""
     try:
-        response = requests.post(f"{BACKEND_URL}/signup", json={"username": username, "password": password})
+        response = get_http_session().post(f"{BACKEND_URL}/signup", json={"username": username, "password": password})
         if response.status_code == 200:
             st.success("Signup successful! Please log in.")
         else:
@@ -39,6 +60,106 @@ def signup(username, password):
         st.error(f"An unexpected error occurred during signup: {e}")
 
 
+def _job_timed_out(job_id):
+    return {"response_type": "error", "message": f"Error: The task is still running after {JOB_WAIT_TIMEOUT_SECONDS:.0f} seconds. Its result will not be shown here (job {job_id})."}
+
+
+def wait_for_job(job_id, headers, deadline=None):
+    """Polls the backend until a queued plan-run job finishes or the deadline passes, then returns its response."""
+    deadline = deadline or time.monotonic() + JOB_WAIT_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        try:
+            response = get_http_session().get(f"{BACKEND_URL}/jobs/{job_id}", headers=headers, timeout=(5, 30))
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            # The backend may be restarting; keep polling until the deadline
+            time.sleep(JOB_POLL_INTERVAL_SECONDS)
+            continue
+        response.raise_for_status()
+        job = response.json()
+        if job["status"] == "succeeded":
+            return job["response"]
+        if job["status"] == "failed":
+            return {"response_type": "error", "message": f"Error: {job.get('error') or 'The task failed.'}"}
+        time.sleep(JOB_POLL_INTERVAL_SECONDS)
+    return _job_timed_out(job_id)
+
+
+def _iter_sse(response):
+    """Yields (event id, event type, data) for each server-sent event in a streaming response."""
+    event_id, event_type, data = None, "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if line is None:
+            continue
+        if line == "":
+            if data:
+                yield event_id, event_type, json.loads("\n".join(data))
+            event_type, data = "message", []
+        elif line.startswith("id:"):
+            event_id = line[3:].strip()
+        elif line.startswith("event:"):
+            event_type = line[6:].strip()
+        elif line.startswith("data:"):
+            data.append(line[5:].strip())
+
+
+def stream_job(job_id, headers, progress):
+    """
+    Follows the job's event stream, rendering step progress into `progress` as it arrives,
+    and returns the job's response. Falls back to polling if the stream is unavailable.
+    """
+    steps = []
+    last_event_id = "0-0"
+    deadline = time.monotonic() + JOB_WAIT_TIMEOUT_SECONDS
+    reconnects = 0
+    while time.monotonic() < deadline:
+        try:
+            with get_http_session().get(
+                f"{BACKEND_URL}/jobs/{job_id}/events",
+                headers={**headers, "Last-Event-ID": last_event_id},
+                stream=True,
+                timeout=(5, 60),
+            ) as response:
+                response.raise_for_status()
+                for event_id, event_type, data in _iter_sse(response):
+                    last_event_id = event_id or last_event_id
+                    reconnects = 0
+                    if event_type == "job_succeeded":
+                        return data.get("response") or {}
+                    if event_type == "job_failed":
+                        return {"response_type": "error", "message": f"Error: {data.get('error') or 'The task failed.'}"}
+                    if event_type == "step_started":
+                        steps.append(f"⏳ {data.get('task')}")
+                    elif event_type == "step_completed" and steps:
+                        steps[-1] = f"✅ {data.get('task')}\n\n    {data.get('output')}"
+                    elif event_type == "job_parked":
+                        steps.append("⏸️ Waiting for the action to be completed...")
+                    progress.markdown("\n\n".join(steps) or "Task queued...")
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout):
+            # A read timeout mid-stream surfaces as ConnectionError. The server sends keep-alives, so
+            # a silent minute or a dropped stream means a broken connection: reconnect and replay
+            reconnects += 1
+            if reconnects > JOB_STREAM_MAX_RECONNECTS:
+                return wait_for_job(job_id, headers, deadline)
+            time.sleep(JOB_POLL_INTERVAL_SECONDS)
+            continue
+        except requests.exceptions.RequestException:
+            return wait_for_job(job_id, headers, deadline)
+    return _job_timed_out(job_id)
+
+
+def render_history():
+    """Renders only the latest page(s) of the conversation, so long chats stay fast."""
+    messages = st.session_state.messages
+    visible = HISTORY_PAGE_SIZE * st.session_state.history_pages
+    if len(messages) > visible:
+        if st.button(f"Show earlier messages ({len(messages) - visible} hidden)"):
+            st.session_state.history_pages += 1
+            st.experimental_rerun()
+    for message in messages[-visible:]:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"], unsafe_allow_html=True)
+
+
 # --- UI Views ---
 def show_login_page():
     """Displays the login and signup forms."""
@@ -77,31 +198,38 @@ def show_chat_page():
     if "messages" not in st.session_state: st.session_state.messages = []
     if "session_id" not in st.session_state: st.session_state.session_id = str(uuid.uuid4())
     if "flow_paused_for_action" not in st.session_state: st.session_state.flow_paused_for_action = False
+    if "history_pages" not in st.session_state: st.session_state.history_pages = 1
 
     # Display past messages
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"], unsafe_allow_html=True)
+    render_history()
 
     # Handle new user input
     if prompt := st.chat_input("Ask a compliance question or give a command..."):
         st.session_state.messages.append({"role": "user", "content": prompt})
         with st.chat_message("user"): st.markdown(prompt)
 
-        with st.spinner("Thinking..."):
-            endpoint = "/resume_flow" if st.session_state.flow_paused_for_action else "/chat"
-            st.session_state.flow_paused_for_action = False
-            
-            headers = {"Authorization": f"Bearer {st.session_state.auth_token}"}
+        endpoint = "/resume_flow" if st.session_state.flow_paused_for_action else "/chat"
+        st.session_state.flow_paused_for_action = False
+
+        headers = {"Authorization": f"Bearer {st.session_state.auth_token}"}
+        # One key per message, so a resent message never runs the task twice
+        idempotency_key = str(uuid.uuid4())
+        with st.chat_message("assistant"):
+            # Step progress streams into this placeholder and is replaced by the final answer
+            progress = st.empty()
             try:
-                response = requests.post(
-                    f"{BACKEND_URL}{endpoint}",
-                    json={"user_message": prompt, "session_id": st.session_state.session_id},
-                    headers=headers
-                )
-                response.raise_for_status()
-                data = response.json()
-                
+                with st.spinner("Thinking..."):
+                    response = get_http_session().post(
+                        f"{BACKEND_URL}{endpoint}",
+                        json={"user_message": prompt, "session_id": st.session_state.session_id},
+                        headers={**headers, "Idempotency-Key": idempotency_key}
+                    )
+                    response.raise_for_status()
+                    data = response.json()
+                if data.get("response_type") == "job_queued":
+                    progress.markdown("Task queued...")
+                    data = stream_job(data["job_id"], headers, progress)
+
                 assistant_message = ""
                 if data.get("response_type") == "clarification_action":
                     assistant_message = f"{data['message']}\n\nPlease complete the action at this URL, then return here and type 'ok' to continue:\n\n**[Click here to authorize]({data['action_url']})**"
@@ -113,14 +241,14 @@ def show_chat_page():
                     assistant_message = data.get('message', 'An unknown error occurred.')
 
                 st.session_state.messages.append({"role": "assistant", "content": assistant_message})
-                with st.chat_message("assistant"): st.markdown(assistant_message, unsafe_allow_html=True)
+                progress.markdown(assistant_message, unsafe_allow_html=True)
 
             except requests.exceptions.HTTPError as e:
                 error_detail = e.response.json().get("detail", "An unknown error occurred.")
-                st.error(f"An error occurred with the backend: {error_detail}")
+                progress.error(f"An error occurred with the backend: {error_detail}")
                 st.session_state.messages.append({"role": "assistant", "content": f"Error: {error_detail}"})
             except requests.exceptions.RequestException as e:
-                st.error(f"Could not connect to the backend: {e}")
+                progress.error(f"Could not connect to the backend: {e}")
                 st.session_state.messages.append({"role": "assistant", "content": "Error: Could not connect to the backend."})
 
 
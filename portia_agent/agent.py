@@ -1,46 +1,99 @@
 # portia-agent/agent.py
 import os
 import json
+import threading
 import google.generativeai as genai
-from portia import PlanRun
+from portia import ActionClarification, ExecutionHooks, PlanRun, PlanRunState
 from portia_agent.portia_client import PortiaClient
-from backend.redis_client import get_redis_client # For managing chat history
+from portia_agent.query_cache import PreprocessCache
+from portia_agent.slot_extractor import fast_path_analysis
+from portia_agent.chat_history import ChatHistory
+from portia_agent.llm_scheduler import LLMRateLimited, Priority, get_llm_scheduler
+from portia_agent.plan_templates import PLAN_TEMPLATES_ENABLED, plan_inputs, route_query
+from backend.redis_client import get_async_redis_client # For managing chat history
+from backend.telemetry import span, record_llm_usage, PLAN_SOURCES
 
 class PortiaAIAgent:
-    def __init__(self, portia_api_key: str, google_api_key: str, xero_client_id: str, xero_client_secret: str):
-        self.portia_client = PortiaClient(portia_api_key, xero_client_id, xero_client_secret)
-        self.portia_sdk = self.portia_client.get_sdk()
-        
+    def __init__(self, portia_api_key: str, google_api_key: str, xero_client_id: str, xero_client_secret: str, execution_hooks: ExecutionHooks = None):
+        # The Portia client (and with it the MCP connection) is only built on first use, so
+        # the API tier, which never executes plans, does not pay for it at all.
+        self._portia_client_args = (portia_api_key, xero_client_id, xero_client_secret, execution_hooks)
+        self._portia_client = None
+        self._portia_client_lock = threading.Lock()
+
         # Configure the Gemini LLM for the pre-processing step
         genai.configure(api_key=google_api_key)
         self.pre_processing_llm = genai.GenerativeModel('gemini-1.5-flash')
-        self.redis = get_redis_client()
-
-    def _get_chat_history(self, session_id: str):
-        """Retrieves chat history from Redis."""
-        key = f"chat_history:{session_id}"
-        # Use Redis's list capabilities for a proper chat log
-        history_raw = self.redis.lrange(key, 0, -1)
-        # Decode from bytes if necessary, then parse JSON
-        return [json.loads(item) for item in history_raw]
-
-    def _save_chat_history(self, session_id: str, user_query: str, assistant_response: str):
-        """Saves the latest turn of conversation to Redis."""
-        key = f"chat_history:{session_id}"
-        # Push user message
-        self.redis.rpush(key, json.dumps({"role": "user", "content": user_query}))
-        # Push assistant response
-        self.redis.rpush(key, json.dumps({"role": "assistant", "content": assistant_response}))
-        # Set an expiration time on the chat history
-        self.redis.expire(key, 3600) # Expire in 1 hour
-
-    def pre_process_query(self, user_query: str, session_id: str) -> dict:
+        self.redis = get_async_redis_client()
+        self.llm_scheduler = get_llm_scheduler()
+        self.preprocess_cache = PreprocessCache(
+            redis=self.redis,
+            max_entries=int(os.getenv("PREPROCESS_CACHE_MAX_ENTRIES", "1024")),
+            ttl_seconds=int(os.getenv("PREPROCESS_CACHE_TTL_SECONDS", "3600")),
+        )
+        self.rule_fast_path_enabled = os.getenv("RULE_FAST_PATH_ENABLED", "true").lower() == "true"
+        self.chat_history = ChatHistory(
+            self.redis,
+            max_messages=int(os.getenv("CHAT_HISTORY_MAX_MESSAGES", "20")),
+            window=4,
+            summarizer=self._summarize_history if os.getenv("CHAT_HISTORY_SUMMARIES", "true").lower() == "true" else None,
+        )
+
+    @property
+    def portia_client(self) -> PortiaClient:
+        if self._portia_client is None:
+            with self._portia_client_lock:
+                if self._portia_client is None:
+                    portia_api_key, xero_client_id, xero_client_secret, execution_hooks = self._portia_client_args
+                    self._portia_client = PortiaClient(portia_api_key, xero_client_id, xero_client_secret, execution_hooks=execution_hooks)
+        return self._portia_client
+
+    @property
+    def portia_sdk(self):
+        return self.portia_client.get_sdk()
+
+    async def _summarize_history(self, previous_summary: str, messages: list) -> str:
+        """Folds older conversation turns into the rolling summary kept alongside the history."""
+        prompt = f"""
+        Update the summary of a Global Trade Compliance assistant conversation. Keep the facts that
+        later requests may rely on (products, HS codes, countries, values and currencies, customers,
+        decisions made). Reply with the updated summary only, in at most 80 words.
+
+        CURRENT SUMMARY: {previous_summary or "(none)"}
+
+        NEW MESSAGES:
+        {json.dumps(messages)}
+        """
+        async with self.llm_scheduler.slot(Priority.BACKGROUND):
+            with span("llm_summarize") as attributes:
+                response = await self.pre_processing_llm.generate_content_async(prompt)
+                attributes.update(record_llm_usage("llm_summarize", response))
+        return response.text.strip()[:1000]
+
+    async def pre_process_query(self, user_query: str, session_id: str) -> dict:
         """
         Uses Gemini to act as a compliance expert. It checks if the query is complete
         enough to be executed, or if it needs clarification, considering chat history.
         """
-        chat_history = self._get_chat_history(session_id)
-        
+        with span("history_read"):
+            recent_history, history_summary = await self.chat_history.read(session_id)
+
+        # Queries the slot rules can decide on their own never reach Gemini
+        if self.rule_fast_path_enabled:
+            analysis = fast_path_analysis(user_query, has_history=bool(recent_history or history_summary))
+            if analysis is not None:
+                await self._record_turn(session_id, user_query, analysis)
+                return analysis
+
+        # Repeated questions in the same conversational context skip Gemini entirely
+        cache_key = PreprocessCache.make_key(user_query, [history_summary] + recent_history)
+        with span("preprocess_cache") as attributes:
+            cached_analysis = await self.preprocess_cache.get(cache_key)
+            attributes["hit"] = cached_analysis is not None
+        if cached_analysis is not None:
+            await self._record_turn(session_id, user_query, cached_analysis)
+            return cached_analysis
+
         prompt = f"""
         You are a world-class Global Trade Compliance expert. Your task is to analyze a user's request and determine if it contains all the necessary information to be sent to an execution engine. You must consider the previous conversation for context.
 
@@ -51,8 +104,11 @@ class PortiaAIAgent:
 
         Analyze the following user query in the context of our conversation history.
 
+        SUMMARY OF EARLIER CONVERSATION:
+        {history_summary or "(none)"}
+
         CONVERSATION HISTORY (last 4 messages):
-        {json.dumps(chat_history[-4:])}
+        {json.dumps(recent_history)}
 
         CURRENT USER QUERY: "{user_query}"
 
@@ -71,7 +127,10 @@ class PortiaAIAgent:
         }}
         """
         try:
-            response = self.pre_processing_llm.generate_content(prompt)
+            async with self.llm_scheduler.slot(Priority.INTERACTIVE):
+                with span("llm_preprocess") as attributes:
+                    response = await self.pre_processing_llm.generate_content_async(prompt)
+                    attributes.update(record_llm_usage("llm_preprocess", response))
             # Basic cleanup for the LLM response
             cleaned_response = response.text.strip()
             if cleaned_response.startswith("```json"):
@@ -80,25 +139,89 @@ class PortiaAIAgent:
                 cleaned_response = cleaned_response[:-3]
             
             analysis = json.loads(cleaned_response)
+            if analysis.get("status") in ("ready_for_execution", "clarification_needed"):
+                await self.preprocess_cache.set(cache_key, analysis)
 
             # Save conversation history after successful analysis
-            assistant_response = analysis.get("clarification_question", "Okay, I will process that.")
-            self._save_chat_history(session_id, user_query, assistant_response)
+            await self._record_turn(session_id, user_query, analysis)
 
             return analysis
 
+        except LLMRateLimited:
+            # Surfaced to the client as a 429 rather than a failed analysis
+            raise
         except Exception as e:
             print(f"Error during pre-processing: {e}")
             return {"status": "error", "error_message": "Failed to analyze query."}
 
+    async def _record_turn(self, session_id: str, user_query: str, analysis: dict):
+        assistant_response = analysis.get("clarification_question", "Okay, I will process that.")
+        with span("history_write"):
+            await self.chat_history.append_turn(session_id, user_query, assistant_response)
+
     def start_new_task(self, enriched_query: str, end_user_id: str) -> PlanRun:
         """
-        Generates and runs a plan using Portia's planner.
-        This is now only called with an enriched, validated query.
+        Runs a plan for an enriched, validated query: a registered template, a cached
+        plan, or one newly generated by Portia's planner.
         """
-        print(f"Agent: Generating plan for enriched query: '{enriched_query}'")
-        plan = self.portia_sdk.plan(enriched_query)
-        print(f"Agent: Plan generated. ID: {plan.id}. Starting run for user '{end_user_id}'...")
-        plan_run = self.portia_sdk.run_plan(plan, end_user_id=end_user_id)
+        plan, inputs, source = self._plan_for(enriched_query)
+        PLAN_SOURCES.labels(source=source).inc()
+        print(f"Agent: Using {source} plan {plan.id}. Starting run for user '{end_user_id}'...")
+        # Portia makes its own LLM calls, so execution reserves provider capacity up
+        # front, roughly one call per step
+        self.llm_scheduler.acquire_sync(Priority.INTERACTIVE, cost=max(1, len(plan.steps)))
+        with span("portia_run_plan", plan_source=source) as attributes:
+            plan_run = self.portia_sdk.run_plan(plan, end_user_id=end_user_id, plan_run_inputs=inputs)
+            attributes["state"] = str(plan_run.state)
         print(f"Agent: Plan run started. Initial state: {plan_run.state}")
         return plan_run
+
+    def _plan_for(self, enriched_query: str):
+        """
+        Returns (plan, plan inputs, source). A query whose slots fill a registered template
+        runs that template; otherwise a cached plan for the same query is reused, and only
+        then is the query planned by the LLM.
+        """
+        portia_client = self.portia_client
+        routed = route_query(enriched_query) if PLAN_TEMPLATES_ENABLED else None
+        if routed is not None and routed[0].name in portia_client.registered_plans:
+            template, slots = routed
+            plan = portia_client.registered_plans[template.name]
+            return plan, plan_inputs(plan, slots), "template"
+
+        plan = portia_client.plan_cache.get(enriched_query) if portia_client.plan_cache is not None else None
+        if plan is not None:
+            return plan, None, "cache"
+
+        print(f"Agent: Generating plan for enriched query: '{enriched_query}'")
+        self.llm_scheduler.acquire_sync(Priority.INTERACTIVE)
+        with span("portia_plan") as attributes:
+            plan = self.portia_sdk.plan(enriched_query)
+            attributes["steps"] = len(plan.steps)
+        if portia_client.plan_cache is not None:
+            portia_client.plan_cache.set(enriched_query, plan)
+        return plan, None, "planner"
+
+    def resume_task(self, plan_run: PlanRun, user_message: str) -> PlanRun:
+        """
+        Resolves the plan run's outstanding clarifications with the user's reply and
+        resumes execution.
+
+        Action clarifications (such as OAuth) are only resumed once the action has been
+        reported complete, so they are resolved straight away rather than polled with
+        `wait_for_ready`. If the action is in fact still pending, the step raises a new
+        clarification and the run is parked again.
+        """
+        with span("portia_resume"):
+            while plan_run.state == PlanRunState.NEED_CLARIFICATION:
+                clarification = plan_run.get_outstanding_clarifications()[0]
+                if isinstance(clarification, ActionClarification):
+                    plan_run = self.portia_sdk.resolve_clarification(clarification, "Action completed.", plan_run)
+                else:
+                    plan_run = self.portia_sdk.resolve_clarification(clarification, user_message, plan_run)
+
+            if plan_run.state != PlanRunState.DONE:
+                self.llm_scheduler.acquire_sync(Priority.INTERACTIVE)
+                plan_run = self.portia_sdk.resume(plan_run)
+        return plan_run
+
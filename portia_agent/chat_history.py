@@ -0,0 +1,85 @@
+import json
+import asyncio
+from typing import Awaitable, Callable, Optional
+
+class ChatHistory:
+    """
+    Per-session chat history in Redis with constant memory and prompt size.
+
+    Messages live in a capped list, `chat_history:{session_id}`. Reads fetch only the window
+    the prompt needs, together with the rolling summary, in one pipelined round trip. Each
+    turn is written in a single transaction that also trims and refreshes the TTL.
+
+    With a summarizer configured, messages about to fall off the end of the list are first
+    folded into `chat_summary:{session_id}` in the background, so older context survives
+    as a short summary instead of being dropped.
+    """
+
+    def __init__(self, redis, max_messages: int = 20, window: int = 4, ttl_seconds: int = 3600,
+                 summarizer: Optional[Callable[[str, list], Awaitable[str]]] = None, summary_batch: int = 8):
+        self.redis = redis
+        self.max_messages = max_messages
+        self.window = window
+        self.ttl_seconds = ttl_seconds
+        self.summarizer = summarizer
+        self.summary_batch = summary_batch
+        self._background_tasks = set()
+
+    @staticmethod
+    def _key(session_id: str) -> str:
+        return f"chat_history:{session_id}"
+
+    @staticmethod
+    def _summary_key(session_id: str) -> str:
+        return f"chat_summary:{session_id}"
+
+    async def read(self, session_id: str):
+        """Returns (last `window` messages, rolling summary of older turns or None)."""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.lrange(self._key(session_id), -self.window, -1)
+            pipe.get(self._summary_key(session_id))
+            history_raw, summary = await pipe.execute()
+        summary = summary.decode() if isinstance(summary, bytes) else summary
+        return [json.loads(item) for item in history_raw], summary
+
+    async def append_turn(self, session_id: str, user_query: str, assistant_response: str):
+        key = self._key(session_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, json.dumps({"role": "user", "content": user_query}), json.dumps({"role": "assistant", "content": assistant_response}))
+            # Hard cap; with a summarizer there is headroom for turns waiting to be summarized
+            pipe.ltrim(key, -self.max_messages if self.summarizer is None else -(self.max_messages + 4 * self.summary_batch), -1)
+            pipe.expire(key, self.ttl_seconds)
+            pipe.expire(self._summary_key(session_id), self.ttl_seconds)
+            length, *_ = await pipe.execute()
+
+        # Summarize in batches, so the summarizer runs once every few turns rather than every turn
+        if self.summarizer is not None and length > self.max_messages + self.summary_batch:
+            task = asyncio.create_task(self._fold_into_summary(session_id))
+            self._background_tasks.add(task)
+            task.add_done_callback(self._background_tasks.discard)
+
+    async def _fold_into_summary(self, session_id: str):
+        key, summary_key = self._key(session_id), self._summary_key(session_id)
+        lock_key = f"{summary_key}:lock"
+        if not await self.redis.set(lock_key, "1", nx=True, ex=60):
+            return
+        try:
+            length = await self.redis.llen(key)
+            overflow = length - self.max_messages
+            if overflow <= 0:
+                return
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.lrange(key, 0, overflow - 1)
+                pipe.get(summary_key)
+                overflow_raw, previous_summary = await pipe.execute()
+            previous_summary = previous_summary.decode() if isinstance(previous_summary, bytes) else (previous_summary or "")
+            summary = await self.summarizer(previous_summary, [json.loads(item) for item in overflow_raw])
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.set(summary_key, summary, ex=self.ttl_seconds)
+                # Only drop what was summarized; turns appended meanwhile are kept
+                pipe.ltrim(key, overflow, -1)
+                await pipe.execute()
+        except Exception as e:
+            print(f"Error while summarizing chat history: {e}")
+        finally:
+            await self.redis.delete(lock_key)
@@ -0,0 +1,125 @@
+import os
+import re
+import csv
+from functools import lru_cache
+import numpy as np
+from scipy import sparse
+
+# --- Offline HS code classification index ---
+# Descriptions from an HS nomenclature CSV (columns `hs_code`, `description`) are
+# vectorized as TF-IDF over character n-grams. A batch of product descriptions is
+# classified with one sparse matrix multiply, so a whole invoice is scored at once
+# instead of running one agent plan per line.
+DEFAULT_HS_CODES_CSV = os.path.join(os.path.dirname(__file__), "data", "hs_codes.csv")
+NGRAM_RANGE = (3, 5)
+# Rows of queries scored per matrix multiply, bounding the dense score block's memory
+QUERY_CHUNK_SIZE = 1024
+
+_NON_ALNUM = re.compile(r"[^a-z0-9]+")
+_INNER_HYPHEN = re.compile(r"(?<=\w)-(?=\w)")
+
+def _char_ngrams(text: str):
+    """
+    Character n-grams taken within word boundaries, like scikit-learn's `char_wb`, plus
+    each whole word so exact word matches outrank shared fragments ("tshirts" vs "shirts").
+    """
+    ngrams = []
+    # "t-shirts" and "e-bikes" are single words
+    for word in _NON_ALNUM.sub(" ", _INNER_HYPHEN.sub("", text.lower())).split():
+        ngrams.append(f"<{word}>")
+        padded = f" {word} "
+        for n in range(NGRAM_RANGE[0], NGRAM_RANGE[1] + 1):
+            ngrams.extend(padded[i:i + n] for i in range(max(len(padded) - n + 1, 1)))
+    return ngrams
+
+
+class HSCodeIndex:
+    def __init__(self, codes: list, descriptions: list):
+        if not codes:
+            raise ValueError("The HS code index needs at least one code.")
+        self.codes = codes
+        self.descriptions = descriptions
+
+        self.vocabulary = {}
+        rows, cols, counts = [], [], []
+        for row, description in enumerate(descriptions):
+            for ngram, count in self._term_counts(description, grow_vocabulary=True).items():
+                rows.append(row)
+                cols.append(ngram)
+                counts.append(count)
+        counts_matrix = sparse.csr_matrix((counts, (rows, cols)), shape=(len(descriptions), len(self.vocabulary)), dtype=np.float32)
+
+        # Smoothed IDF, as in scikit-learn's TfidfVectorizer
+        document_frequency = np.bincount(counts_matrix.indices, minlength=len(self.vocabulary))
+        self.idf = (np.log((1 + len(descriptions)) / (1 + document_frequency)) + 1).astype(np.float32)
+        # Transposed once so lookups are a single (queries x terms) @ (terms x codes) product
+        self.matrix_t = self._weight(counts_matrix).T.tocsr()
+
+    @classmethod
+    def from_csv(cls, path: str) -> "HSCodeIndex":
+        codes, descriptions = [], []
+        with open(path, newline="", encoding="utf-8") as f:
+            for record in csv.DictReader(f):
+                codes.append(record["hs_code"].strip())
+                descriptions.append(record["description"].strip())
+        return cls(codes, descriptions)
+
+    def _term_counts(self, text: str, grow_vocabulary: bool = False) -> dict:
+        counts = {}
+        for ngram in _char_ngrams(text):
+            column = self.vocabulary.get(ngram)
+            if column is None:
+                if not grow_vocabulary:
+                    continue
+                column = self.vocabulary[ngram] = len(self.vocabulary)
+            counts[column] = counts.get(column, 0) + 1
+        return counts
+
+    def _weight(self, counts_matrix):
+        """Sublinear TF scaled by IDF, with L2-normalized rows so dot products are cosine similarities."""
+        weighted = counts_matrix.copy()
+        weighted.data = 1 + np.log(weighted.data)
+        weighted = weighted.multiply(self.idf).tocsr()
+        norms = np.sqrt(np.asarray(weighted.multiply(weighted).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        return sparse.diags(1 / norms).dot(weighted).tocsr()
+
+    def _vectorize(self, texts: list):
+        rows, cols, counts = [], [], []
+        for row, text in enumerate(texts):
+            for column, count in self._term_counts(text).items():
+                rows.append(row)
+                cols.append(column)
+                counts.append(count)
+        counts_matrix = sparse.csr_matrix((counts, (rows, cols)), shape=(len(texts), len(self.vocabulary)), dtype=np.float32)
+        return self._weight(counts_matrix)
+
+    def lookup(self, descriptions: list, top_k: int = 3, min_score: float = 0.0) -> list:
+        """
+        Returns, for each product description, up to `top_k` candidate codes ordered by
+        cosine similarity: [[{"hs_code", "description", "score"}, ...], ...].
+        """
+        top_k = max(1, min(top_k, len(self.codes)))
+        results = []
+        for start in range(0, len(descriptions), QUERY_CHUNK_SIZE):
+            chunk = descriptions[start:start + QUERY_CHUNK_SIZE]
+            scores = (self._vectorize(chunk) @ self.matrix_t).toarray()
+            # argpartition picks the top k per row in linear time; only those k are sorted
+            candidates = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+            candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+            order = np.argsort(-candidate_scores, axis=1)
+            candidates = np.take_along_axis(candidates, order, axis=1)
+            candidate_scores = np.take_along_axis(candidate_scores, order, axis=1)
+            for row_candidates, row_scores in zip(candidates, candidate_scores):
+                results.append([
+                    {"hs_code": self.codes[i], "description": self.descriptions[i], "score": round(float(score), 4)}
+                    for i, score in zip(row_candidates, row_scores)
+                    if score > min_score
+                ])
+        return results
+
+
+@lru_cache(maxsize=1)
+def get_hs_index() -> HSCodeIndex:
+    """The process-wide index, built on first use from HS_CODES_CSV or the bundled sample nomenclature."""
+    return HSCodeIndex.from_csv(os.getenv("HS_CODES_CSV", DEFAULT_HS_CODES_CSV))
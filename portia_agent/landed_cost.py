@@ -0,0 +1,203 @@
+import os
+import re
+import json
+import time
+import threading
+from typing import Iterator, Optional
+import numpy as np
+import pandas as pd
+
+# --- Vectorized bulk landed-cost calculator ---
+# Shipment line items are priced against locally cached tables rather than one agent
+# run per line:
+#   duty_rates.csv  destination (ISO2 or customs union, e.g. EU), hs_prefix, origin ("*" = any), duty_rate
+#   tax_rates.csv   destination, tax_name, tax_rate (import VAT/GST)
+#   fx_rates.csv    currency, usd_per_unit
+# Duty uses the longest matching HS prefix, preferring an origin-specific rate over "*".
+# Import tax is charged on customs value plus duty. Tax rates fetched from Xero are
+# cached in Redis by the worker tier and override the local table for that country.
+DEFAULT_TARIFF_DATA_DIR = os.path.join(os.path.dirname(__file__), "data", "tariffs")
+CHUNK_ROWS = 50000
+HS_PREFIX_LENGTHS = (10, 8, 6, 4, 2)
+TABLES_TTL_SECONDS = 300
+XERO_TAX_RATES_KEY = "landed_cost:xero_tax_rates"
+
+# Only empty cells are missing: pandas' default NA strings include "NA", Namibia's code
+_CSV_NA = {"keep_default_na": False, "na_values": [""]}
+
+EU_MEMBERS = {
+    "AT", "BE", "BG", "HR", "CY", "CZ", "DK", "EE", "FI", "FR", "DE", "GR", "HU", "IE", "IT", "LV",
+    "LT", "LU", "MT", "NL", "PL", "PT", "RO", "SK", "SI", "ES", "SE",
+}
+REQUIRED_COLUMNS = ["hs_code", "origin", "destination", "value", "currency"]
+
+
+class TariffTables:
+    def __init__(self, duty_rates: pd.DataFrame, tax_rates: pd.DataFrame, fx_rates: pd.DataFrame):
+        # Flattened to "DEST|ORIGIN|PREFIX" keys so each prefix length is one Series.map
+        self.duty_rates = pd.Series(
+            duty_rates["duty_rate"].astype(float).values,
+            index=duty_rates["destination"].str.upper() + "|" + duty_rates["origin"].fillna("*").str.upper() + "|" + duty_rates["hs_prefix"].astype(str).str.replace(r"\D", "", regex=True),
+        )
+        self.tax_rates = pd.Series(tax_rates["tax_rate"].astype(float).values, index=tax_rates["destination"].str.upper())
+        self.fx_rates = pd.Series(fx_rates["usd_per_unit"].astype(float).values, index=fx_rates["currency"].str.upper())
+
+    @classmethod
+    def from_dir(cls, data_dir: str, tax_overrides: Optional[dict] = None) -> "TariffTables":
+        tax_rates = pd.read_csv(os.path.join(data_dir, "tax_rates.csv"), dtype={"destination": str}, **_CSV_NA)
+        if tax_overrides:
+            overrides = pd.DataFrame([{"destination": k, "tax_name": "Xero", "tax_rate": v} for k, v in tax_overrides.items()])
+            tax_rates = pd.concat([tax_rates[~tax_rates["destination"].str.upper().isin(overrides["destination"])], overrides])
+        return cls(
+            pd.read_csv(os.path.join(data_dir, "duty_rates.csv"), dtype={"destination": str, "hs_prefix": str, "origin": str}, **_CSV_NA),
+            tax_rates,
+            pd.read_csv(os.path.join(data_dir, "fx_rates.csv"), dtype={"currency": str}, **_CSV_NA),
+        )
+
+    def price(self, lines: pd.DataFrame, report_currency: str = "USD") -> pd.DataFrame:
+        """Computes duty, import tax and landed cost for a chunk of line items, in `report_currency`."""
+        missing = [column for column in REQUIRED_COLUMNS if column not in lines.columns]
+        if missing:
+            raise ValueError(f"Missing required columns: {', '.join(missing)}")
+        report_rate = self.fx_rates.get(report_currency.upper())
+        if report_rate is None:
+            raise ValueError(f"No FX rate for report currency {report_currency}")
+
+        out = lines.copy()
+        hs = out["hs_code"].astype(str).str.replace(r"\D", "", regex=True)
+        destination = out["destination"].astype(str).str.strip().str.upper()
+        origin = out["origin"].fillna("").astype(str).str.strip().str.upper()
+        customs_territory = destination.where(~destination.isin(EU_MEMBERS), "EU")
+
+        # Customs value (CIF when freight/insurance columns are supplied), in the report currency
+        fx = out["currency"].astype(str).str.upper().map(self.fx_rates)
+        value = pd.to_numeric(out["value"], errors="coerce")
+        for extra in ("freight", "insurance"):
+            if extra in out.columns:
+                value = value + pd.to_numeric(out[extra], errors="coerce").fillna(0)
+        customs_value = value * fx / report_rate
+
+        # Longest HS prefix wins; at each length an origin-specific rate beats the "*" rate
+        duty_rate = pd.Series(np.nan, index=out.index)
+        for length in HS_PREFIX_LENGTHS:
+            prefix = hs.str[:length]
+            for origin_key in (origin, "*"):
+                unmatched = duty_rate.isna()
+                if not unmatched.any():
+                    break
+                keys = customs_territory[unmatched] + "|" + (origin_key[unmatched] if isinstance(origin_key, pd.Series) else origin_key) + "|" + prefix[unmatched]
+                duty_rate[unmatched] = keys.map(self.duty_rates)
+
+        tax_rate = destination.map(self.tax_rates)
+        duty = customs_value * duty_rate
+        tax = (customs_value + duty) * tax_rate
+
+        out["report_currency"] = report_currency.upper()
+        out["customs_value"] = customs_value.round(2)
+        out["duty_rate"] = duty_rate
+        out["duty"] = duty.round(2)
+        out["tax_rate"] = tax_rate
+        out["tax"] = tax.round(2)
+        out["landed_cost"] = (customs_value + duty + tax).round(2)
+        out["status"] = np.select(
+            [value.isna(), fx.isna(), duty_rate.isna(), tax_rate.isna()],
+            ["invalid_value", "unknown_currency", "no_tariff_rate", "no_tax_rate"],
+            default="ok",
+        )
+        return out
+
+
+def _read_chunks(file, file_format: str) -> Iterator[pd.DataFrame]:
+    if file_format == "parquet":
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(file).iter_batches(batch_size=CHUNK_ROWS):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(file, chunksize=CHUNK_ROWS, dtype={"hs_code": str}, **_CSV_NA)
+
+
+def price_shipment_file(tables: TariffTables, file, file_format: str, report_currency: str = "USD", output: str = "csv") -> Iterator[str]:
+    """Prices an uploaded manifest chunk by chunk, yielding CSV or NDJSON text as each chunk completes."""
+    for i, chunk in enumerate(_read_chunks(file, file_format)):
+        priced = tables.price(chunk, report_currency)
+        if output == "ndjson":
+            yield priced.to_json(orient="records", lines=True)
+        else:
+            yield priced.to_csv(index=False, header=(i == 0))
+
+
+# --- Cached tables ---
+_tables = None
+_tables_loaded_at = 0.0
+_tables_lock = threading.Lock()
+
+def get_tariff_tables(redis=None) -> TariffTables:
+    """The process-wide tables, reloaded every few minutes to pick up refreshed Xero tax rates."""
+    global _tables, _tables_loaded_at
+    with _tables_lock:
+        if _tables is None or time.monotonic() - _tables_loaded_at > TABLES_TTL_SECONDS:
+            overrides = None
+            if redis is not None:
+                raw = redis.get(XERO_TAX_RATES_KEY)
+                overrides = json.loads(raw) if raw else None
+            _tables = TariffTables.from_dir(os.getenv("TARIFF_DATA_DIR", DEFAULT_TARIFF_DATA_DIR), overrides)
+            _tables_loaded_at = time.monotonic()
+        return _tables
+
+
+# --- Xero tax-rate refresh (worker tier) ---
+XERO_TAX_RATES_TOOL_ID = os.getenv("XERO_TAX_RATES_TOOL_ID", "mcp:xero:list-tax-rates")
+XERO_TAX_COUNTRY = os.getenv("XERO_TAX_COUNTRY")
+XERO_IMPORT_TAX_NAME = os.getenv("XERO_IMPORT_TAX_NAME", "import")
+TAX_RATE_REFRESH_SECONDS = int(os.getenv("TAX_RATE_REFRESH_SECONDS", "21600"))
+# A failed refresh is retried after this long rather than a full refresh interval
+TAX_RATE_RETRY_SECONDS = int(os.getenv("TAX_RATE_RETRY_SECONDS", "300"))
+_PERCENT_RE = re.compile(r"(\d+(?:\.\d+)?)\s*%")
+
+def _parse_import_tax_rate(output) -> Optional[float]:
+    """Picks the import tax rate out of the Xero tool's output (structured records or text)."""
+    if isinstance(output, str):
+        try:
+            output = json.loads(output)
+        except ValueError:
+            for line in output.splitlines():
+                match = _PERCENT_RE.search(line)
+                if match and XERO_IMPORT_TAX_NAME.lower() in line.lower():
+                    return float(match.group(1)) / 100
+            return None
+    records = output.get("TaxRates", output.get("taxRates", [])) if isinstance(output, dict) else output
+    for record in records or []:
+        name = str(record.get("Name") or record.get("name") or "")
+        rate = record.get("EffectiveRate", record.get("effectiveRate", record.get("DisplayTaxRate")))
+        if rate is not None and XERO_IMPORT_TAX_NAME.lower() in name.lower():
+            return float(rate) / 100
+    return None
+
+def refresh_xero_tax_rates(portia_sdk, redis, end_user_id: str = "system") -> bool:
+    """
+    Fetches tax rates through the Xero MCP tool once per refresh interval, across all
+    workers, and stores the import rate for XERO_TAX_COUNTRY where the API tier reads it.
+    """
+    lock_key = f"{XERO_TAX_RATES_KEY}:refresh_lock"
+    # Held only for the retry delay until the refresh succeeds, then for the full interval
+    if not XERO_TAX_COUNTRY or not redis.set(lock_key, "1", nx=True, ex=TAX_RATE_RETRY_SECONDS):
+        return False
+    from portia import PlanBuilder
+    from portia_agent.llm_scheduler import Priority, get_llm_scheduler
+
+    try:
+        # Background refreshes never wait for provider capacity; the next interval retries
+        get_llm_scheduler().acquire_sync(Priority.BATCH, max_wait_seconds=0)
+        plan = PlanBuilder("Fetch the organisation's tax rates from Xero").step("List all tax rates", tool_id=XERO_TAX_RATES_TOOL_ID).build()
+        plan_run = portia_sdk.run_plan(plan, end_user_id=end_user_id)
+        final_output = plan_run.outputs.final_output
+        rate = _parse_import_tax_rate(final_output.get_value() if final_output else None)
+    except Exception as e:
+        print(f"Landed cost: Xero tax-rate refresh failed: {e}")
+        return False
+    if rate is None:
+        print("Landed cost: no import tax rate found in Xero output.")
+        return False
+    redis.set(XERO_TAX_RATES_KEY, json.dumps({XERO_TAX_COUNTRY.upper(): rate}))
+    redis.expire(lock_key, TAX_RATE_REFRESH_SECONDS)
+    return True
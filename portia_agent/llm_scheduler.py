@@ -0,0 +1,209 @@
+import os
+import math
+import time
+import heapq
+import asyncio
+import itertools
+from enum import IntEnum
+from functools import lru_cache
+from contextlib import asynccontextmanager
+from typing import Optional
+from redis.exceptions import RedisError
+from backend.redis_client import get_redis_client, get_async_redis_client
+
+# --- LLM call scheduler ---
+# Every LLM call (Gemini pre-processing and summaries, Portia planning and execution) is
+# admitted through here, so one customer's burst cannot push everyone into the
+# provider's rate limit:
+#   - A per-user token bucket is charged when a turn or plan run is accepted at the API
+#     edge. Over quota means an immediate 429 with Retry-After for that user only.
+#   - A per-provider token bucket is shared by every API and worker process and sized
+#     to the provider's limit. Callers wait in line for it instead of being retried
+#     by the provider.
+#   - Priorities: interactive turns can drain the provider bucket completely, while
+#     background and batch work must leave headroom. Within an API process, waiting
+#     calls get concurrency slots in priority order.
+#   - The queue is bounded in depth and wait time; beyond that callers get a 429.
+# Buckets live in Redis (`llm_bucket:{scope}`) and are updated atomically by a script.
+# If Redis is unavailable the buckets fail open: calls are admitted and a warning is logged.
+# Worker threads may block up to this long for provider capacity before failing the job
+WORKER_MAX_WAIT_SECONDS = float(os.getenv("LLM_WORKER_MAX_WAIT_SECONDS", "120"))
+# User-bucket cost of accepting a plan run (planning plus typical execution calls)
+PLAN_RUN_COST = float(os.getenv("LLM_PLAN_RUN_COST", "3"))
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BACKGROUND = 1
+    BATCH = 2
+
+# Share of the provider bucket each priority must leave untouched
+PRIORITY_RESERVE = {Priority.INTERACTIVE: 0.0, Priority.BACKGROUND: 0.2, Priority.BATCH: 0.4}
+
+class LLMRateLimited(Exception):
+    """Raised when an LLM call cannot be admitted; maps to HTTP 429 with Retry-After."""
+
+    def __init__(self, scope: str, retry_after: float):
+        super().__init__(f"LLM rate limit reached ({scope}); retry in {retry_after:.1f}s")
+        self.scope = scope
+        self.retry_after = retry_after
+
+# KEYS: buckets to charge. ARGV: now, cost, then rate, capacity, reserve per bucket.
+# Charges all buckets or none. Returns {0, "0"} on success, otherwise the 1-based
+# index of the limiting bucket and the seconds until it can cover the cost.
+_TOKEN_BUCKET_LUA = """
+local now = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local rate, capacity, reserve = tonumber(ARGV[3 * i]), tonumber(ARGV[3 * i + 1]), tonumber(ARGV[3 * i + 2])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or capacity
+    local elapsed = math.max(0, now - (tonumber(bucket[2]) or now))
+    tokens = math.min(capacity, tokens + elapsed * rate)
+    local floor = reserve * capacity
+    if tokens - cost < floor then
+        return {i, tostring((cost + floor - tokens) / rate)}
+    end
+    levels[i] = tokens
+end
+for i, key in ipairs(KEYS) do
+    local rate, capacity = tonumber(ARGV[3 * i]), tonumber(ARGV[3 * i + 1])
+    redis.call('HSET', key, 'tokens', tostring(levels[i] - cost), 'ts', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(capacity / rate) + 1)
+end
+return {0, '0'}
+"""
+
+
+class LLMScheduler:
+    def __init__(self, provider: str, provider_rpm: float, provider_burst: float, user_rpm: float, user_burst: float,
+                 max_concurrency: int, max_queue: int, max_wait_seconds: float):
+        self.provider = provider
+        self.provider_rate, self.provider_capacity = provider_rpm / 60, provider_burst
+        self.user_rate, self.user_capacity = user_rpm / 60, user_burst
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait_seconds = max_wait_seconds
+        self._script = get_redis_client().register_script(_TOKEN_BUCKET_LUA)
+        self._async_script = get_async_redis_client().register_script(_TOKEN_BUCKET_LUA)
+        # In-process concurrency slots, handed out in priority order
+        self._active = 0
+        self._waiters = []
+        self._sequence = itertools.count()
+
+    def _provider_bucket(self, priority: Priority, cost: float):
+        return f"llm_bucket:provider:{self.provider}", [self.provider_rate, self.provider_capacity, PRIORITY_RESERVE[priority]], min(cost, self.provider_capacity)
+
+    def _user_bucket(self, user_id: str, cost: float):
+        return f"llm_bucket:user:{user_id}", [self.user_rate, self.user_capacity, 0.0], min(cost, self.user_capacity)
+
+    @staticmethod
+    def _parse(result) -> tuple[int, float]:
+        index, wait = result
+        return int(index), float(wait.decode() if isinstance(wait, bytes) else wait)
+
+    def _charge_sync(self, key: str, params: list, cost: float) -> tuple[int, float]:
+        try:
+            return self._parse(self._script(keys=[key], args=[time.time(), cost, *params]))
+        except RedisError as e:
+            print(f"LLM scheduler: Redis unavailable, admitting without {key}: {e}")
+            return 0, 0.0
+
+    async def _charge(self, key: str, params: list, cost: float) -> tuple[int, float]:
+        try:
+            return self._parse(await self._async_script(keys=[key], args=[time.time(), cost, *params]))
+        except RedisError as e:
+            print(f"LLM scheduler: Redis unavailable, admitting without {key}: {e}")
+            return 0, 0.0
+
+    # --- API side (async) ---
+    async def admit(self, user_id: str, cost: float = 1):
+        """Charges the user's bucket for work accepted at the API edge, or raises LLMRateLimited."""
+        index, wait = await self._charge(*self._user_bucket(user_id, cost))
+        if index:
+            raise LLMRateLimited("user", wait)
+
+    async def refund(self, user_id: str, cost: float):
+        """Returns tokens charged by `admit` for work that was not started."""
+        key, params, _ = self._user_bucket(user_id, cost)
+        # A negative charge always succeeds; the bucket is capped at its capacity on the next read
+        await self._charge(key, params, -cost)
+
+    @asynccontextmanager
+    async def slot(self, priority: Priority = Priority.INTERACTIVE, cost: float = 1):
+        """Holds a concurrency slot and provider capacity for one LLM call made in this process."""
+        deadline = time.monotonic() + self.max_wait_seconds
+        await self._acquire_slot(priority, deadline)
+        try:
+            bucket = self._provider_bucket(priority, cost)
+            while True:
+                index, wait = await self._charge(*bucket)
+                if not index:
+                    break
+                if time.monotonic() + wait > deadline:
+                    raise LLMRateLimited("provider", wait)
+                await asyncio.sleep(wait)
+            yield
+        finally:
+            self._release_slot()
+
+    async def _acquire_slot(self, priority: Priority, deadline: float):
+        if self._active < self.max_concurrency and not self._waiters:
+            self._active += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            raise LLMRateLimited("queue", 1.0)
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), waiter))
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=max(0.0, deadline - time.monotonic()))
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            # Timed out, or the caller went away (client disconnect, shutdown)
+            if waiter.done() and not waiter.cancelled():
+                # Granted just as the wait ended: hand the slot on
+                self._release_slot()
+            else:
+                waiter.cancel()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            raise LLMRateLimited("queue", 1.0)
+
+    def _release_slot(self):
+        while self._waiters:
+            _priority, _sequence, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                # The slot passes straight to the next waiter, so _active is unchanged
+                waiter.set_result(None)
+                return
+        self._active -= 1
+
+    # --- Worker side (sync) ---
+    def acquire_sync(self, priority: Priority = Priority.INTERACTIVE, cost: float = 1, max_wait_seconds: Optional[float] = None):
+        """Blocks until the provider bucket covers `cost`, or raises LLMRateLimited after `max_wait_seconds`."""
+        max_wait_seconds = WORKER_MAX_WAIT_SECONDS if max_wait_seconds is None else max_wait_seconds
+        deadline = time.monotonic() + max_wait_seconds
+        bucket = self._provider_bucket(priority, cost)
+        while True:
+            index, wait = self._charge_sync(*bucket)
+            if not index:
+                return
+            if time.monotonic() + wait > deadline:
+                raise LLMRateLimited("provider", wait)
+            time.sleep(wait)
+
+
+@lru_cache(maxsize=1)
+def get_llm_scheduler() -> LLMScheduler:
+    return LLMScheduler(
+        provider=os.getenv("LLM_PROVIDER", "gemini"),
+        provider_rpm=float(os.getenv("LLM_PROVIDER_RPM", "1000")),
+        provider_burst=float(os.getenv("LLM_PROVIDER_BURST", "50")),
+        user_rpm=float(os.getenv("LLM_USER_RPM", "30")),
+        user_burst=float(os.getenv("LLM_USER_BURST", "12")),
+        max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "16")),
+        max_queue=int(os.getenv("LLM_MAX_QUEUE", "200")),
+        max_wait_seconds=float(os.getenv("LLM_MAX_WAIT_SECONDS", "10")),
+    )
+
+def retry_after_header(error: LLMRateLimited) -> dict:
+    return {"Retry-After": str(max(1, math.ceil(error.retry_after)))}
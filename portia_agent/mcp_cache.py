@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+from typing import Callable, Optional
+from pydantic import PrivateAttr
+from portia import Tool, ToolRegistry, ToolRunContext
+from redis.exceptions import RedisError
+
+# --- Read-through cache for Xero MCP tools ---
+# Read-only Xero tools (list-*/get-*) are served from Redis for a per-tool TTL. All
+# worker processes share the cache. While one process fetches a key, concurrent
+# callers wait for its result instead of calling Xero themselves. Every other tool is
+# treated as a write: it runs uncached and bumps the tenant's generation, which makes
+# everything cached for that tenant unreachable at once.
+MCP_CACHE_PREFIX = "mcp_cache:"
+MCP_CACHE_STATS_KEY = "mcp_cache:stats"
+MCP_CACHE_DEFAULT_TTL_SECONDS = int(os.getenv("MCP_CACHE_DEFAULT_TTL_SECONDS", "60"))
+MCP_CACHE_INFLIGHT_TIMEOUT_SECONDS = 30
+# Reference data changes rarely; transactional lists keep the short default
+MCP_CACHE_TTLS = {
+    "list-tax-rates": 3600,
+    "list-organisation-details": 3600,
+    "list-accounts": 1800,
+    "list-tracking-categories": 1800,
+    "list-items": 600,
+    "list-contacts": 300,
+    "list-contact-groups": 300,
+    **json.loads(os.getenv("MCP_CACHE_TTLS", "{}")),
+}
+READ_ONLY_PREFIXES = ("list-", "get-")
+# Releases the in-flight marker only if this caller still owns it
+_RELEASE_INFLIGHT_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def _tool_name(tool: Tool) -> str:
+    return tool.id.rsplit(":", 1)[-1].replace("_", "-")
+
+
+def _is_error_result(result) -> bool:
+    if isinstance(result, str):
+        try:
+            result = json.loads(result)
+        except ValueError:
+            return False
+    return isinstance(result, dict) and bool(result.get("isError"))
+
+
+class McpCallCache:
+    """Redis-backed results cache with single-flight fetches for one Xero tenant."""
+
+    def __init__(self, redis, tenant: str):
+        self.redis = redis
+        self.tenant = hashlib.sha256((tenant or "default").encode()).hexdigest()[:16]
+
+    @property
+    def _generation_key(self) -> str:
+        return f"{MCP_CACHE_PREFIX}{self.tenant}:generation"
+
+    def _record(self, tool_name: str, outcome: str):
+        self.redis.hincrby(MCP_CACHE_STATS_KEY, f"{tool_name}:{outcome}", 1)
+
+    def invalidate(self):
+        """Drops every cached result for this tenant."""
+        self.redis.incr(self._generation_key)
+
+    def call(self, tool_name: str, args: dict, ttl_seconds: int, fetch: Callable):
+        owner_token = None
+        try:
+            generation = int(self.redis.get(self._generation_key) or 0)
+            args_digest = hashlib.sha256(json.dumps(args, sort_keys=True, default=str).encode()).hexdigest()
+            key = f"{MCP_CACHE_PREFIX}{self.tenant}:{generation}:{tool_name}:{args_digest}"
+            cached = self.redis.get(key)
+            if cached is not None:
+                self._record(tool_name, "hits")
+                return json.loads(cached)
+
+            inflight_key = f"{key}:inflight"
+            token = uuid.uuid4().hex
+            if self.redis.set(inflight_key, token, nx=True, ex=MCP_CACHE_INFLIGHT_TIMEOUT_SECONDS):
+                owner_token = token
+            else:
+                # Someone else is fetching this exact call; wait for their result. If they
+                # give up without one, fetch directly, leaving their marker alone.
+                deadline = time.monotonic() + MCP_CACHE_INFLIGHT_TIMEOUT_SECONDS
+                while time.monotonic() < deadline:
+                    time.sleep(0.05)
+                    cached = self.redis.get(key)
+                    if cached is not None:
+                        self._record(tool_name, "coalesced")
+                        return json.loads(cached)
+                    if not self.redis.exists(inflight_key):
+                        break
+        except RedisError as e:
+            print(f"MCP cache: Redis unavailable, calling {tool_name} directly: {e}")
+            return fetch()
+
+        try:
+            result = fetch()
+        except BaseException:
+            self._release_inflight(inflight_key, owner_token, tool_name)
+            raise
+        # The result must reach the caller even if Redis fails from here on; losing it
+        # would make the agent call the tool again
+        try:
+            self._record(tool_name, "misses")
+            if not _is_error_result(result):
+                try:
+                    self.redis.set(key, json.dumps(result), ex=ttl_seconds)
+                except TypeError:
+                    pass
+        except RedisError as e:
+            print(f"MCP cache: could not cache the result of {tool_name}: {e}")
+        self._release_inflight(inflight_key, owner_token, tool_name)
+        return result
+
+    def _release_inflight(self, inflight_key: str, owner_token: Optional[str], tool_name: str):
+        if owner_token is None:
+            return
+        try:
+            self.redis.eval(_RELEASE_INFLIGHT_LUA, 1, inflight_key, owner_token)
+        except RedisError as e:
+            print(f"MCP cache: could not release the in-flight marker for {tool_name}: {e}")
+
+
+class CachedMcpTool(Tool):
+    """Wraps an MCP tool: cached reads for read-only tools, tenant invalidation for writes."""
+
+    _inner: Tool = PrivateAttr()
+    _cache: McpCallCache = PrivateAttr()
+    _ttl_seconds: Optional[int] = PrivateAttr()
+
+    def __init__(self, inner: Tool, cache: McpCallCache):
+        super().__init__(
+            id=inner.id,
+            name=inner.name,
+            description=inner.description,
+            args_schema=inner.args_schema,
+            output_schema=inner.output_schema,
+            should_summarize=inner.should_summarize,
+        )
+        self._inner = inner
+        self._cache = cache
+        tool_name = _tool_name(inner)
+        self._ttl_seconds = MCP_CACHE_TTLS.get(tool_name, MCP_CACHE_DEFAULT_TTL_SECONDS) if tool_name.startswith(READ_ONLY_PREFIXES) else None
+
+    def run(self, ctx: ToolRunContext, *args, **kwargs):
+        tool_name = _tool_name(self._inner)
+        if self._ttl_seconds is None:
+            try:
+                return self._inner.run(ctx, *args, **kwargs)
+            finally:
+                try:
+                    self._cache.invalidate()
+                except RedisError as e:
+                    print(f"MCP cache: could not invalidate after {tool_name}: {e}")
+        if self._ttl_seconds <= 0:
+            return self._inner.run(ctx, *args, **kwargs)
+        return self._cache.call(tool_name, kwargs, self._ttl_seconds, lambda: self._inner.run(ctx, *args, **kwargs))
+
+
+def cached_tool_registry(registry: ToolRegistry, redis, tenant: str) -> ToolRegistry:
+    """Returns a registry with every tool of `registry` wrapped in the read-through cache."""
+    cache = McpCallCache(redis, tenant)
+    return ToolRegistry([CachedMcpTool(tool, cache) for tool in registry.get_tools()])
+
+
+async def get_mcp_cache_stats(redis) -> dict:
+    """Per-tool hit, coalesced and miss counts and hit rate, across all workers."""
+    stats = {}
+    for field, count in (await redis.hgetall(MCP_CACHE_STATS_KEY)).items():
+        field = field.decode() if isinstance(field, bytes) else field
+        tool_name, outcome = field.rsplit(":", 1)
+        stats.setdefault(tool_name, {"hits": 0, "coalesced": 0, "misses": 0})[outcome] = int(count)
+    for counts in stats.values():
+        total = counts["hits"] + counts["coalesced"] + counts["misses"]
+        counts["hit_rate"] = round((counts["hits"] + counts["coalesced"]) / total, 4) if total else 0.0
+    return stats
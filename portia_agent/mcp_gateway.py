@@ -0,0 +1,78 @@
+import os
+import time
+import shutil
+import socket
+import subprocess
+from typing import Optional
+
+# --- Xero MCP server process management ---
+# The Xero MCP server is a pinned, pre-installed Node binary (see deployment/Dockerfile),
+# so starting it never goes to npm. When it is only reachable over stdio, Portia spawns
+# a fresh server process for every tool call. Instead, each worker instance starts one
+# long-lived server behind an MCP stdio-to-SSE proxy, and all of its worker processes
+# connect to that over localhost. MCP multiplexes requests by id, so one server
+# process can handle every worker process on the instance.
+XERO_MCP_VERSION = os.getenv("XERO_MCP_VERSION", "0.0.12")
+XERO_MCP_BINARY = os.getenv("XERO_MCP_BINARY", "xero-mcp-server")
+XERO_MCP_GATEWAY_HOST = "127.0.0.1"
+XERO_MCP_GATEWAY_PORT = int(os.getenv("XERO_MCP_GATEWAY_PORT", "8096"))
+XERO_MCP_GATEWAY_START_TIMEOUT = float(os.getenv("XERO_MCP_GATEWAY_START_TIMEOUT", "30"))
+_gateway_process = None
+
+
+def xero_mcp_command() -> list:
+    """The command that starts the Xero MCP server over stdio, preferring the pre-installed binary."""
+    binary = shutil.which(XERO_MCP_BINARY)
+    if binary:
+        return [binary]
+    # Local development without the binary: still pinned, so npm's cache is reused across runs
+    return ["npx", "-y", f"@xeroapi/xero-mcp-server@{XERO_MCP_VERSION}"]
+
+
+def _port_open(host: str, port: int) -> bool:
+    try:
+        with socket.create_connection((host, port), timeout=0.5):
+            return True
+    except OSError:
+        return False
+
+
+def start_xero_mcp_gateway(xero_client_id: str, xero_client_secret: str) -> Optional[str]:
+    """
+    Starts the shared Xero MCP server behind `mcp-proxy` and returns its SSE URL. Returns
+    None when the proxy is not installed, so callers fall back to per-process stdio.
+    """
+    global _gateway_process
+    url = f"http://{XERO_MCP_GATEWAY_HOST}:{XERO_MCP_GATEWAY_PORT}/sse"
+    if _port_open(XERO_MCP_GATEWAY_HOST, XERO_MCP_GATEWAY_PORT):
+        # Already running, e.g. started by a previous worker generation on this instance
+        return url
+    proxy = shutil.which("mcp-proxy")
+    if proxy is None:
+        print("MCP gateway: mcp-proxy is not installed; Xero tools will use per-process stdio.")
+        return None
+
+    env = {**os.environ, "XERO_CLIENT_ID": xero_client_id or "", "XERO_CLIENT_SECRET": xero_client_secret or ""}
+    process = subprocess.Popen(
+        [proxy, "--host", XERO_MCP_GATEWAY_HOST, "--port", str(XERO_MCP_GATEWAY_PORT), "--pass-environment", "--", *xero_mcp_command()],
+        env=env,
+    )
+    deadline = time.monotonic() + XERO_MCP_GATEWAY_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            print(f"MCP gateway: exited during startup with code {process.returncode}.")
+            return None
+        if _port_open(XERO_MCP_GATEWAY_HOST, XERO_MCP_GATEWAY_PORT):
+            _gateway_process = process
+            return url
+        time.sleep(0.1)
+    process.terminate()
+    print("MCP gateway: did not start in time; Xero tools will use per-process stdio.")
+    return None
+
+
+def stop_xero_mcp_gateway():
+    global _gateway_process
+    if _gateway_process is not None and _gateway_process.poll() is None:
+        _gateway_process.terminate()
+    _gateway_process = None
@@ -0,0 +1,148 @@
+import os
+import json
+import hashlib
+from dataclasses import dataclass
+from typing import Callable, Optional
+from portia import Plan, PlanBuilder, PlanInput
+from redis.exceptions import RedisError
+from portia_agent.query_cache import PreprocessCache
+from portia_agent.slot_extractor import CREATE_VERB_RE, QuerySlots, extract_slots
+
+# --- Plan templates and plan cache ---
+# Nearly all traffic is an HS lookup, a duty calculation or an invoice. Each of these
+# shapes has a pre-built Portia plan whose values are plan inputs. Workers register
+# the plans once at startup (see backend/plan_registrar.py). When the slots of an
+# enriched query fill a template, the query runs that plan with the slot values and
+# skips the planning LLM call. Other queries are planned by Portia as before. The
+# generated plan is then cached in Redis, keyed by the normalized query and the tool
+# set, so repeated queries are not planned again.
+PLAN_TEMPLATES_ENABLED = os.getenv("PLAN_TEMPLATES_ENABLED", "true").lower() == "true"
+PLAN_CACHE_ENABLED = os.getenv("PLAN_CACHE_ENABLED", "true").lower() == "true"
+PLAN_CACHE_TTL_SECONDS = int(os.getenv("PLAN_CACHE_TTL_SECONDS", "86400"))
+PLAN_CACHE_PREFIX = "plan_cache:"
+
+HS_LOOKUP_TOOL_ID = "hs_code_lookup_tool"
+LANDED_COST_TOOL_ID = "landed_cost_tool"
+XERO_LIST_CONTACTS_TOOL_ID = os.getenv("XERO_LIST_CONTACTS_TOOL_ID", "mcp:xero:list-contacts")
+XERO_CREATE_INVOICE_TOOL_ID = os.getenv("XERO_CREATE_INVOICE_TOOL_ID", "mcp:xero:create-invoice")
+# Plan inputs must all have a value; an unknown origin is spelled out for the LLM steps
+UNKNOWN_ORIGIN = "not specified"
+
+
+def _hs_lookup_plan() -> Plan:
+    return (
+        PlanBuilder("Find the HS code for a product imported into a destination country.")
+        .input(name="$product", description="Description of the goods")
+        .input(name="$destination", description="Destination country")
+        .input(name="$origin", description="Country of origin, if known")
+        .step("Find the candidate HS codes for $product.", tool_id=HS_LOOKUP_TOOL_ID, output="$hs_candidates", inputs=["$product"])
+        .build()
+    )
+
+
+def _duty_plan() -> Plan:
+    return (
+        PlanBuilder("Find the HS code for a product and calculate its import duty in a destination country.")
+        .input(name="$product", description="Description of the goods")
+        .input(name="$destination", description="Destination country")
+        .input(name="$origin", description="Country of origin, if known")
+        .input(name="$amount", description="Customs value")
+        .input(name="$currency", description="Currency of the customs value")
+        .step("Find the candidate HS codes for $product.", tool_id=HS_LOOKUP_TOOL_ID, output="$hs_candidates", inputs=["$product"])
+        .step(
+            "Pick the best HS code for $product from $hs_candidates, then price the import of $product with a customs "
+            "value of $amount $currency into $destination from $origin using the local tariff tables.",
+            tool_id=LANDED_COST_TOOL_ID,
+            output="$duty",
+            inputs=["$hs_candidates", "$product", "$amount", "$currency", "$destination", "$origin"],
+        )
+        .build()
+    )
+
+
+def _invoice_plan() -> Plan:
+    return (
+        PlanBuilder("Create an invoice in Xero for a customer.")
+        .input(name="$customer", description="Name of the Xero contact to invoice")
+        .input(name="$product", description="Line item description")
+        .input(name="$amount", description="Invoice amount")
+        .input(name="$currency", description="Invoice currency")
+        .step("Find the Xero contact named $customer.", tool_id=XERO_LIST_CONTACTS_TOOL_ID, output="$contact", inputs=["$customer"])
+        .step(
+            "Create a sales invoice for the contact in $contact with one line item for $product with an amount of $amount $currency.",
+            tool_id=XERO_CREATE_INVOICE_TOOL_ID,
+            output="$invoice",
+            inputs=["$contact", "$product", "$amount", "$currency"],
+        )
+        .build()
+    )
+
+
+@dataclass
+class PlanTemplate:
+    name: str
+    build: Callable[[], Plan]
+    # Slots that must be filled to route here, in addition to the intents matching
+    required_slots: tuple
+
+
+def plan_inputs(plan: Plan, slots: QuerySlots) -> list:
+    """Values for a template plan's inputs, taken from the query's slots."""
+    values = {
+        "$product": slots.product, "$destination": slots.destination, "$origin": slots.origin or UNKNOWN_ORIGIN,
+        "$amount": slots.amount, "$currency": slots.currency, "$customer": slots.customer,
+    }
+    return [PlanInput(name=plan_input.name, value=values[plan_input.name]) for plan_input in plan.plan_inputs]
+
+
+PLAN_TEMPLATES = {
+    ("hs_code",): PlanTemplate("hs_lookup", _hs_lookup_plan, ("product", "destination")),
+    ("duty",): PlanTemplate("duty_calculation", _duty_plan, ("product", "destination", "amount", "currency")),
+    ("duty", "hs_code"): PlanTemplate("duty_calculation", _duty_plan, ("product", "destination", "amount", "currency")),
+    ("invoice",): PlanTemplate("invoice_creation", _invoice_plan, ("customer", "product", "amount", "currency")),
+}
+
+
+def route_query(enriched_query: str) -> Optional[tuple[PlanTemplate, QuerySlots]]:
+    """
+    Maps an enriched query onto a plan template using the slot extractor, or returns
+    None when the intent has no template, any slot is missing or ambiguous, or the
+    query asks for more than the template does.
+    """
+    slots = extract_slots(enriched_query)
+    template = PLAN_TEMPLATES.get(tuple(sorted(slots.intents)))
+    # Words outside the slots ("void", "email it", "screen the supplier") need the planner
+    if template is None or slots.ambiguous or slots.unused:
+        return None
+    # Only requests to create an invoice may run the template that creates one
+    if "invoice" in slots.intents and not CREATE_VERB_RE.search(enriched_query):
+        return None
+    if not all(getattr(slots, name) for name in template.required_slots):
+        return None
+    return template, slots
+
+
+class PlanCache:
+    """Generated plans in Redis, keyed by the normalized query and the registered tool ids."""
+
+    def __init__(self, redis, tool_ids: list):
+        self.redis = redis
+        self.tools_digest = hashlib.sha256(json.dumps(sorted(tool_ids)).encode()).hexdigest()[:16]
+
+    def _key(self, query: str) -> str:
+        query_digest = hashlib.sha256(PreprocessCache.normalize_query(query).encode()).hexdigest()
+        return f"{PLAN_CACHE_PREFIX}{self.tools_digest}:{query_digest}"
+
+    def get(self, query: str) -> Optional[Plan]:
+        try:
+            cached = self.redis.get(self._key(query))
+        except RedisError as e:
+            print(f"Plan cache: Redis unavailable, planning without it: {e}")
+            return None
+        return Plan.model_validate_json(cached) if cached is not None else None
+
+    def set(self, query: str, plan: Plan):
+        try:
+            self.redis.set(self._key(query), plan.model_dump_json(), ex=PLAN_CACHE_TTL_SECONDS)
+        except RedisError as e:
+            print(f"Plan cache: could not store plan {plan.id}: {e}")
@@ -1,22 +1,41 @@
 import os
-from portia import Portia, Config, DefaultToolRegistry, McpToolRegistry
+from portia import Portia, Config, DefaultToolRegistry, McpToolRegistry, ToolRegistry, ExecutionHooks
+from portia_agent.tools import get_local_tools
+from portia_agent.mcp_gateway import xero_mcp_command
+from portia_agent.mcp_cache import cached_tool_registry
+from portia_agent.plan_templates import PLAN_CACHE_ENABLED, PlanCache
+from backend.redis_client import get_redis_client
 
 class PortiaClient:
-    def __init__(self, portia_api_key: str, xero_client_id: str, xero_client_secret: str):
+    def __init__(self, portia_api_key: str, xero_client_id: str, xero_client_secret: str, execution_hooks: ExecutionHooks = None):
         print("Initializing Portia SDK Client...")
         config = Config.from_default(api_key=portia_api_key)
+
+        # Workers point XERO_MCP_URL at their instance's shared MCP gateway; without one,
+        # the pinned server is spawned over stdio.
+        xero_mcp_url = os.getenv("XERO_MCP_URL")
+        if xero_mcp_url:
+            xero_registry = McpToolRegistry.from_sse_connection(server_name="xero", url=xero_mcp_url)
+        else:
+            command, *args = xero_mcp_command()
+            xero_registry = McpToolRegistry.from_stdio_connection(
+                server_name="xero",
+                command=command,
+                args=args,
+                env={
+                    "XERO_CLIENT_ID": xero_client_id,
+                    "XERO_CLIENT_SECRET": xero_client_secret,
+                },
+            )
+        # Read-only Xero calls are served from a shared cache; writes invalidate it
+        if os.getenv("XERO_MCP_CACHE_ENABLED", "true").lower() == "true":
+            xero_registry = cached_tool_registry(xero_registry, get_redis_client(), tenant=xero_client_id)
+        tool_registry = DefaultToolRegistry(config) + ToolRegistry(get_local_tools()) + xero_registry
         
-        tool_registry = DefaultToolRegistry(config) + McpToolRegistry.from_stdio_connection(
-            server_name="xero",
-            command="npx",
-            args=["-y", "@xeroapi/xero-mcp-server@latest"],
-            env={
-                "XERO_CLIENT_ID": xero_client_id,
-                "XERO_CLIENT_SECRET": xero_client_secret,
-            },
-        )
-        
-        self.portia_sdk = Portia(config=config, tools=tool_registry)
+        self.portia_sdk = Portia(config=config, tools=tool_registry, execution_hooks=execution_hooks)
+        # Template plans by name, filled in by backend.plan_registrar.register_all_plans
+        self.registered_plans = {}
+        self.plan_cache = PlanCache(get_redis_client(), [tool.id for tool in tool_registry.get_tools()]) if PLAN_CACHE_ENABLED else None
         print("Portia SDK Client Initialized Successfully.")
 
     def get_sdk(self):
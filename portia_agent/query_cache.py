@@ -0,0 +1,82 @@
+import json
+import time
+import hashlib
+import asyncio
+from collections import OrderedDict
+from typing import Optional
+
+class PreprocessCache:
+    """
+    Two-tier cache for pre-processing results. Entries are keyed on the normalized
+    query text plus a digest of the conversation turns the prompt sees, so a repeated
+    question in the same context skips the Gemini round trip entirely.
+
+    The first tier is an in-process LRU with a size limit; the second is Redis, shared
+    by every API worker. Both tiers honour the same TTL.
+    """
+
+    KEY_PREFIX = "preprocess_cache:"
+
+    def __init__(self, redis=None, max_entries: int = 1024, ttl_seconds: int = 3600):
+        self.redis = redis
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple[float, dict]]" = OrderedDict()
+        self._lock = asyncio.Lock()
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        return " ".join(query.lower().split()).rstrip("?!. ")
+
+    @classmethod
+    def make_key(cls, query: str, history: list) -> str:
+        history_digest = hashlib.sha256(json.dumps(history, sort_keys=True).encode()).hexdigest()
+        return hashlib.sha256(f"{cls.normalize_query(query)}\x00{history_digest}".encode()).hexdigest()
+
+    async def get(self, key: str) -> Optional[dict]:
+        async with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, analysis = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return analysis
+                del self._entries[key]
+
+        if self.redis is not None:
+            raw = await self.redis.get(self.KEY_PREFIX + key)
+            if raw:
+                analysis = json.loads(raw)
+                await self._store_local(key, analysis)
+                self.redis_hits += 1
+                return analysis
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, analysis: dict):
+        await self._store_local(key, analysis)
+        if self.redis is not None:
+            await self.redis.set(self.KEY_PREFIX + key, json.dumps(analysis), ex=self.ttl_seconds)
+
+    async def _store_local(self, key: str, analysis: dict):
+        async with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, analysis)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.redis_hits + self.misses
+        return {
+            "hits": self.hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.redis_hits) / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+        }
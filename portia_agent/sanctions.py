@@ -0,0 +1,348 @@
+import os
+import csv
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import unicodedata
+import xml.etree.ElementTree as ET
+from difflib import SequenceMatcher
+from functools import lru_cache
+from typing import Optional
+import numpy as np
+
+# --- In-memory fuzzy sanctions screening ---
+# Watchlist files in SANCTIONS_LISTS_DIR are parsed into one flat list of names (primary
+# names and aliases). Names are normalized and transliterated, then indexed as a
+# character-trigram inverted index held in NumPy arrays. Screening a name counts
+# shared trigrams against every list name in a single `np.bincount`. Only the best
+# candidates are then rescored with a token-aware similarity.
+#
+# The compiled index is written next to the lists and memory-mapped on load, so worker
+# processes share its pages and a reload after a list update is cheap. Each build goes
+# into its own directory named after the lists' signature and is moved into place
+# complete, so files another process has mapped are never rewritten. Supported inputs:
+#   - OFAC SDN `sdn.csv` (+ optional `alt.csv` aliases), headerless as published
+#   - Generic CSV with a header: name, aliases (";"-separated), entity_id, type, program, list
+#   - UN consolidated list XML (INDIVIDUAL / ENTITY records)
+#   - EU consolidated financial sanctions XML (sanctionEntity / nameAlias)
+DEFAULT_SANCTIONS_LISTS_DIR = os.path.join(os.path.dirname(__file__), "data", "sanctions")
+INDEX_DIR_NAME = ".index"
+DEFAULT_MATCH_THRESHOLD = float(os.getenv("SANCTIONS_MATCH_THRESHOLD", "0.85"))
+# Candidates (by trigram Dice score) rescored with the exact similarity per screened name
+RESCORE_CANDIDATES = 20
+# Shorter single-word queries are too common to match one word of a listed name on their own
+MIN_SINGLE_TOKEN_LENGTH = 4
+
+_TRANSLITERATION = str.maketrans({
+    "ß": "ss", "æ": "ae", "œ": "oe", "ø": "o", "ł": "l", "đ": "d", "ð": "d", "þ": "th", "ı": "i",
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "e", "ж": "zh", "з": "z",
+    "и": "i", "й": "y", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p", "р": "r",
+    "с": "s", "т": "t", "у": "u", "ф": "f", "х": "kh", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "shch",
+    "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "yu", "я": "ya", "і": "i", "ї": "yi", "є": "ye", "ґ": "g",
+})
+# Legal-form and filler tokens that say nothing about who an entity is
+_STOP_TOKENS = {
+    "the", "ltd", "limited", "llc", "inc", "incorporated", "co", "corp", "corporation", "company",
+    "gmbh", "ag", "sa", "sarl", "srl", "bv", "nv", "plc", "ooo", "oao", "zao", "pao", "jsc", "pjsc", "fze", "fzco",
+}
+
+
+def normalize_name(name: str) -> str:
+    """Lower-cases, transliterates and strips accents, punctuation and legal-form tokens."""
+    name = unicodedata.normalize("NFKD", name.lower().translate(_TRANSLITERATION))
+    name = "".join(ch if ch.isalnum() else " " for ch in name if not unicodedata.combining(ch))
+    tokens = [token for token in name.split() if token not in _STOP_TOKENS]
+    return " ".join(tokens) if tokens else " ".join(name.split())
+
+
+def _trigrams(normalized: str) -> set:
+    """Per-token padded trigrams, so word order does not affect the overlap count."""
+    grams = set()
+    for token in normalized.split():
+        padded = f"  {token} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+@lru_cache(maxsize=65536)
+def _token_ratio(a: str, b: str) -> float:
+    # Name tokens repeat heavily across lists and queries, so token-pair ratios are memoized
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def similarity(query_tokens: list, name_tokens: list) -> float:
+    """
+    The better of the mean best-match ratio of each query token against the list name's
+    tokens, and the token-sorted string ratio. The former keeps "Vladimir Poutin" close
+    to "PUTIN, Vladimir Vladimirovich" and "Rosneft" close to "Rosneft Oil Company".
+    """
+    score = 0.0
+    if name_tokens and (len(query_tokens) >= 2 or (query_tokens and len(query_tokens[0]) >= MIN_SINGLE_TOKEN_LENGTH)):
+        score = sum(max(_token_ratio(q, n) for n in name_tokens) for q in query_tokens) / len(query_tokens)
+    matcher = SequenceMatcher(None, " ".join(sorted(query_tokens)), " ".join(sorted(name_tokens)))
+    # quick_ratio() is a cheap upper bound; skip the full ratio when it cannot win
+    if matcher.quick_ratio() > score:
+        score = max(score, matcher.ratio())
+    return score
+
+
+# --- Watchlist parsers ---
+def _parse_ofac_sdn(lists_dir: str, path: str) -> list:
+    entries, by_id = [], {}
+    with open(path, newline="", encoding="utf-8", errors="replace") as f:
+        for row in csv.reader(f):
+            if len(row) < 4 or not row[0].strip().isdigit():
+                continue
+            entry = {"name": row[1].strip(), "primary_name": row[1].strip(), "entity_id": row[0].strip(), "type": row[2].strip().strip("-") or "entity", "program": row[3].strip(), "list": "OFAC SDN"}
+            entries.append(entry)
+            by_id[entry["entity_id"]] = entry
+    alt_path = os.path.join(lists_dir, "alt.csv")
+    if os.path.exists(alt_path):
+        with open(alt_path, newline="", encoding="utf-8", errors="replace") as f:
+            for row in csv.reader(f):
+                if len(row) >= 4 and row[0].strip() in by_id:
+                    entries.append({**by_id[row[0].strip()], "name": row[3].strip()})
+    return entries
+
+
+def _parse_generic_csv(path: str) -> list:
+    entries = []
+    list_name = os.path.splitext(os.path.basename(path))[0]
+    with open(path, newline="", encoding="utf-8", errors="replace") as f:
+        for record in csv.DictReader(f):
+            primary = (record.get("name") or "").strip()
+            if not primary:
+                continue
+            entry = {"name": primary, "primary_name": primary, "entity_id": record.get("entity_id", ""), "type": record.get("type", ""), "program": record.get("program", ""), "list": record.get("list") or list_name}
+            entries.append(entry)
+            entries.extend({**entry, "name": alias.strip()} for alias in (record.get("aliases") or "").split(";") if alias.strip())
+    return entries
+
+
+def _local(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def _parse_xml(path: str) -> list:
+    """UN consolidated list (INDIVIDUAL/ENTITY) and EU consolidated list (sanctionEntity) XML."""
+    entries = []
+    for _event, element in ET.iterparse(path, events=("end",)):
+        tag = _local(element.tag)
+        if tag in ("INDIVIDUAL", "ENTITY"):
+            fields = {_local(child.tag): (child.text or "").strip() for child in element}
+            primary = " ".join(fields.get(part, "") for part in ("FIRST_NAME", "SECOND_NAME", "THIRD_NAME", "FOURTH_NAME")).strip()
+            if primary:
+                entry = {"name": primary, "primary_name": primary, "entity_id": fields.get("REFERENCE_NUMBER", ""), "type": tag.lower(), "program": fields.get("UN_LIST_TYPE", ""), "list": "UN"}
+                entries.append(entry)
+                for alias in element.iter():
+                    if _local(alias.tag) == "ALIAS_NAME" and alias.text and alias.text.strip():
+                        entries.append({**entry, "name": alias.text.strip()})
+            element.clear()
+        elif tag == "sanctionEntity":
+            aliases = [alias.get("wholeName", "").strip() for alias in element.iter() if _local(alias.tag) == "nameAlias"]
+            aliases = [alias for alias in aliases if alias]
+            if aliases:
+                subject = next((child for child in element.iter() if _local(child.tag) == "subjectType"), None)
+                entry = {"name": aliases[0], "primary_name": aliases[0], "entity_id": element.get("logicalId", ""), "type": subject.get("code", "") if subject is not None else "", "program": "", "list": "EU"}
+                entries.append(entry)
+                entries.extend({**entry, "name": alias} for alias in aliases[1:])
+            element.clear()
+    return entries
+
+
+def _list_files(lists_dir: str) -> list:
+    if not os.path.isdir(lists_dir):
+        return []
+    return sorted(
+        os.path.join(lists_dir, name) for name in os.listdir(lists_dir)
+        if name.lower().endswith((".csv", ".xml")) and name.lower() != "alt.csv"
+    )
+
+
+def load_watchlists(lists_dir: str) -> list:
+    entries = []
+    for path in _list_files(lists_dir):
+        name = os.path.basename(path).lower()
+        if name == "sdn.csv":
+            entries.extend(_parse_ofac_sdn(lists_dir, path))
+        elif name.endswith(".csv"):
+            entries.extend(_parse_generic_csv(path))
+        else:
+            entries.extend(_parse_xml(path))
+    return entries
+
+
+def _lists_signature(lists_dir: str) -> str:
+    """Changes whenever a list file is added, removed or modified."""
+    paths = _list_files(lists_dir)
+    alt_path = os.path.join(lists_dir, "alt.csv")
+    if os.path.exists(alt_path):
+        paths.append(alt_path)
+    stats = [f"{path}:{os.stat(path).st_mtime_ns}:{os.stat(path).st_size}" for path in paths]
+    return hashlib.sha256("\n".join(stats).encode()).hexdigest()
+
+
+class SanctionsIndex:
+    """Trigram inverted index over normalized watchlist names, stored as CSR-style arrays."""
+
+    def __init__(self, entries: list, normalized_names: list, vocabulary: dict, postings_indptr, postings_indices, name_gram_counts):
+        self.entries = entries
+        self.normalized_names = normalized_names
+        self.normalized_tokens = [normalized.split() for normalized in normalized_names]
+        self.vocabulary = vocabulary
+        self.postings_indptr = postings_indptr
+        self.postings_indices = postings_indices
+        self.name_gram_counts = name_gram_counts
+
+    @classmethod
+    def build(cls, entries: list) -> "SanctionsIndex":
+        vocabulary, postings = {}, []
+        normalized_names = [normalize_name(entry["name"]) for entry in entries]
+        name_gram_counts = np.zeros(len(entries), dtype=np.int32)
+        for name_id, normalized in enumerate(normalized_names):
+            grams = _trigrams(normalized)
+            name_gram_counts[name_id] = len(grams)
+            for gram in grams:
+                gram_id = vocabulary.setdefault(gram, len(vocabulary))
+                if gram_id == len(postings):
+                    postings.append([])
+                postings[gram_id].append(name_id)
+        postings_indptr = np.zeros(len(postings) + 1, dtype=np.int64)
+        postings_indptr[1:] = np.cumsum([len(p) for p in postings])
+        postings_indices = np.fromiter((name_id for p in postings for name_id in p), dtype=np.int32, count=int(postings_indptr[-1]))
+        return cls(entries, normalized_names, vocabulary, postings_indptr, postings_indices, name_gram_counts)
+
+    @staticmethod
+    def _version_dir(index_dir: str, signature: str) -> str:
+        return os.path.join(index_dir, signature[:32])
+
+    def save(self, index_dir: str, signature: str):
+        """Writes the index to a temporary directory and renames it into its versioned place."""
+        os.makedirs(index_dir, exist_ok=True)
+        build_dir = tempfile.mkdtemp(prefix=".build-", dir=index_dir)
+        try:
+            np.save(os.path.join(build_dir, "postings_indptr.npy"), self.postings_indptr)
+            np.save(os.path.join(build_dir, "postings_indices.npy"), self.postings_indices)
+            np.save(os.path.join(build_dir, "name_gram_counts.npy"), self.name_gram_counts)
+            with open(os.path.join(build_dir, "index.json"), "w", encoding="utf-8") as f:
+                json.dump({"signature": signature, "entries": self.entries, "normalized_names": self.normalized_names, "vocabulary": self.vocabulary}, f)
+            try:
+                os.replace(build_dir, self._version_dir(index_dir, signature))
+            except OSError:
+                # Another process already published this version; theirs is identical
+                if not os.path.isdir(self._version_dir(index_dir, signature)):
+                    raise
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+        # Older versions are unlinked, not truncated, so processes still mapping them are unaffected
+        current = os.path.basename(self._version_dir(index_dir, signature))
+        for name in os.listdir(index_dir):
+            path = os.path.join(index_dir, name)
+            if name == current or name.startswith(".build-"):
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                # Files of the earlier, unversioned layout
+                os.remove(path)
+
+    @classmethod
+    def load(cls, index_dir: str, signature: str) -> Optional["SanctionsIndex"]:
+        """Memory-maps a saved index, or returns None if it is missing or built from older lists."""
+        version_dir = cls._version_dir(index_dir, signature)
+        try:
+            with open(os.path.join(version_dir, "index.json"), encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta["signature"] != signature:
+                return None
+            arrays = [np.load(os.path.join(version_dir, f"{name}.npy"), mmap_mode="r") for name in ("postings_indptr", "postings_indices", "name_gram_counts")]
+        except (OSError, ValueError, KeyError):
+            return None
+        return cls(meta["entries"], meta["normalized_names"], meta["vocabulary"], *arrays)
+
+    def screen(self, name: str, threshold: float = DEFAULT_MATCH_THRESHOLD, max_matches: int = 5) -> list:
+        normalized = normalize_name(name)
+        all_query_grams = _trigrams(normalized)
+        query_grams = [self.vocabulary[gram] for gram in all_query_grams if gram in self.vocabulary]
+        if not query_grams or not self.entries:
+            return []
+
+        # Overlap of the query's trigrams with every list name, in one vectorized pass
+        postings = np.concatenate([self.postings_indices[self.postings_indptr[g]:self.postings_indptr[g + 1]] for g in query_grams])
+        overlap = np.bincount(postings, minlength=len(self.entries))
+        dice = 2 * overlap / (len(all_query_grams) + np.asarray(self.name_gram_counts))
+        query_tokens = normalized.split()
+        if len(query_tokens) == 1:
+            # A single word is matched against each word of a name, so a long name that
+            # contains it ("Sberbank of Russia") must rank by containment, not Dice
+            dice = np.maximum(dice, overlap / len(all_query_grams))
+        candidate_count = min(RESCORE_CANDIDATES, len(self.entries))
+        candidates = np.argpartition(-dice, candidate_count - 1)[:candidate_count]
+
+        best_by_entity = {}
+        for name_id in candidates:
+            # Dice bounds how similar two names can be; skip names that cannot reach the threshold
+            if dice[name_id] < threshold * 0.5:
+                continue
+            score = similarity(query_tokens, self.normalized_tokens[name_id])
+            if score < threshold:
+                continue
+            entry = self.entries[name_id]
+            key = (entry["list"], entry["entity_id"], entry["primary_name"])
+            if key not in best_by_entity or score > best_by_entity[key]["score"]:
+                best_by_entity[key] = {
+                    "matched_name": entry["name"],
+                    "primary_name": entry["primary_name"],
+                    "list": entry["list"],
+                    "entity_id": entry["entity_id"],
+                    "type": entry["type"],
+                    "program": entry["program"],
+                    "score": round(score, 4),
+                }
+        return sorted(best_by_entity.values(), key=lambda match: -match["score"])[:max_matches]
+
+    def screen_batch(self, names: list, threshold: float = DEFAULT_MATCH_THRESHOLD, max_matches: int = 5) -> list:
+        return [{"name": name, "matches": (matches := self.screen(name, threshold, max_matches)), "is_hit": bool(matches)} for name in names]
+
+
+class SanctionsScreener:
+    """Holds the current index and swaps in a rebuilt one when the list files change."""
+
+    def __init__(self, lists_dir: str, index_dir: Optional[str] = None):
+        self.lists_dir = lists_dir
+        self.index_dir = index_dir or os.path.join(lists_dir, INDEX_DIR_NAME)
+        self._signature = None
+        self._index = None
+        self._lock = threading.Lock()
+
+    def get_index(self) -> SanctionsIndex:
+        signature = _lists_signature(self.lists_dir)
+        if signature != self._signature:
+            with self._lock:
+                if signature != self._signature:
+                    index = SanctionsIndex.load(self.index_dir, signature)
+                    if index is None:
+                        print(f"Sanctions: building index from {self.lists_dir}...")
+                        index = SanctionsIndex.build(load_watchlists(self.lists_dir))
+                        try:
+                            index.save(self.index_dir, signature)
+                        except OSError as e:
+                            # A read-only lists directory only costs a rebuild on the next process start
+                            print(f"Sanctions: could not persist index to {self.index_dir}: {e}")
+                    self._index, self._signature = index, signature
+                    print(f"Sanctions: {len(index.entries)} names loaded.")
+        return self._index
+
+    def has_lists(self) -> bool:
+        return bool(_list_files(self.lists_dir))
+
+
+_screener = None
+
+def get_sanctions_screener() -> SanctionsScreener:
+    global _screener
+    if _screener is None:
+        _screener = SanctionsScreener(os.getenv("SANCTIONS_LISTS_DIR", DEFAULT_SANCTIONS_LISTS_DIR), os.getenv("SANCTIONS_INDEX_DIR"))
+    return _screener
@@ -0,0 +1,270 @@
+import re
+from dataclasses import dataclass, field
+from typing import Optional
+
+# --- Deterministic fast path for the pre-processing completeness check ---
+# The "CRITICAL RULES" in `PortiaAIAgent.pre_process_query` are plain slot requirements.
+# This module extracts those slots locally and answers by itself when it is confident;
+# anything ambiguous returns None so the caller falls through to Gemini.
+#
+# Destination countries and money amounts are matched reliably, so a query missing
+# them can be answered with a clarification question. Products and customer names
+# are free text, so they are only used to declare a query ready — if they cannot be
+# extracted, the query goes to the LLM.
+#
+# The templated enriched query only carries the slots. It is used only when every other
+# word of the query is a connective; otherwise (payment terms, a second task) the query
+# is passed on verbatim so nothing is lost.
+
+COUNTRIES = {
+    "argentina": "Argentina", "australia": "Australia", "austria": "Austria", "bangladesh": "Bangladesh",
+    "belgium": "Belgium", "brazil": "Brazil", "canada": "Canada", "chile": "Chile", "china": "China",
+    "colombia": "Colombia", "czech republic": "Czech Republic", "czechia": "Czech Republic",
+    "denmark": "Denmark", "egypt": "Egypt", "finland": "Finland", "france": "France", "germany": "Germany",
+    "greece": "Greece", "hong kong": "Hong Kong", "hungary": "Hungary", "india": "India",
+    "indonesia": "Indonesia", "ireland": "Ireland", "israel": "Israel", "italy": "Italy", "japan": "Japan",
+    "kenya": "Kenya", "malaysia": "Malaysia", "mexico": "Mexico", "morocco": "Morocco",
+    "netherlands": "Netherlands", "the netherlands": "Netherlands", "holland": "Netherlands",
+    "new zealand": "New Zealand", "nigeria": "Nigeria", "norway": "Norway", "pakistan": "Pakistan",
+    "peru": "Peru", "philippines": "Philippines", "poland": "Poland", "portugal": "Portugal",
+    "romania": "Romania", "saudi arabia": "Saudi Arabia", "singapore": "Singapore",
+    "south africa": "South Africa", "south korea": "South Korea", "korea": "South Korea", "spain": "Spain",
+    "sri lanka": "Sri Lanka", "sweden": "Sweden", "switzerland": "Switzerland", "taiwan": "Taiwan",
+    "thailand": "Thailand", "turkey": "Turkey", "turkiye": "Turkey", "ukraine": "Ukraine",
+    "united arab emirates": "United Arab Emirates", "uae": "United Arab Emirates",
+    "united kingdom": "United Kingdom", "uk": "United Kingdom", "great britain": "United Kingdom",
+    "britain": "United Kingdom", "england": "United Kingdom",
+    "united states": "United States", "usa": "United States",
+    "u.s.": "United States", "america": "United States", "vietnam": "Vietnam", "viet nam": "Vietnam",
+}
+
+# ISO 3166 alpha-2 codes, only matched when written in upper case ("IN", "IT" and "NO" are words too)
+ISO_CODES = {
+    "AR": "Argentina", "AU": "Australia", "AT": "Austria", "BD": "Bangladesh", "BE": "Belgium", "BR": "Brazil",
+    "CA": "Canada", "CL": "Chile", "CN": "China", "CO": "Colombia", "CZ": "Czech Republic", "DK": "Denmark",
+    "EG": "Egypt", "FI": "Finland", "FR": "France", "DE": "Germany", "GR": "Greece", "HK": "Hong Kong",
+    "HU": "Hungary", "IN": "India", "ID": "Indonesia", "IE": "Ireland", "IL": "Israel", "IT": "Italy",
+    "JP": "Japan", "KE": "Kenya", "MY": "Malaysia", "MX": "Mexico", "MA": "Morocco", "NL": "Netherlands",
+    "NZ": "New Zealand", "NG": "Nigeria", "NO": "Norway", "PK": "Pakistan", "PE": "Peru", "PH": "Philippines",
+    "PL": "Poland", "PT": "Portugal", "RO": "Romania", "SA": "Saudi Arabia", "SG": "Singapore",
+    "ZA": "South Africa", "KR": "South Korea", "ES": "Spain", "LK": "Sri Lanka", "SE": "Sweden",
+    "CH": "Switzerland", "TW": "Taiwan", "TH": "Thailand", "TR": "Turkey", "UA": "Ukraine",
+    "AE": "United Arab Emirates", "GB": "United Kingdom", "US": "United States", "VN": "Vietnam",
+}
+
+CURRENCY_CODES = {
+    "USD", "EUR", "GBP", "JPY", "CNY", "INR", "AUD", "CAD", "NZD", "CHF", "SGD", "HKD", "AED",
+    "SEK", "NOK", "DKK", "ZAR", "MXN", "BRL", "KRW",
+}
+CURRENCY_SYMBOLS = {"$": "USD", "€": "EUR", "£": "GBP", "¥": "JPY", "₹": "INR"}
+# "pounds" is deliberately absent: "500 pounds of cotton" is a weight
+CURRENCY_WORDS = {"dollars": "USD", "dollar": "USD", "euros": "EUR", "euro": "EUR", "yen": "JPY", "rupees": "INR"}
+
+_AMOUNT = r"(\d{1,3}(?:,\d{3})+(?:\.\d+)?|\d+(?:\.\d+)?)"
+_CURRENCY_PREFIX_RE = re.compile(
+    r"(?:(?P<symbol>[$€£¥₹])|\b(?P<code>" + "|".join(CURRENCY_CODES) + r"))\s?" + _AMOUNT, re.IGNORECASE
+)
+_CURRENCY_SUFFIX_RE = re.compile(
+    _AMOUNT + r"\s?(?P<code>" + "|".join(list(CURRENCY_CODES) + list(CURRENCY_WORDS)) + r")\b", re.IGNORECASE
+)
+
+_COUNTRY_NAMES_RE = "|".join(re.escape(name) for name in sorted(COUNTRIES, key=len, reverse=True))
+_COUNTRY_RE = re.compile(r"(?<![\w.])(?P<name>" + _COUNTRY_NAMES_RE + r")(?![\w])", re.IGNORECASE)
+_ISO_RE = re.compile(r"\b(?P<iso>" + "|".join(ISO_CODES) + r")\b")
+_ORIGIN_PREPOSITION_RE = re.compile(r"\b(?:from|origin|originating in|made in|manufactured in)\s+$", re.IGNORECASE)
+_DESTINATION_PREPOSITION_RE = re.compile(r"\b(?:to|into|in|destination|destined for|entering)\s+(?:the\s+)?$", re.IGNORECASE)
+
+INTENT_PATTERNS = {
+    "hs_code": re.compile(r"\bhs[\s-]?codes?\b|\bharmoni[sz]ed (?:system|code|tariff)\b|\btariff (?:code|classification)\b|\bclassif(?:y|ication)\b", re.IGNORECASE),
+    "duty": re.compile(r"\bdut(?:y|ies)\b|\blanded cost\b|\bimport tax(?:es)?\b|\bcustoms charges?\b", re.IGNORECASE),
+    "invoice": re.compile(r"\binvoices?\b", re.IGNORECASE),
+}
+# Yes/no and open questions ("Is there an anti-dumping duty on steel?") are not slot-filling requests
+_OPEN_QUESTION_RE = re.compile(r"^\s*(?:is|are|does|do|can|could|should|why|when|which|compare)\b", re.IGNORECASE)
+CREATE_VERB_RE = re.compile(r"\b(?:create|raise|issue|make|generate|draft|prepare|bill)\b", re.IGNORECASE)
+# "20 chairs at 50 USD each": the amount is a unit price, not the total
+_UNIT_PRICE_RE = re.compile(r"\b(?:each|per|apiece)\b|@|\bx\s?\d|\d\s?x\b", re.IGNORECASE)
+
+_PRODUCT_RE = re.compile(
+    r"\b(?:for|of|on)\s+(?P<product>[a-z0-9][a-z0-9\s'\-/]*?)\s*"
+    r"(?=\b(?:into|to|in|from|worth|valued|at|with|for|shipped|going|imported|exported|and|totaling|totalling|"
+    r"made|manufactured|originating|produced)\b|[,.?!;]|$)"
+)
+_PRODUCT_FILLER = {
+    "a", "an", "the", "some", "my", "our", "of", "importing", "exporting", "shipping", "sending",
+    "selling", "buying", "customer", "import", "export", "value", "product", "products",
+}
+_NOT_A_PRODUCT = re.compile(r"\b(?:hs|code|codes|duty|duties|tax|taxes|invoice|invoices|customs|tariff|import|export)\b")
+# Words a request may contain besides its slots and intent without asking for anything more
+_CONNECTIVES = {
+    "a", "an", "the", "i", "we", "me", "my", "our", "you", "it", "s", "please", "what", "whats", "is", "be",
+    "would", "will", "can", "how", "much", "need", "want", "like", "find", "get", "give", "tell", "show",
+    "look", "up", "calculate", "compute", "work", "out", "determine", "estimate", "for", "of", "on", "to",
+    "into", "in", "from", "at", "with", "and", "then", "made", "manufactured", "originating", "produced",
+    "origin", "destination", "destined", "entering", "import", "imported", "importing", "imports", "export",
+    "exported", "exporting", "shipped", "shipping", "going", "sending", "worth", "valued", "value", "customs",
+    "amount", "total", "totaling", "totalling", "customer", "client", "new", "xero", "rate", "cost", "goods",
+    "product", "products", "shipment",
+}
+_WORD_RE = re.compile(r"[a-z]+|\d+")
+_CUSTOMER_RE = re.compile(
+    r"\b(?:customer|client|for|to|bill)\s+(?P<customer>[A-Z][\w&.'-]*(?:\s+(?:[A-Z][\w&.'-]*|&))*)"
+)
+
+
+@dataclass
+class QuerySlots:
+    intents: list = field(default_factory=list)
+    destination: Optional[str] = None
+    origin: Optional[str] = None
+    amount: Optional[str] = None
+    currency: Optional[str] = None
+    product: Optional[str] = None
+    customer: Optional[str] = None
+    ambiguous: bool = False
+    # Words of the query that no slot, intent or connective accounts for
+    unused: list = field(default_factory=list)
+
+
+def _extract_amount(query: str):
+    match = _CURRENCY_PREFIX_RE.search(query)
+    if match:
+        currency = CURRENCY_SYMBOLS.get(match.group("symbol")) if match.group("symbol") else match.group("code").upper()
+        return match.group(3), currency, match.span()
+    match = _CURRENCY_SUFFIX_RE.search(query)
+    if match:
+        code = match.group("code").lower()
+        return match.group(1), CURRENCY_WORDS.get(code, code.upper()), match.span()
+    return None, None, None
+
+
+def _extract_countries(query: str):
+    """
+    Returns (destination, origin, ambiguous). A country preceded by "from"/"made in" is
+    the origin; one preceded by "to"/"into" is the destination. A lone unmarked country
+    is taken as the destination, several unmarked ones are ambiguous.
+    """
+    mentions = [(m.start(), COUNTRIES[m.group("name").lower()]) for m in _COUNTRY_RE.finditer(query)]
+    mentions += [(m.start(), ISO_CODES[m.group("iso")]) for m in _ISO_RE.finditer(query)]
+    destinations, origins, unmarked = [], [], []
+    for start, country in sorted(mentions):
+        if _ORIGIN_PREPOSITION_RE.search(query[:start]):
+            origins.append(country)
+        elif _DESTINATION_PREPOSITION_RE.search(query[:start]):
+            destinations.append(country)
+        else:
+            unmarked.append(country)
+    origin = origins[0] if origins else None
+    if destinations:
+        # "into Germany and France" names two destinations
+        return destinations[0], origin, len(set(destinations + unmarked)) > 1
+    if len(set(unmarked)) == 1:
+        return unmarked[0], origin, False
+    return None, origin, len(set(unmarked)) > 1
+
+
+def _extract_product(text: str) -> Optional[str]:
+    for match in _PRODUCT_RE.finditer(text):
+        words = match.group("product").split()
+        while words and words[0] in _PRODUCT_FILLER:
+            words.pop(0)
+        product = " ".join(words)
+        if product and len(words) <= 8 and not _NOT_A_PRODUCT.search(product) and not _COUNTRY_RE.fullmatch(product):
+            return product
+    return None
+
+
+def _extract_customer(query: str):
+    for match in _CUSTOMER_RE.finditer(query):
+        customer = match.group("customer").strip()
+        if customer.lower() not in COUNTRIES and customer not in ISO_CODES and customer.upper() not in CURRENCY_CODES:
+            return customer, match.span("customer")
+    return None, None
+
+
+def extract_slots(query: str) -> QuerySlots:
+    slots = QuerySlots()
+    slots.intents = [intent for intent, pattern in INTENT_PATTERNS.items() if pattern.search(query)]
+    slots.amount, slots.currency, amount_span = _extract_amount(query)
+    slots.destination, slots.origin, slots.ambiguous = _extract_countries(query)
+
+    # Blank out the amount so "on 1,500 EUR of chairs" still yields the product, and
+    # replace the customer with a boundary so "for Acme for office chairs" does too
+    text = query
+    spans = [amount_span]
+    if "invoice" in slots.intents:
+        slots.customer, customer_span = _extract_customer(query)
+        spans.append(customer_span)
+    for start, end in sorted((span for span in spans if span), reverse=True):
+        text = text[:start] + " , " + text[end:] if (start, end) != amount_span else text[:start] + " " + text[end:]
+    slots.product = _extract_product(" ".join(text.split()).lower())
+    slots.unused = _unused_words(query, spans, slots.product)
+    return slots
+
+
+def _unused_words(query: str, spans: list, product: Optional[str]) -> list:
+    spans = list(spans)
+    for pattern in (_COUNTRY_RE, _ISO_RE, CREATE_VERB_RE, *INTENT_PATTERNS.values()):
+        spans += [match.span() for match in pattern.finditer(query)]
+    text = query
+    for start, end in sorted((span for span in spans if span), reverse=True):
+        text = text[:start] + " " + text[end:]
+    known = _CONNECTIVES | set(_WORD_RE.findall(product or ""))
+    return [word for word in _WORD_RE.findall(text.lower()) if word not in known]
+
+
+def _enriched_query(slots: QuerySlots) -> str:
+    origin = f" from {slots.origin}" if slots.origin else ""
+    if slots.intents == ["invoice"]:
+        return f"Create an invoice in Xero for customer {slots.customer} for {slots.product} with an amount of {slots.amount} {slots.currency}."
+    if slots.intents == ["hs_code"]:
+        return f"Find the HS code for {slots.product} for import into {slots.destination}{origin}."
+    if slots.intents == ["duty"]:
+        return f"Calculate the import duty for {slots.product} with a value of {slots.amount} {slots.currency} imported into {slots.destination}{origin}."
+    return (
+        f"Find the HS code for {slots.product} for import into {slots.destination}{origin} "
+        f"and then calculate the duty for a value of {slots.amount} {slots.currency}."
+    )
+
+
+def _clarification_question(slots: QuerySlots, missing: list) -> str:
+    subject = slots.product or "the goods"
+    if missing == ["destination"]:
+        return f"I can certainly look that up for you. Which country are you importing {subject} into?"
+    if missing == ["amount"]:
+        noun = "invoice amount" if "invoice" in slots.intents else "customs value"
+        return f"Happy to help. What is the {noun}, including the currency (for example 150 EUR)?"
+    return f"Happy to help. Which country are you importing {subject} into, and what is their customs value including the currency (for example 150 EUR)?"
+
+
+def fast_path_analysis(query: str, has_history: bool) -> Optional[dict]:
+    """
+    Returns a pre-processing analysis (same shape as the Gemini response) when the
+    rules can decide on their own, or None when the query needs the LLM.
+    Follow-up turns with history may rely on earlier context, so they are only
+    answered here when the current message is complete on its own.
+    """
+    if _OPEN_QUESTION_RE.match(query) or _UNIT_PRICE_RE.search(query):
+        return None
+    slots = extract_slots(query)
+    if not slots.intents or slots.ambiguous:
+        return None
+    if "invoice" in slots.intents:
+        # Invoice requests mixed with other intents, or that do not ask to create one, need the LLM
+        if len(slots.intents) > 1 or not CREATE_VERB_RE.search(query):
+            return None
+        required_reliable = ["amount"]
+        required_free_text = [slots.customer, slots.product]
+    else:
+        required_reliable = ["destination"] + (["amount"] if "duty" in slots.intents else [])
+        required_free_text = [slots.product]
+
+    missing = [name for name in required_reliable if getattr(slots, name) is None]
+    if missing:
+        if has_history:
+            return None
+        return {"status": "clarification_needed", "clarification_question": _clarification_question(slots, missing), "source": "rules"}
+    if all(required_free_text):
+        enriched_query = query if slots.unused else _enriched_query(slots)
+        return {"status": "ready_for_execution", "enriched_query": enriched_query, "source": "rules"}
+    return None
@@ -0,0 +1,107 @@
+from typing import Optional
+import pandas as pd
+from pydantic import BaseModel, Field
+from portia import Tool, ToolHardError, ToolRunContext
+from portia_agent.hs_index import get_hs_index
+from portia_agent.landed_cost import get_tariff_tables
+from portia_agent.sanctions import DEFAULT_MATCH_THRESHOLD, get_sanctions_screener
+from portia_agent.slot_extractor import COUNTRIES, ISO_CODES
+from backend.redis_client import get_redis_client
+
+# --- Local compliance tools ---
+# These run in-process against local indexes, so the planner can use them instead of
+# LLM or web-search steps for lookups that do not need either.
+
+class HSCodeLookupToolSchema(BaseModel):
+    product_descriptions: list[str] = Field(..., description="One or more product descriptions to classify, e.g. ['cotton t-shirts', 'wooden chairs'].")
+    top_k: int = Field(3, description="Number of candidate HS codes to return per description.")
+
+class HSCodeLookupTool(Tool[list]):
+    id: str = "hs_code_lookup_tool"
+    name: str = "HS Code Lookup Tool"
+    description: str = (
+        "Classifies product descriptions against the Harmonized System nomenclature. "
+        "Returns the closest candidate HS codes for each description, with a similarity score between 0 and 1. "
+        "Pass every product of a request in one call."
+    )
+    args_schema: type[BaseModel] = HSCodeLookupToolSchema
+    output_schema: tuple[str, str] = ("list", "For each product description, a list of {hs_code, description, score} candidates, best first.")
+
+    def run(self, _: ToolRunContext, product_descriptions: list[str], top_k: int = 3) -> list:
+        return [
+            {"product_description": description, "candidates": candidates}
+            for description, candidates in zip(product_descriptions, get_hs_index().lookup(product_descriptions, top_k=top_k))
+        ]
+
+class SanctionsScreeningToolSchema(BaseModel):
+    names: list[str] = Field(..., description="Names of the people or organisations to screen, e.g. customers, consignees or banks.")
+    threshold: float = Field(DEFAULT_MATCH_THRESHOLD, description="Minimum similarity between 0 and 1 for a watchlist name to count as a match.")
+
+class SanctionsScreeningTool(Tool[list]):
+    id: str = "sanctions_screening_tool"
+    name: str = "Sanctions Screening Tool"
+    description: str = (
+        "Screens people and organisations against the loaded sanctions watchlists (OFAC SDN, EU, UN) "
+        "using fuzzy name matching that handles aliases, transliteration and word order. "
+        "Pass every name of a request in one call."
+    )
+    args_schema: type[BaseModel] = SanctionsScreeningToolSchema
+    output_schema: tuple[str, str] = ("list", "For each name, whether it is a potential hit and the matching watchlist entries with scores.")
+
+    def run(self, _: ToolRunContext, names: list[str], threshold: float = DEFAULT_MATCH_THRESHOLD) -> list:
+        screener = get_sanctions_screener()
+        if not screener.has_lists():
+            raise ToolHardError("No sanctions watchlists are loaded; screening is unavailable.")
+        return screener.get_index().screen_batch(names, threshold=threshold)
+
+_ISO_BY_COUNTRY = {country: code for code, country in ISO_CODES.items()}
+
+def _country_code(country: str) -> Optional[str]:
+    """ISO 3166 alpha-2 code for a country name or code, as used by the tariff tables."""
+    country = (country or "").strip()
+    if country.upper() in ISO_CODES:
+        return country.upper()
+    return _ISO_BY_COUNTRY.get(COUNTRIES.get(country.lower(), country))
+
+class LandedCostToolSchema(BaseModel):
+    hs_code: str = Field(..., description="HS code of the goods, e.g. '610910'.")
+    destination: str = Field(..., description="Destination country name or ISO 3166 alpha-2 code.")
+    origin: str = Field("", description="Country of origin name or ISO code; empty if unknown.")
+    value: float = Field(..., description="Customs value of the goods, as a plain number.")
+    currency: str = Field(..., description="ISO 4217 currency code of the customs value, e.g. 'EUR'.")
+
+class LandedCostTool(Tool[dict]):
+    id: str = "landed_cost_tool"
+    name: str = "Landed Cost Tool"
+    description: str = (
+        "Calculates the import duty, import tax and landed cost of goods from the local tariff tables, "
+        "given their HS code, destination, origin and customs value. Use it instead of estimating duty rates."
+    )
+    args_schema: type[BaseModel] = LandedCostToolSchema
+    output_schema: tuple[str, str] = ("dict", "The duty rate and amount, import tax rate and amount, and landed cost, in the value's currency.")
+
+    def run(self, _: ToolRunContext, hs_code: str, destination: str, value: float, currency: str, origin: str = "") -> dict:
+        destination_code = _country_code(destination)
+        if destination_code is None:
+            raise ToolHardError(f"Unknown destination country: {destination}")
+        line = pd.DataFrame([{"hs_code": hs_code, "origin": _country_code(origin) or "", "destination": destination_code, "value": value, "currency": currency}])
+        try:
+            priced = get_tariff_tables(get_redis_client()).price(line, report_currency=currency).iloc[0]
+        except ValueError as e:
+            raise ToolHardError(str(e))
+        if priced["status"] not in ("ok", "no_tax_rate"):
+            raise ToolHardError(f"Cannot price HS {hs_code} into {destination_code}: {priced['status']}")
+        return {
+            "hs_code": hs_code,
+            "destination": destination_code,
+            "currency": priced["report_currency"],
+            "customs_value": float(priced["customs_value"]),
+            "duty_rate": float(priced["duty_rate"]),
+            "duty": float(priced["duty"]),
+            "import_tax_rate": None if pd.isna(priced["tax_rate"]) else float(priced["tax_rate"]),
+            "import_tax": None if pd.isna(priced["tax"]) else float(priced["tax"]),
+            "landed_cost": None if pd.isna(priced["landed_cost"]) else float(priced["landed_cost"]),
+        }
+
+def get_local_tools() -> list:
+    return [HSCodeLookupTool(), SanctionsScreeningTool(), LandedCostTool()]
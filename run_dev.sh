@@ -19,12 +19,17 @@ echo "Starting FastAPI backend on http://localhost:8000"
 FASTAPI_PID=$!
 sleep 5
 
+# Start the plan-run worker that executes queued /chat and /resume_flow jobs
+echo "Starting plan-run worker"
+"$VENV_PYTHON" -m backend.worker &
+WORKER_PID=$!
+
 # Start the Streamlit frontend server in the foreground
 echo "Starting Streamlit frontend on http://localhost:8501"
 # --- THIS LINE IS THE FIX ---
 "$VENV_PYTHON" -m streamlit run frontend/app.py --server.port 8501 --server.enableCORS true
 
 # This part runs after you stop Streamlit (Ctrl+C)
-echo "Streamlit frontend stopped. Shutting down FastAPI backend..."
-kill $FASTAPI_PID
+echo "Streamlit frontend stopped. Shutting down FastAPI backend and worker..."
+kill $FASTAPI_PID $WORKER_PID
 echo "Servers stopped."
@@ -0,0 +1,19 @@
+import io
+
+from portia_agent.landed_cost import TariffTables, price_shipment_file
+
+
+def test_namibia_is_not_read_as_missing(tmp_path):
+    (tmp_path / "duty_rates.csv").write_text("destination,hs_prefix,origin,duty_rate\nNA,6109,*,0.3\n")
+    (tmp_path / "tax_rates.csv").write_text("destination,tax_name,tax_rate\nNA,VAT,0.15\n")
+    (tmp_path / "fx_rates.csv").write_text("currency,usd_per_unit\nUSD,1.0\n")
+    tables = TariffTables.from_dir(str(tmp_path))
+    manifest = io.StringIO("hs_code,origin,destination,value,currency\n610910,NA,NA,100,USD\n610910,,NA,,USD\n")
+
+    priced = "".join(price_shipment_file(tables, manifest, "csv")).splitlines()
+
+    header = priced[0].split(",")
+    first, second = (dict(zip(header, line.split(","))) for line in priced[1:])
+    assert (first["origin"], first["destination"], first["duty"], first["tax"], first["status"]) == ("NA", "NA", "30.0", "19.5", "ok")
+    # Empty cells are still missing values
+    assert second["status"] == "invalid_value"
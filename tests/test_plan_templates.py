@@ -0,0 +1,21 @@
+import pytest
+
+pytest.importorskip("portia")
+
+from portia_agent.plan_templates import route_query
+
+
+def test_complete_invoice_request_uses_the_template():
+    template, slots = route_query("Create an invoice in Xero for customer Acme Trading for office chairs with an amount of 2500 USD.")
+    assert template.name == "invoice_creation"
+    assert (slots.customer, slots.product, slots.amount, slots.currency) == ("Acme Trading", "office chairs", "2500", "USD")
+
+
+@pytest.mark.parametrize("query", [
+    "Void the invoice for Acme Trading for office chairs totaling 2500 USD",
+    "Find the existing invoice for Acme Trading for office chairs totaling 2500 USD and email it to the customer",
+    "Check whether invoice for Acme Trading for office chairs totaling 2500 USD has been paid",
+    "Find the HS code for steel pipes into Germany and screen the supplier Rosneft",
+])
+def test_requests_beyond_the_template_go_to_the_planner(query):
+    assert route_query(query) is None
@@ -0,0 +1,33 @@
+import pytest
+
+from portia_agent.sanctions import DEFAULT_MATCH_THRESHOLD, SanctionsIndex
+
+
+def _entry(name, entity_id):
+    return {"name": name, "primary_name": name, "entity_id": entity_id, "type": "entity", "program": "RUSSIA-EO14024", "list": "test"}
+
+
+@pytest.fixture
+def index():
+    return SanctionsIndex.build([
+        _entry("Rosneft Oil Company", "1"),
+        _entry("Sberbank of Russia", "2"),
+        _entry("PUTIN, Vladimir Vladimirovich", "3"),
+        _entry("Oil Trading Partners Ltd", "4"),
+    ])
+
+
+@pytest.mark.parametrize("name, primary_name", [
+    ("Rosneft", "Rosneft Oil Company"),
+    ("Sberbank", "Sberbank of Russia"),
+    ("SBERBANK", "Sberbank of Russia"),
+    ("Vladimir Poutin", "PUTIN, Vladimir Vladimirovich"),
+])
+def test_short_and_reordered_names_are_hits(index, name, primary_name):
+    matches = index.screen(name, threshold=DEFAULT_MATCH_THRESHOLD)
+    assert matches and matches[0]["primary_name"] == primary_name
+
+
+@pytest.mark.parametrize("name", ["Oil", "Acme Trading"])
+def test_unrelated_and_too_short_names_are_not_hits(index, name):
+    assert index.screen(name, threshold=DEFAULT_MATCH_THRESHOLD) == []
@@ -0,0 +1,30 @@
+import pytest
+
+from portia_agent.slot_extractor import extract_slots, fast_path_analysis
+
+
+def test_complete_query_gets_templated_enriched_query():
+    analysis = fast_path_analysis("Create an invoice for Acme Trading for office chairs totaling 2500 USD", has_history=False)
+    assert analysis["status"] == "ready_for_execution"
+    assert analysis["enriched_query"] == "Create an invoice in Xero for customer Acme Trading for office chairs with an amount of 2500 USD."
+
+
+@pytest.mark.parametrize("query", [
+    "Create an invoice for Acme Trading for office chairs totaling 2500 USD due in 30 days with 10% discount",
+    "Create an invoice for Acme Trading for office chairs totaling 2500 USD and email it to Bob",
+    "Find the HS code for steel pipes into Germany and also screen the supplier Rosneft",
+])
+def test_clauses_outside_the_slots_are_passed_through(query):
+    analysis = fast_path_analysis(query, has_history=False)
+    assert analysis["status"] == "ready_for_execution"
+    assert analysis["enriched_query"] == query
+
+
+def test_unit_price_falls_back_to_llm():
+    assert fast_path_analysis("Create an invoice for Acme Trading for 20 chairs at 50 USD each", has_history=False) is None
+
+
+def test_origin_is_not_part_of_the_product():
+    slots = extract_slots("HS code for shoes made in Italy into Germany")
+    assert (slots.product, slots.origin, slots.destination) == ("shoes", "Italy", "Germany")
+    assert slots.unused == []